@@ -1,7 +1,17 @@
+import os
 import subprocess
 import re
+import struct
 
 from . import ARM_CS_TOOLS
+from . import dwarf
+
+# Read DWARF straight out of the ELF where we can, instead of parsing objdump's output.
+USE_NATIVE_READER = True
+
+# Malformed DWARF tends to show up as one of these rather than anything more helpful.
+struct_errors = (struct.error, IndexError, KeyError, ValueError)
+
 
 class LineReader(object):
     def __init__(self, elf_path):
@@ -11,6 +21,27 @@ class LineReader(object):
         return subprocess.check_output([ARM_CS_TOOLS + "arm-none-eabi-objdump", "--dwarf=decodedline", self.elf])
 
     def get_line_listing(self):
+        if USE_NATIVE_READER:
+            try:
+                return self.get_native_line_listing()
+            except (dwarf.DWARFError, struct_errors) as e:
+                print "Falling back to objdump for line info: %s" % e
+        return self.get_objdump_line_listing()
+
+    def get_native_line_listing(self):
+        files = []
+        lines = []
+        with dwarf.ELFFile(self.elf) as elf:
+            for unit_files, rows in dwarf.iter_line_programs(elf):
+                # Mimic objdump: each unit is named after its first file, and only rows in .c files count.
+                if unit_files and unit_files[0].endswith('.c'):
+                    files.append(os.path.basename(unit_files[0]))
+                for file_index, line, address in rows:
+                    if 0 < file_index <= len(unit_files) and unit_files[file_index - 1].endswith('.c'):
+                        lines.append({'file': unit_files[file_index - 1], 'line': line, 'address': address})
+        return files, lines
+
+    def get_objdump_line_listing(self):
         decoded = self._exec_tool()
 
         # Hack: assume that any line some text ending in .c, followed by a
@@ -85,16 +116,41 @@ class FunctionReader(object):
 
 
     def iter_info_groups(self):
+        if USE_NATIVE_READER:
+            try:
+                # Read everything up front so that we can still fall back if something goes wrong part way through.
+                groups = self.get_native_info_groups()
+            except (dwarf.DWARFError, struct_errors) as e:
+                print "Falling back to objdump for function info: %s" % e
+            else:
+                for group in groups:
+                    yield group
+                return
+        for group in self.iter_objdump_info_groups():
+            yield group
+
+    def get_native_info_groups(self):
+        with dwarf.ELFFile(self.elf) as elf:
+            return [FunctionRange(name, start, end, line) for name, start, end, line in dwarf.iter_subprograms(elf)]
+
+    def iter_objdump_info_groups(self):
         content = self._exec_tool()
-        for match in re.finditer(r"<1><[0-9a-f]+>: Abbrev Number: \d+ \(DW_TAG_subprogram\)(.*?)<\d><[0-9a-f]+>", content, re.DOTALL):
-            fields = self._decode_info_fields(match.group(1))
-            if 'DW_AT_low_pc' not in fields or 'DW_AT_high_pc' not in fields or 'DW_AT_name' not in fields:
-                continue
-            fn_name = fields['DW_AT_name'].split(' ')[-1] # Function name is the last word in this line.
-            fn_start = int(fields['DW_AT_low_pc'], 16)
-            fn_end = int(fields['DW_AT_high_pc'], 16)
-            fn_line = int(fields['DW_AT_decl_line']) if 'DW_AT_decl_line' in fields else None
-            yield FunctionRange(fn_name, fn_start, fn_end, fn_line)
+        for unit in re.split(r"^\s*Compilation Unit @ offset", content, flags=re.MULTILINE)[1:]:
+            version = re.search(r"^\s*Version:\s*(\d+)", unit, re.MULTILINE)
+            version = int(version.group(1)) if version else 2
+            for match in re.finditer(r"<1><[0-9a-f]+>: Abbrev Number: \d+ \(DW_TAG_subprogram\)(.*?)<\d><[0-9a-f]+>", unit, re.DOTALL):
+                fields = self._decode_info_fields(match.group(1))
+                if 'DW_AT_low_pc' not in fields or 'DW_AT_high_pc' not in fields or 'DW_AT_name' not in fields:
+                    continue
+                fn_name = fields['DW_AT_name'].split(' ')[-1] # Function name is the last word in this line.
+                fn_start = int(fields['DW_AT_low_pc'], 16)
+                fn_end = int(fields['DW_AT_high_pc'], 16)
+                # Since DWARF 4, GCC gives high_pc as the function's length. objdump doesn't say which form it has,
+                # so go by the unit's version, and report the end address as dwarf.iter_subprograms does.
+                if version >= 4:
+                    fn_end += fn_start
+                fn_line = int(fields['DW_AT_decl_line']) if 'DW_AT_decl_line' in fields else None
+                yield FunctionRange(fn_name, fn_start, fn_end, fn_line)
 
     def get_info_groups(self):
         return list(self.iter_info_groups())
@@ -103,3 +159,25 @@ def create_coalesced_group(elf):
     dict = LineReader(elf).get_compact_listing()
     dict['functions'] = sorted([(x.start, x.end, x.name, x.line) for x in FunctionReader(elf).iter_info_groups()], key=lambda x: x[0])
     return dict
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    parser = argparse.ArgumentParser(description="Extracts line and function information from an ELF file as JSON.")
+    parser.add_argument('elf')
+    parser.add_argument('--tools', help="Directory containing arm-none-eabi-objdump", default=ARM_CS_TOOLS)
+    parser.add_argument('--output', help="File to write to, instead of stdout")
+    parser.add_argument('--format', choices=('json', 'compact'), default='json')
+    args = parser.parse_args()
+    ARM_CS_TOOLS = args.tools
+    if args.format == 'compact':
+        from .symbols import pack_debug_info
+        result = pack_debug_info(create_coalesced_group(args.elf))
+    else:
+        result = json.dumps(create_coalesced_group(args.elf))
+    if args.output:
+        with open(args.output, 'wb') as f:
+            f.write(result)
+    else:
+        print result
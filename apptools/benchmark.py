@@ -0,0 +1,46 @@
+import argparse
+import time
+
+from . import addr2lines
+
+
+def time_reader(elf, native, repeat):
+    """
+    :return: a tuple of the best time taken to extract debug info from elf, and the info itself.
+    """
+    addr2lines.USE_NATIVE_READER = native
+    best = None
+    result = None
+    for i in xrange(repeat):
+        start = time.time()
+        result = addr2lines.create_coalesced_group(elf)
+        taken = time.time() - start
+        if best is None or taken < best:
+            best = taken
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares reading debug info from ELFs directly with parsing "
+                                                 "objdump's output.")
+    parser.add_argument('elfs', nargs='+')
+    parser.add_argument('--tools', help="Directory containing arm-none-eabi-objdump",
+                        default=addr2lines.ARM_CS_TOOLS)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    addr2lines.ARM_CS_TOOLS = args.tools
+
+    for elf in args.elfs:
+        try:
+            objdump_time, objdump_result = time_reader(elf, False, args.repeat)
+        except Exception as e:
+            print "%s: objdump failed: %s" % (elf, e)
+            continue
+        native_time, native_result = time_reader(elf, True, args.repeat)
+        print "%s: objdump %.3fs, native %.3fs (%.1fx), %s" % (
+            elf, objdump_time, native_time, objdump_time / max(native_time, 1e-6),
+            "same output" if objdump_result == native_result else "OUTPUT DIFFERS")
+
+
+if __name__ == '__main__':
+    main()
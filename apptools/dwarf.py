@@ -0,0 +1,371 @@
+"""
+Just enough of an ELF and DWARF (versions 2 to 4) reader to get line tables and function ranges out of
+a build without going through objdump. Sections are read straight from a memory map of the file.
+"""
+import mmap
+import struct
+
+DW_TAG_subprogram = 0x2e
+
+DW_AT_name = 0x03
+DW_AT_low_pc = 0x11
+DW_AT_high_pc = 0x12
+DW_AT_decl_line = 0x3b
+
+DW_FORM_addr = 0x01
+DW_FORM_block2 = 0x03
+DW_FORM_block4 = 0x04
+DW_FORM_data2 = 0x05
+DW_FORM_data4 = 0x06
+DW_FORM_data8 = 0x07
+DW_FORM_string = 0x08
+DW_FORM_block = 0x09
+DW_FORM_block1 = 0x0a
+DW_FORM_data1 = 0x0b
+DW_FORM_flag = 0x0c
+DW_FORM_sdata = 0x0d
+DW_FORM_strp = 0x0e
+DW_FORM_udata = 0x0f
+DW_FORM_ref_addr = 0x10
+DW_FORM_ref1 = 0x11
+DW_FORM_ref2 = 0x12
+DW_FORM_ref4 = 0x13
+DW_FORM_ref8 = 0x14
+DW_FORM_ref_udata = 0x15
+DW_FORM_indirect = 0x16
+DW_FORM_sec_offset = 0x17
+DW_FORM_exprloc = 0x18
+DW_FORM_flag_present = 0x19
+DW_FORM_ref_sig8 = 0x20
+
+CONSTANT_FORMS = {DW_FORM_data1, DW_FORM_data2, DW_FORM_data4, DW_FORM_data8, DW_FORM_udata, DW_FORM_sdata}
+
+DW_LNS_copy = 1
+DW_LNS_advance_pc = 2
+DW_LNS_advance_line = 3
+DW_LNS_set_file = 4
+DW_LNS_const_add_pc = 8
+DW_LNS_fixed_advance_pc = 9
+
+DW_LNE_end_sequence = 1
+DW_LNE_set_address = 2
+DW_LNE_define_file = 3
+
+
+class DWARFError(Exception):
+    pass
+
+
+class ELFFile(object):
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            self._file.close()
+            raise
+        try:
+            self._read_sections()
+        except:
+            self.close()
+            raise
+
+    def _read_sections(self):
+        data = self.data
+        if data[:4] != '\x7fELF':
+            raise DWARFError("Not an ELF file")
+        elf_class, endianness = ord(data[4]), ord(data[5])
+        if elf_class not in (1, 2) or endianness not in (1, 2):
+            raise DWARFError("Unsupported ELF class or byte order")
+        self.endian = '<' if endianness == 1 else '>'
+        if elf_class == 1:
+            shoff, = struct.unpack_from(self.endian + 'I', data, 0x20)
+            shentsize, shnum, shstrndx = struct.unpack_from(self.endian + 'HHH', data, 0x2e)
+            header_format = self.endian + 'IIIIII'
+        else:
+            shoff, = struct.unpack_from(self.endian + 'Q', data, 0x28)
+            shentsize, shnum, shstrndx = struct.unpack_from(self.endian + 'HHH', data, 0x3a)
+            header_format = self.endian + 'IIQQQQ'
+        headers = []
+        for i in xrange(shnum):
+            name, kind, flags, addr, offset, size = struct.unpack_from(header_format, data, shoff + i * shentsize)
+            headers.append((name, kind, offset, size))
+        names_offset = headers[shstrndx][2]
+        self.sections = {}
+        for name, kind, offset, size in headers:
+            # SHT_NOBITS sections take up no space in the file.
+            if kind == 8:
+                continue
+            self.sections[read_string(data, names_offset + name)[0]] = (offset, size)
+
+    def close(self):
+        self.data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def read_string(data, pos):
+    end = data.find('\0', pos)
+    if end == -1:
+        raise DWARFError("Unterminated string")
+    return data[pos:end], end + 1
+
+
+def read_uleb128(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def read_sleb128(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            if byte & 0x40:
+                result -= 1 << shift
+            return result, pos
+
+
+def _read_unit_length(elf, pos):
+    """
+    :return: a tuple of the unit length, the size of section offsets in the unit, and the position after the length.
+    """
+    length, = struct.unpack_from(elf.endian + 'I', elf.data, pos)
+    if length == 0xffffffff:
+        length, = struct.unpack_from(elf.endian + 'Q', elf.data, pos + 4)
+        return length, 8, pos + 12
+    return length, 4, pos + 4
+
+
+def _read_offset(elf, pos, size):
+    return struct.unpack_from(elf.endian + ('I' if size == 4 else 'Q'), elf.data, pos)[0], pos + size
+
+
+def iter_line_programs(elf):
+    """
+    Runs the line number program of every unit in .debug_line.
+    :return: an iterator of (file names, rows) tuples, one per unit. Rows are (file index, line, address) tuples,
+    and only come from the opcodes that add a row to the line table other than DW_LNE_end_sequence.
+    """
+    if '.debug_line' not in elf.sections:
+        raise DWARFError("No .debug_line section")
+    data = elf.data
+    section_start, section_size = elf.sections['.debug_line']
+    section_end = section_start + section_size
+    pos = section_start
+    while pos < section_end:
+        length, offset_size, pos = _read_unit_length(elf, pos)
+        unit_end = pos + length
+        version, = struct.unpack_from(elf.endian + 'H', data, pos)
+        if not 2 <= version <= 4:
+            raise DWARFError("Unsupported line table version %d" % version)
+        header_length, pos = _read_offset(elf, pos + 2, offset_size)
+        program_start = pos + header_length
+        min_inst_length = ord(data[pos])
+        pos += 1
+        if version >= 4:
+            pos += 1  # maximum_operations_per_instruction, which is always 1 for us.
+        default_is_stmt, line_base, line_range, opcode_base = struct.unpack_from('BbBB', data, pos)
+        pos += 4
+        opcode_lengths = [ord(x) for x in data[pos:pos + opcode_base - 1]]
+        pos += opcode_base - 1
+        while data[pos] != '\0':
+            directory, pos = read_string(data, pos)
+        pos += 1
+        files = []
+        while data[pos] != '\0':
+            name, pos = read_string(data, pos)
+            directory, pos = read_uleb128(data, pos)
+            mtime, pos = read_uleb128(data, pos)
+            size, pos = read_uleb128(data, pos)
+            files.append(name)
+
+        rows = []
+        address = 0
+        file_index = 1
+        line = 1
+        pos = program_start
+        while pos < unit_end:
+            opcode = ord(data[pos])
+            pos += 1
+            if opcode >= opcode_base:
+                adjusted = opcode - opcode_base
+                address += (adjusted // line_range) * min_inst_length
+                line += line_base + adjusted % line_range
+                rows.append((file_index, line, address))
+            elif opcode == 0:
+                length, pos = read_uleb128(data, pos)
+                extended_end = pos + length
+                sub_opcode = ord(data[pos])
+                if sub_opcode == DW_LNE_end_sequence:
+                    address = 0
+                    file_index = 1
+                    line = 1
+                elif sub_opcode == DW_LNE_set_address:
+                    address_format = {2: 'H', 4: 'I', 8: 'Q'}[length - 1]
+                    address, = struct.unpack_from(elf.endian + address_format, data, pos + 1)
+                elif sub_opcode == DW_LNE_define_file:
+                    name, _ = read_string(data, pos + 1)
+                    files.append(name)
+                pos = extended_end
+            elif opcode == DW_LNS_copy:
+                rows.append((file_index, line, address))
+            elif opcode == DW_LNS_advance_pc:
+                operand, pos = read_uleb128(data, pos)
+                address += operand * min_inst_length
+            elif opcode == DW_LNS_advance_line:
+                operand, pos = read_sleb128(data, pos)
+                line += operand
+            elif opcode == DW_LNS_set_file:
+                file_index, pos = read_uleb128(data, pos)
+            elif opcode == DW_LNS_const_add_pc:
+                address += ((255 - opcode_base) // line_range) * min_inst_length
+            elif opcode == DW_LNS_fixed_advance_pc:
+                operand, = struct.unpack_from(elf.endian + 'H', data, pos)
+                pos += 2
+                address += operand
+            else:
+                # Everything else (including opcodes we've never heard of) just has some ULEB128 operands to skip.
+                for i in xrange(opcode_lengths[opcode - 1]):
+                    operand, pos = read_uleb128(data, pos)
+        yield files, rows
+        pos = unit_end
+
+
+def _read_abbreviations(elf, offset):
+    data = elf.data
+    pos = elf.sections['.debug_abbrev'][0] + offset
+    abbreviations = {}
+    while True:
+        code, pos = read_uleb128(data, pos)
+        if code == 0:
+            return abbreviations
+        tag, pos = read_uleb128(data, pos)
+        has_children = data[pos] != '\0'
+        pos += 1
+        attributes = []
+        while True:
+            attribute, pos = read_uleb128(data, pos)
+            form, pos = read_uleb128(data, pos)
+            if attribute == 0 and form == 0:
+                break
+            attributes.append((attribute, form))
+        abbreviations[code] = (tag, has_children, attributes)
+
+
+def _read_form(elf, form, pos, address_size, offset_size, version):
+    """
+    :return: a tuple of the attribute's value (or None if it isn't something we'd want) and the position after it.
+    """
+    data = elf.data
+    endian = elf.endian
+    if form == DW_FORM_addr:
+        return struct.unpack_from(endian + {2: 'H', 4: 'I', 8: 'Q'}[address_size], data, pos)[0], pos + address_size
+    elif form == DW_FORM_data1 or form == DW_FORM_ref1 or form == DW_FORM_flag:
+        return ord(data[pos]), pos + 1
+    elif form == DW_FORM_data2 or form == DW_FORM_ref2:
+        return struct.unpack_from(endian + 'H', data, pos)[0], pos + 2
+    elif form == DW_FORM_data4 or form == DW_FORM_ref4:
+        return struct.unpack_from(endian + 'I', data, pos)[0], pos + 4
+    elif form == DW_FORM_data8 or form == DW_FORM_ref8 or form == DW_FORM_ref_sig8:
+        return struct.unpack_from(endian + 'Q', data, pos)[0], pos + 8
+    elif form == DW_FORM_udata or form == DW_FORM_ref_udata:
+        return read_uleb128(data, pos)
+    elif form == DW_FORM_sdata:
+        return read_sleb128(data, pos)
+    elif form == DW_FORM_string:
+        return read_string(data, pos)
+    elif form == DW_FORM_strp:
+        offset, pos = _read_offset(elf, pos, offset_size)
+        if '.debug_str' not in elf.sections:
+            raise DWARFError("No .debug_str section")
+        return read_string(data, elf.sections['.debug_str'][0] + offset)[0], pos
+    elif form == DW_FORM_sec_offset:
+        return _read_offset(elf, pos, offset_size)
+    elif form == DW_FORM_ref_addr:
+        # This was address sized in DWARF 2, and offset sized afterwards.
+        size = address_size if version == 2 else offset_size
+        return None, pos + size
+    elif form == DW_FORM_flag_present:
+        return True, pos
+    elif form == DW_FORM_block1:
+        return None, pos + 1 + ord(data[pos])
+    elif form == DW_FORM_block2:
+        return None, pos + 2 + struct.unpack_from(endian + 'H', data, pos)[0]
+    elif form == DW_FORM_block4:
+        return None, pos + 4 + struct.unpack_from(endian + 'I', data, pos)[0]
+    elif form == DW_FORM_block or form == DW_FORM_exprloc:
+        length, pos = read_uleb128(data, pos)
+        return None, pos + length
+    elif form == DW_FORM_indirect:
+        form, pos = read_uleb128(data, pos)
+        return _read_form(elf, form, pos, address_size, offset_size, version)
+    raise DWARFError("Unsupported attribute form 0x%x" % form)
+
+
+def iter_subprograms(elf):
+    """
+    Finds every function defined at the top level of a compilation unit in .debug_info.
+    :return: an iterator of (name, low_pc, high_pc, decl_line) tuples. decl_line may be None.
+    Functions without a name or address range of their own are skipped.
+    """
+    if '.debug_info' not in elf.sections or '.debug_abbrev' not in elf.sections:
+        raise DWARFError("No .debug_info section")
+    data = elf.data
+    section_start, section_size = elf.sections['.debug_info']
+    section_end = section_start + section_size
+    pos = section_start
+    while pos < section_end:
+        length, offset_size, pos = _read_unit_length(elf, pos)
+        unit_end = pos + length
+        version, = struct.unpack_from(elf.endian + 'H', data, pos)
+        if not 2 <= version <= 4:
+            raise DWARFError("Unsupported debug info version %d" % version)
+        abbrev_offset, pos = _read_offset(elf, pos + 2, offset_size)
+        address_size = ord(data[pos])
+        pos += 1
+        abbreviations = _read_abbreviations(elf, abbrev_offset)
+
+        depth = 0
+        while pos < unit_end:
+            code, pos = read_uleb128(data, pos)
+            if code == 0:
+                depth -= 1
+                continue
+            try:
+                tag, has_children, attributes = abbreviations[code]
+            except KeyError:
+                raise DWARFError("Unknown abbreviation %d" % code)
+            wanted = depth == 1 and tag == DW_TAG_subprogram
+            values = {}
+            for attribute, form in attributes:
+                value, pos = _read_form(elf, form, pos, address_size, offset_size, version)
+                if wanted:
+                    values[attribute] = (value, form)
+            if wanted and DW_AT_name in values and DW_AT_low_pc in values and DW_AT_high_pc in values:
+                low_pc = values[DW_AT_low_pc][0]
+                high_pc, high_pc_form = values[DW_AT_high_pc]
+                # Since DWARF 4, high_pc can be given as an offset from low_pc.
+                if high_pc_form in CONSTANT_FORMS:
+                    high_pc += low_pc
+                decl_line = values[DW_AT_decl_line][0] if DW_AT_decl_line in values else None
+                yield values[DW_AT_name][0], low_pc, high_pc, decl_line
+            if has_children:
+                depth += 1
+        pos = unit_end
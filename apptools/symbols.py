@@ -0,0 +1,202 @@
+"""
+A compact format for the debug info produced by addr2lines.create_coalesced_group, and lookups against it.
+
+The file starts with MAGIC and a version byte, followed by a zlib-compressed body of unsigned LEB128 integers
+laid out in columns:
+
+    file count, then for each file its length in bytes and its UTF-8 name
+    line count, then every line's address as a delta from the previous one, then every line's file id, then every
+    line's number as a zigzag-encoded delta from the previous one
+    function count, then every function's start as a delta from the previous one, then its length, then its
+    declaration line plus one (zero if unknown), then the length in bytes of its name, followed by all the names
+
+Lines and functions are sorted by address, so every delta but the line numbers is small and non-negative.
+Version 1 had every function's length zigzag-encoded; it can still be read.
+"""
+import bisect
+import zlib
+from array import array
+
+MAGIC = 'PBDI'
+VERSION = 2
+
+
+class SymbolFormatError(Exception):
+    pass
+
+
+def _write_uleb128(out, value):
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+
+def _zigzag(value):
+    return (value << 1) if value >= 0 else ((-value << 1) - 1)
+
+
+def _unzigzag(value):
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1)
+
+
+class _Reader(object):
+    def __init__(self, data):
+        self.data = array('B', data)
+        self.pos = 0
+
+    def uleb128(self):
+        data = self.data
+        result = 0
+        shift = 0
+        while True:
+            byte = data[self.pos]
+            self.pos += 1
+            result |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                return result
+            shift += 7
+
+    def column(self, count):
+        return [self.uleb128() for i in xrange(count)]
+
+    def bytes(self, length):
+        start = self.pos
+        self.pos += length
+        if self.pos > len(self.data):
+            raise IndexError("Read past the end of the data")
+        return self.data[start:self.pos].tostring()
+
+
+def _accumulate(deltas):
+    total = 0
+    out = array('L')
+    for delta in deltas:
+        total += delta
+        out.append(total)
+    return out
+
+
+def pack_debug_info(info):
+    """
+    :param info: debug info as returned by addr2lines.create_coalesced_group.
+    :return: the same information as a string in the compact format.
+    """
+    out = array('B')
+    files = [f.encode('utf-8') if isinstance(f, unicode) else f for f in info['files']]
+    _write_uleb128(out, len(files))
+    for name in files:
+        _write_uleb128(out, len(name))
+        out.fromstring(name)
+
+    lines = sorted(info['lines'], key=lambda x: x[0])
+    _write_uleb128(out, len(lines))
+    previous = 0
+    for address, file_id, line in lines:
+        _write_uleb128(out, address - previous)
+        previous = address
+    for address, file_id, line in lines:
+        _write_uleb128(out, file_id)
+    previous = 0
+    for address, file_id, line in lines:
+        _write_uleb128(out, _zigzag(line - previous))
+        previous = line
+
+    functions = sorted(info['functions'], key=lambda x: x[0])
+    names = [f[2].encode('utf-8') if isinstance(f[2], unicode) else f[2] for f in functions]
+    _write_uleb128(out, len(functions))
+    previous = 0
+    for start, end, name, line in functions:
+        _write_uleb128(out, start - previous)
+        previous = start
+    for start, end, name, line in functions:
+        if end < start:
+            raise ValueError("Function %s ends before it starts" % name)
+        _write_uleb128(out, end - start)
+    for start, end, name, line in functions:
+        _write_uleb128(out, 0 if line is None else line + 1)
+    for name in names:
+        _write_uleb128(out, len(name))
+    for name in names:
+        out.fromstring(name)
+
+    return MAGIC + chr(VERSION) + zlib.compress(out.tostring(), 9)
+
+
+class SymbolTable(object):
+    """
+    Debug info for one ELF, loaded for looking up addresses. Can be created from either the compact format or the
+    older JSON-style dict.
+    """
+    def __init__(self, files, line_addresses, line_files, line_numbers, function_starts, function_ends,
+                 function_names, function_lines):
+        self.files = files
+        self.line_addresses = line_addresses
+        self.line_files = line_files
+        self.line_numbers = line_numbers
+        self.function_starts = function_starts
+        self.function_ends = function_ends
+        self.function_names = function_names
+        self.function_lines = function_lines
+
+    @classmethod
+    def from_packed(cls, data):
+        if len(data) <= len(MAGIC) or data[:len(MAGIC)] != MAGIC:
+            raise SymbolFormatError("Not compact debug info")
+        version = ord(data[len(MAGIC)])
+        if version not in (1, VERSION):
+            raise SymbolFormatError("Unsupported compact debug info version %d" % version)
+        try:
+            reader = _Reader(zlib.decompress(data[len(MAGIC) + 1:]))
+            files = [reader.bytes(reader.uleb128()).decode('utf-8') for i in xrange(reader.uleb128())]
+
+            line_count = reader.uleb128()
+            line_addresses = _accumulate(reader.column(line_count))
+            line_files = array('L', reader.column(line_count))
+            line_numbers = _accumulate(_unzigzag(x) for x in reader.column(line_count))
+
+            function_count = reader.uleb128()
+            function_starts = _accumulate(reader.column(function_count))
+            function_lengths = reader.column(function_count)
+            if version == 1:
+                function_lengths = [_unzigzag(x) for x in function_lengths]
+            function_ends = [start + length for start, length in zip(function_starts, function_lengths)]
+            function_lines = [(x - 1 if x else None) for x in reader.column(function_count)]
+            function_names = [reader.bytes(length).decode('utf-8') for length in reader.column(function_count)]
+        except (IndexError, OverflowError, UnicodeDecodeError, zlib.error) as e:
+            raise SymbolFormatError("Corrupt compact debug info: %s" % e)
+        return cls(files, line_addresses, line_files, line_numbers, function_starts, function_ends, function_names,
+                   function_lines)
+
+    @classmethod
+    def from_dict(cls, info):
+        lines = sorted(info['lines'], key=lambda x: x[0])
+        functions = sorted(info['functions'], key=lambda x: x[0])
+        return cls(info['files'], [x[0] for x in lines], [x[1] for x in lines], [x[2] for x in lines],
+                   [x[0] for x in functions], [x[1] for x in functions], [x[2] for x in functions],
+                   [x[3] for x in functions])
+
+    def lookup(self, address):
+        """
+        :return: a dict of the file, line, fn_name and fn_line for address, or None if it isn't in any known line
+        or function.
+        """
+        index = bisect.bisect_right(self.line_addresses, address) - 1
+        if index < 0:
+            return None
+        file_name = self.files[self.line_files[index]]
+        line = self.line_numbers[index]
+
+        index = bisect.bisect_right(self.function_starts, address) - 1
+        if index < 0 or address > self.function_ends[index]:
+            return None
+        return {
+            'file': file_name,
+            'line': line,
+            'fn_name': self.function_names[index],
+            'fn_line': self.function_lines[index],
+        }
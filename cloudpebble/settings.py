@@ -1,9 +1,11 @@
 # encoding: utf-8
 # Django settings for cloudpebble project.
 
+import multiprocessing
 import os
 import socket
 import dj_database_url
+from kombu import Exchange, Queue
 _environ = os.environ
 
 DEBUG = _environ.get('DEBUG', '') != ''
@@ -280,6 +282,27 @@ FILE_STORAGE = os.getcwd() + '/user_data/'
 
 CHROOT_ROOT = None
 
+# Scratch space for builds, imports and exports. By default it goes on tmpfs (SCRATCH_TMPFS) if that has at least
+# SCRATCH_TMPFS_MIN_FREE bytes free, or in the chroot if there is one. Each build may use up to SCRATCH_QUOTA bytes,
+# in its scratch space and in the directory waf builds it in; the latter is checked every
+# SCRATCH_QUOTA_CHECK_INTERVAL seconds while waf is running.
+SCRATCH_ROOT = _environ.get('SCRATCH_ROOT', None)
+SCRATCH_TMPFS = _environ.get('SCRATCH_TMPFS', '/dev/shm')
+SCRATCH_TMPFS_MIN_FREE = int(_environ.get('SCRATCH_TMPFS_MIN_FREE', 256 * 1024 * 1024))
+SCRATCH_QUOTA = int(_environ.get('SCRATCH_QUOTA', 50 * 1024 * 1024))
+SCRATCH_QUOTA_CHECK_INTERVAL = int(_environ.get('SCRATCH_QUOTA_CHECK_INTERVAL', 2))
+SCRATCH_REAP_INTERVAL = int(_environ.get('SCRATCH_REAP_INTERVAL', 300))
+
+# How many project files to fetch from S3 at once when assembling a build.
+S3_FETCH_CONCURRENCY = int(_environ.get('S3_FETCH_CONCURRENCY', 8))
+
+# When to extract debug info from successful builds: 'inline' (before the build is marked finished), 'deferred'
+# (after it is) or 'skip'. Builds can ask for something else. Extraction runs DEBUG_INFO_CONCURRENCY ELFs at a time
+# and gives up on whatever is left after DEBUG_INFO_TIME_BUDGET seconds.
+DEBUG_INFO_MODE = _environ.get('DEBUG_INFO_MODE', 'inline')
+DEBUG_INFO_TIME_BUDGET = int(_environ.get('DEBUG_INFO_TIME_BUDGET', 30))
+DEBUG_INFO_CONCURRENCY = int(_environ.get('DEBUG_INFO_CONCURRENCY', 3))
+
 DEFAULT_TEMPLATE = None
 
 EXPORT_DIRECTORY = os.getcwd() + '/user_data/export/'
@@ -296,6 +319,145 @@ SDK3_PEBBLE_WAF = _environ.get('SDK3_PEBBLE_WAF', '/sdk3/pebble/waf')
 
 ARM_CS_TOOLS = _environ.get('ARM_CS_TOOLS', '/arm-cs-tools/bin/')
 
+# Builds whose inputs exactly match an earlier successful build reuse its output instead of running waf.
+# Change BUILD_CACHE_SALT whenever the installed SDKs change to invalidate everything built with the old ones.
+BUILD_CACHE_ENABLED = _environ.get('BUILD_CACHE_ENABLED', 'yes') != 'no'
+BUILD_CACHE_SALT = _environ.get('BUILD_CACHE_SALT', '')
+
+# Point OBJECT_CACHE_DIR at a directory shared by every build worker to cache compiled C objects using ccache.
+OBJECT_CACHE_DIR = _environ.get('OBJECT_CACHE_DIR', None)
+OBJECT_CACHE_MAX_SIZE = _environ.get('OBJECT_CACHE_MAX_SIZE', '5G')
+CCACHE = _environ.get('CCACHE', 'ccache')
+
+# Point RESOURCE_CACHE_DIR at a directory shared by every build worker to cache the SDK's processed images and fonts,
+# so that builds only have to assemble the resource pack. The least recently used are deleted to keep it within
+# RESOURCE_CACHE_DISK_BUDGET bytes.
+RESOURCE_CACHE_DIR = _environ.get('RESOURCE_CACHE_DIR', None)
+RESOURCE_CACHE_DISK_BUDGET = int(_environ.get('RESOURCE_CACHE_DISK_BUDGET', 2 * 1024 * 1024 * 1024))
+
+# Set BUILD_WORKSPACE_ROOT to keep up to BUILD_WORKSPACE_POOL_SIZE already-configured build directories per kind of
+# project on each worker, so that most builds can skip 'waf configure'.
+BUILD_WORKSPACE_ROOT = _environ.get('BUILD_WORKSPACE_ROOT', None)
+BUILD_WORKSPACE_POOL_SIZE = int(_environ.get('BUILD_WORKSPACE_POOL_SIZE', 4))
+
+# Build each platform of multi-platform SDK 3 apps in its own waf process, in parallel, and bundle them afterwards.
+PARALLEL_PLATFORM_BUILDS = _environ.get('PARALLEL_PLATFORM_BUILDS', 'no') == 'yes'
+
+# How many lines of a running build's output are kept in redis for the IDE to follow, and for how long (seconds).
+BUILD_LOG_STREAM_LINES = int(_environ.get('BUILD_LOG_STREAM_LINES', 2000))
+BUILD_LOG_STREAM_EXPIRY = int(_environ.get('BUILD_LOG_STREAM_EXPIRY', 3600))
+# Lines are sent to redis in batches of up to BUILD_LOG_STREAM_BATCH_LINES, at most BUILD_LOG_STREAM_BATCH_MS late.
+BUILD_LOG_STREAM_BATCH_LINES = int(_environ.get('BUILD_LOG_STREAM_BATCH_LINES', 100))
+BUILD_LOG_STREAM_BATCH_MS = int(_environ.get('BUILD_LOG_STREAM_BATCH_MS', 250))
+
+# Requests to build a project that already has a build waiting in the queue join that build instead.
+# BUILD_QUEUED_TTL bounds how long a queued build can be joined if its task never starts.
+BUILD_QUEUED_TTL = int(_environ.get('BUILD_QUEUED_TTL', 600))
+# Kill a project's running build when a newer one is requested.
+CANCEL_SUPERSEDED_BUILDS = _environ.get('CANCEL_SUPERSEDED_BUILDS', 'no') == 'yes'
+
+# Hold builds back until they can run without going over MAX_BUILDS_IN_FLIGHT in all, MAX_BUILDS_PER_USER for their
+# owner and MAX_BUILDS_PER_PROJECT for their project, taking one from each user in turn, so that nobody can take over
+# every worker. Requests to build are turned away while their owner has MAX_PENDING_BUILDS_PER_USER builds waiting.
+FAIR_BUILD_SCHEDULING = _environ.get('FAIR_BUILD_SCHEDULING', 'no') == 'yes'
+MAX_BUILDS_IN_FLIGHT = int(_environ.get('MAX_BUILDS_IN_FLIGHT', 8))
+MAX_BUILDS_PER_USER = int(_environ.get('MAX_BUILDS_PER_USER', 2))
+MAX_BUILDS_PER_PROJECT = int(_environ.get('MAX_BUILDS_PER_PROJECT', 1))
+MAX_PENDING_BUILDS_PER_USER = int(_environ.get('MAX_PENDING_BUILDS_PER_USER', 5))
+# How long, in seconds, to guess builds will take when there haven't been enough lately to go by. Queue time estimates
+# also assume MAX_BUILDS_IN_FLIGHT builds can run at once.
+DEFAULT_BUILD_DURATION = float(_environ.get('DEFAULT_BUILD_DURATION', 15))
+
+# Build projects SPECULATIVE_BUILD_DELAY seconds after they were last saved, on the SPECULATIVE_BUILD_QUEUE celery
+# queue, and hand the result over if the user asks for a build of the project as it was then. With
+# FAIR_BUILD_SCHEDULING, speculative builds are skipped unless nothing is waiting and there's room under every limit.
+# Unclaimed speculative builds stop being handed over after SPECULATIVE_BUILD_TTL seconds; each project's
+# revision, which tells us whether it has changed since, is kept for PROJECT_REVISION_TTL seconds after it changes.
+SPECULATIVE_BUILDS = _environ.get('SPECULATIVE_BUILDS', 'no') == 'yes'
+SPECULATIVE_BUILD_DELAY = int(_environ.get('SPECULATIVE_BUILD_DELAY', 3))
+SPECULATIVE_BUILD_QUEUE = _environ.get('SPECULATIVE_BUILD_QUEUE', 'speculative')
+SPECULATIVE_BUILD_TTL = int(_environ.get('SPECULATIVE_BUILD_TTL', 900))
+PROJECT_REVISION_TTL = int(_environ.get('PROJECT_REVISION_TTL', 7 * 24 * 3600))
+
+# Tasks go to a queue for the kind of work they do, so that a burst of one kind doesn't hold up the others: builds are
+# CPU-bound, while imports, git, gists and archives mostly wait on the network. Telemetry has a queue of its own so
+# that it can be throttled without slowing anything else down. Anything not listed here goes to the 'celery' queue.
+BUILD_QUEUE = _environ.get('BUILD_QUEUE', 'builds')
+IO_QUEUE = _environ.get('IO_QUEUE', 'io')
+TELEMETRY_QUEUE = _environ.get('TELEMETRY_QUEUE', 'telemetry')
+_task_queues = {
+    'ide.tasks.build.run_compile': BUILD_QUEUE,
+    'ide.tasks.build.run_speculative_compile': SPECULATIVE_BUILD_QUEUE,
+    'ide.tasks.archive.create_archive': IO_QUEUE,
+    'ide.tasks.archive.export_user_projects': IO_QUEUE,
+    'ide.tasks.archive.do_import_archive': IO_QUEUE,
+    'ide.tasks.git.do_import_github': IO_QUEUE,
+    'ide.tasks.git.do_github_push': IO_QUEUE,
+    'ide.tasks.git.do_github_pull': IO_QUEUE,
+    'ide.tasks.git.hooked_commit': IO_QUEUE,
+    'ide.tasks.gist.import_gist': IO_QUEUE,
+    'ide.tasks.td_task.td_add_events': TELEMETRY_QUEUE,
+}
+CELERY_QUEUES = tuple(Queue(name, Exchange(name), routing_key=name) for name in
+                      sorted(set(_task_queues.values()) | {'celery'}))
+CELERY_ROUTES = {task_name: {'queue': queue} for task_name, queue in _task_queues.iteritems()}
+
+# How many tasks from each queue each worker may start, in celery's format (e.g. '10/s' or '100/m'). Blank for no limit.
+_queue_rate_limits = {
+    BUILD_QUEUE: _environ.get('BUILD_RATE_LIMIT', ''),
+    SPECULATIVE_BUILD_QUEUE: _environ.get('SPECULATIVE_BUILD_RATE_LIMIT', ''),
+    IO_QUEUE: _environ.get('IO_RATE_LIMIT', ''),
+    TELEMETRY_QUEUE: _environ.get('TELEMETRY_RATE_LIMIT', '50/s'),
+}
+CELERY_ANNOTATIONS = {task_name: {'rate_limit': _queue_rate_limits[queue]}
+                      for task_name, queue in _task_queues.iteritems() if _queue_rate_limits[queue]}
+
+# The kinds of celery worker to run, started with 'python manage.py celerypool <name>'. Builds get a process per core,
+# and everything else a gevent pool with plenty of greenlets, since those tasks spend most of their time waiting.
+# A plain 'celery worker' still takes tasks from every queue.
+CELERY_WORKER_POOLS = {
+    'builds': {
+        'queues': [BUILD_QUEUE],
+        'pool': 'prefork',
+        'concurrency': int(_environ.get('BUILD_WORKER_CONCURRENCY', multiprocessing.cpu_count())),
+    },
+    # Speculative builds get a pool of their own, kept small, so that they never hold up builds someone asked for.
+    'speculative': {
+        'queues': [SPECULATIVE_BUILD_QUEUE],
+        'pool': 'prefork',
+        'concurrency': int(_environ.get('SPECULATIVE_WORKER_CONCURRENCY', 1)),
+    },
+    'io': {
+        'queues': [IO_QUEUE, TELEMETRY_QUEUE, 'celery'],
+        'pool': _environ.get('IO_WORKER_POOL', 'gevent'),
+        'concurrency': int(_environ.get('IO_WORKER_CONCURRENCY', 100)),
+    },
+}
+
+# Keep a workspace per project on the worker that last built it, including waf's outputs, and send the project's
+# builds back to that worker. Needs BUILD_WORKSPACE_ROOT. Least recently used workspaces are deleted to keep them
+# within PROJECT_WORKSPACE_DISK_BUDGET bytes on each worker.
+PROJECT_WORKSPACES = _environ.get('PROJECT_WORKSPACES', 'no') == 'yes'
+# Builds are sent back to the worker with the project's workspace through that worker's own queue.
+CELERY_WORKER_DIRECT = PROJECT_WORKSPACES
+PROJECT_WORKSPACE_DISK_BUDGET = int(_environ.get('PROJECT_WORKSPACE_DISK_BUDGET', 2 * 1024 * 1024 * 1024))
+PROJECT_WORKSPACE_AFFINITY_TTL = int(_environ.get('PROJECT_WORKSPACE_AFFINITY_TTL', 3600))
+
+# Point PEBBLEJS_RUNTIME_CACHE_DIR at a directory shared by every build worker to keep the objects compiled from the
+# Pebble.js C runtime, for each SDK and set of platforms, so that it's only compiled once for every project and
+# builds only have to link it and bundle the JS and resources. The least recently used are deleted to keep it within
+# PEBBLEJS_RUNTIME_CACHE_DISK_BUDGET bytes.
+PEBBLEJS_RUNTIME_CACHE_DIR = _environ.get('PEBBLEJS_RUNTIME_CACHE_DIR', None)
+PEBBLEJS_RUNTIME_CACHE_DISK_BUDGET = int(_environ.get('PEBBLEJS_RUNTIME_CACHE_DISK_BUDGET', 512 * 1024 * 1024))
+
+# Build Simply.js apps by patching the user's script and metadata into a PBW built once from the runtime, without
+# running waf at all.
+SIMPLYJS_TEMPLATE_BUILDS = _environ.get('SIMPLYJS_TEMPLATE_BUILDS', 'yes') != 'no'
+
+# Build native projects whose C code and resources haven't changed since an earlier build by putting their new
+# JavaScript and appinfo.json into that build's PBW, rather than running waf.
+REPACKAGE_BUILDS = _environ.get('REPACKAGE_BUILDS', 'yes') != 'no'
+
 TD_URL = _environ.get('TD_URL', None)
 TD_ENABLED = _environ.get('TD_ENABLED', False)
 
@@ -9,7 +9,12 @@ if [ ! -z "$RUN_WEB" ]; then
 	python manage.py runserver 0.0.0.0:$PORT
 elif [ ! -z "$RUN_CELERY" ]; then
 	sleep 2
-	C_FORCE_ROOT=true python manage.py celery worker --autoreload --loglevel=info
+	if [ ! -z "$CELERY_POOL" ]; then
+		# Only take the tasks meant for one kind of worker; see CELERY_WORKER_POOLS in settings.py.
+		C_FORCE_ROOT=true python manage.py celerypool $CELERY_POOL --loglevel=info
+	else
+		C_FORCE_ROOT=true python manage.py celery worker --autoreload --loglevel=info
+	fi
 else
 	echo "Doing nothing!"
 	exit 1
@@ -8,15 +8,18 @@ from django.contrib.auth.decorators import login_required
 from django.db import transaction, IntegrityError
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils.timezone import now
 from django.views.decorators.http import require_safe, require_POST
 from ide.api import json_response, json_failure
 from ide.models.build import BuildResult
 from ide.models.project import Project, TemplateProject
 from ide.models.files import SourceFile, ResourceFile
 from ide.tasks.archive import create_archive, do_import_archive
-from ide.tasks.build import run_compile
 from ide.tasks.gist import import_gist
 from ide.tasks.git import do_import_github
+from ide.utils.log_stream import BuildLogStream
+from ide.utils.build_scheduler import schedule_build, get_queue_position, get_claim_time, BuildRejected
+from ide.utils.build_estimates import estimate_build_times
 from utils.td_helper import send_td_event
 
 __author__ = 'katharine'
@@ -78,9 +81,18 @@ def project_info(request, project_id):
 @login_required
 def compile_project(request, project_id):
     project = get_object_or_404(Project, pk=project_id, owner=request.user)
-    build = BuildResult.objects.create(project=project)
-    task = run_compile.delay(build.id)
-    return json_response({"build_id": build.id, "task_id": task.task_id})
+    platforms = None
+    if project.sdk_version == '3' and request.POST.get('platforms', None):
+        # Building only some platforms is quicker when trying the app out on an emulator. If that isn't fewer of
+        # the platforms the project is built for, it gets an ordinary build instead.
+        platforms = sorted(set(request.POST['platforms'].split(',')))
+        if not set(platforms) < set(project.get_build_platforms()):
+            platforms = None
+    try:
+        build, task_id = schedule_build(project, debug_info=request.POST.get('debug_info', None), platforms=platforms)
+    except BuildRejected as e:
+        return json_failure(str(e))
+    return json_response({"build_id": build.id, "task_id": task_id, "queue_position": get_queue_position(build)})
 
 
 @require_safe
@@ -88,7 +100,7 @@ def compile_project(request, project_id):
 def last_build(request, project_id):
     project = get_object_or_404(Project, pk=project_id, owner=request.user)
     try:
-        build = project.builds.order_by('-started')[0]
+        build = project.builds.filter(speculative=False).order_by('-started')[0]
     except (IndexError, BuildResult.DoesNotExist):
         return json_response({"build": None})
     else:
@@ -102,6 +114,8 @@ def last_build(request, project_id):
             'log': build.build_log_url,
             'build_dir': build.get_url(),
             'sizes': build.get_sizes(),
+            'partial': build.partial,
+            'platforms': build.platform_list,
         }
         return json_response({"build": b})
 
@@ -111,7 +125,7 @@ def last_build(request, project_id):
 def build_history(request, project_id):
     project = get_object_or_404(Project, pk=project_id, owner=request.user)
     try:
-        builds = project.builds.order_by('-started')[:10]
+        builds = project.builds.filter(speculative=False).order_by('-started')[:10]
     except (IndexError, BuildResult.DoesNotExist):
         return json_response({"build": None})
     else:
@@ -126,7 +140,10 @@ def build_history(request, project_id):
                 'pbw': build.pbw_url,
                 'log': build.build_log_url,
                 'build_dir': build.get_url(),
-                'sizes': build.get_sizes()
+                'sizes': build.get_sizes(),
+                'partial': build.partial,
+                'platforms': build.platform_list,
+                'metrics': build.get_metrics(),
             })
         return json_response({"builds": out})
 
@@ -150,6 +167,77 @@ def build_log(request, project_id, build_id):
     return json_response({"log": log})
 
 
+@require_safe
+@login_required
+def build_log_tail(request, project_id, build_id):
+    project = get_object_or_404(Project, pk=project_id, owner=request.user)
+    build = get_object_or_404(BuildResult, project=project, pk=build_id)
+    try:
+        cursor = int(request.GET.get('cursor', 0))
+    except ValueError:
+        return json_failure("Invalid cursor")
+    lines, cursor, finished, truncated = BuildLogStream(build.id).read(cursor)
+    return json_response({
+        "lines": lines,
+        "cursor": cursor,
+        "finished": finished or build.state != BuildResult.STATE_WAITING,
+        "truncated": truncated,
+    })
+
+
+@require_safe
+@login_required
+def build_estimate(request, project_id, build_id):
+    """
+    Estimates when a build will start and finish, if it hasn't finished already. Times are also given in seconds
+    from now, so that the IDE needn't trust its own clock.
+    """
+    project = get_object_or_404(Project, pk=project_id, owner=request.user)
+    build = get_object_or_404(BuildResult, project=project, pk=build_id)
+    if build.state != BuildResult.STATE_WAITING:
+        return json_response({
+            'state': build.state,
+            'finished': str(build.finished) if build.finished else None,
+        })
+    estimate = estimate_build_times(build)
+    current_time = now()
+    return json_response({
+        'state': build.state,
+        'started': estimate['started'],
+        'builds_ahead': estimate['builds_ahead'],
+        'queue_position': estimate['queue_position'],
+        'estimated_duration': estimate['estimated_duration'],
+        'estimated_start': str(estimate['estimated_start']),
+        'estimated_finish': str(estimate['estimated_finish']),
+        'seconds_until_start': max(0, (estimate['estimated_start'] - current_time).total_seconds()),
+        'seconds_until_finish': max(0, (estimate['estimated_finish'] - current_time).total_seconds()),
+    })
+
+
+@require_safe
+@login_required
+def build_symbolicate(request, project_id, build_id):
+    project = get_object_or_404(Project, pk=project_id, owner=request.user)
+    build = get_object_or_404(BuildResult, project=project, pk=build_id)
+    kind = {'app': BuildResult.DEBUG_APP, 'worker': BuildResult.DEBUG_WORKER}.get(request.GET.get('process', 'app'))
+    if kind is None:
+        return json_failure("Invalid process")
+    try:
+        addresses = [int(x) for x in request.GET.get('addresses', '').split(',') if x]
+    except ValueError:
+        return json_failure("Invalid addresses")
+    try:
+        symbols = build.get_symbol_table(request.GET.get('platform', 'aplite'), kind)
+    except Exception as e:
+        return json_failure(str(e))
+    if symbols is None:
+        # Builds with deferred debug info hold on to their claim until it's saved, after they've finished.
+        if build.state == BuildResult.STATE_SUCCEEDED and get_claim_time(build) is not None:
+            return json_response({"pending": True})
+        return json_failure("No debug information available")
+    return json_response({"symbols": [symbols.lookup(address) for address in addresses]})
+
+
 @require_POST
 @login_required
 def create_project(request):
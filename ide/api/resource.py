@@ -8,6 +8,7 @@ from django.views.decorators.http import require_POST, require_safe
 from ide.api import json_failure, json_response
 from ide.models.project import Project
 from ide.models.files import ResourceFile, ResourceIdentifier, ResourceVariant
+from ide.utils.build_scheduler import schedule_speculative_build
 from utils.td_helper import send_td_event
 import utils.s3 as s3
 
@@ -212,6 +213,12 @@ def update_resource(request, project_id, resource_id):
             }
         }, request=request, project=project)
 
+        if settings.SPECULATIVE_BUILDS:
+            try:
+                schedule_speculative_build(project)
+            except Exception as e:
+                print "Couldn't schedule a speculative build: %s" % e
+
         return json_response({"file": {
             "id": resource.id,
             "kind": resource.kind,
@@ -1,6 +1,7 @@
 import datetime
 import time
 import json
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.db import IntegrityError
 from django.shortcuts import get_object_or_404
@@ -10,6 +11,7 @@ from django.utils.translation import ugettext as _
 from ide.api import json_failure, json_response
 from ide.models.project import Project
 from ide.models.files import SourceFile
+from ide.utils.build_scheduler import schedule_speculative_build
 from utils.td_helper import send_td_event
 
 __author__ = 'katharine'
@@ -148,6 +150,12 @@ def save_source_file(request, project_id, file_id):
             }
         }, request=request, project=project)
 
+        if settings.SPECULATIVE_BUILDS:
+            try:
+                schedule_speculative_build(project)
+            except Exception as e:
+                print "Couldn't schedule a speculative build: %s" % e
+
         return json_response({"modified": time.mktime(source_file.last_modified.utctimetuple())})
 
 
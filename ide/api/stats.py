@@ -0,0 +1,52 @@
+import datetime
+from django.contrib.auth.decorators import login_required
+from django.http import HttpResponseForbidden
+from django.utils.timezone import now
+from django.views.decorators.http import require_safe
+from ide.api import json_response, json_failure
+from ide.models.build import BuildStats
+from ide.utils.build_stats import summarise_build_stats
+from ide.utils.build_estimates import count_waiting_builds
+
+
+@require_safe
+@login_required
+def build_stats(request):
+    """
+    Summarises the builds of the last 'hours' hours (24 by default), optionally filtered by sdk_version, project_type
+    and platform, and grouped by any of hour, sdk_version, project_type and platform (given as a comma-separated
+    group_by). Without a platform, builds are counted once each rather than once per platform.
+    Also says how many builds are waiting or running right now.
+    """
+    if not request.user.is_staff:
+        return HttpResponseForbidden()
+    try:
+        hours = int(request.GET.get('hours', 24))
+    except ValueError:
+        return json_failure("Invalid hours")
+    group_by = [x for x in request.GET.get('group_by', '').split(',') if x]
+    for field in group_by:
+        if field not in ('hour', 'sdk_version', 'project_type', 'platform'):
+            return json_failure("Can't group by %s" % field)
+
+    since = (now() - datetime.timedelta(hours=hours)).replace(minute=0, second=0, microsecond=0)
+    rollups = BuildStats.objects.filter(hour__gte=since)
+    for field in ('sdk_version', 'project_type'):
+        if field in request.GET:
+            rollups = rollups.filter(**{field: request.GET[field]})
+    if 'platform' not in group_by:
+        rollups = rollups.filter(platform=request.GET.get('platform', ''))
+    else:
+        rollups = rollups.exclude(platform='')
+
+    groups = {}
+    for rollup in rollups:
+        groups.setdefault(tuple(getattr(rollup, field) for field in group_by), []).append(rollup)
+
+    stats = []
+    for key in sorted(groups.keys()):
+        summary = summarise_build_stats(groups[key])
+        for field, value in zip(group_by, key):
+            summary[field] = value.isoformat() if field == 'hour' else value
+        stats.append(summary)
+    return json_response({'since': since.isoformat(), 'stats': stats, 'waiting_builds': count_waiting_builds()})
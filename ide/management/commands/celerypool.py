@@ -0,0 +1,34 @@
+import os
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    args = '<pool> [celery worker options]'
+    help = "Runs a celery worker for one of the pools in settings.CELERY_WORKER_POOLS."
+
+    def run_from_argv(self, argv):
+        # Everything after the pool's name is for celery, which Django's option parser wouldn't understand.
+        try:
+            self.handle(*argv[2:])
+        except CommandError as e:
+            sys.stderr.write('CommandError: %s\n' % e)
+            sys.exit(1)
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError("Which pool? Choose from: %s" % ', '.join(sorted(settings.CELERY_WORKER_POOLS)))
+        name = args[0]
+        try:
+            pool = settings.CELERY_WORKER_POOLS[name]
+        except KeyError:
+            raise CommandError("There's no pool called '%s'" % name)
+        command = [sys.executable, sys.argv[0], 'celery', 'worker',
+                   '--queues', ','.join(pool['queues']),
+                   '--pool', pool['pool'],
+                   '--concurrency', str(pool['concurrency']),
+                   '--hostname', '%s@%%h' % name] + list(args[1:])
+        # Replace ourselves with the worker, so that it's the one that gets signals from whatever is supervising us.
+        os.execv(sys.executable, command)
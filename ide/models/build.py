@@ -11,6 +11,7 @@ from django.utils.translation import ugettext as _
 from ide.models.meta import IdeModel
 
 import utils.s3 as s3
+from apptools.symbols import SymbolTable, SymbolFormatError
 __author__ = 'katharine'
 
 
@@ -38,6 +39,19 @@ class BuildResult(IdeModel):
     state = models.IntegerField(choices=STATE_CHOICES, default=STATE_WAITING)
     started = models.DateTimeField(auto_now_add=True, db_index=True)
     finished = models.DateTimeField(blank=True, null=True)
+    cache_key = models.CharField(max_length=40, blank=True, null=True, db_index=True)
+    # Set on native builds whose PBW can be repackaged with different JavaScript; see ide.utils.build_cache.
+    binary_cache_key = models.CharField(max_length=40, blank=True, null=True, db_index=True)
+    object_cache_hits = models.IntegerField(blank=True, null=True)
+    object_cache_misses = models.IntegerField(blank=True, null=True)
+    # JSON from ide.utils.build_metrics.BuildMetrics: how long each phase took, and the resources used.
+    metrics = models.TextField(blank=True, null=True)
+    # Started by a save rather than a request to build, and not shown to the user unless they ask for a build of
+    # the same state of the project; see ide.utils.build_scheduler.
+    speculative = models.BooleanField(default=False)
+    # The platforms built, comma-separated, if only some of the project's were asked for. Partial builds are for
+    # trying out on an emulator, and aren't to be given out as the app.
+    platforms = models.CharField(max_length=64, blank=True, null=True)
 
     def _get_dir(self):
         if settings.AWS_ENABLED:
@@ -66,11 +80,17 @@ class BuildResult(IdeModel):
     def get_build_log_url(self):
         return '%sbuild_log.txt' % self.get_url()
 
-    def get_debug_info_filename(self, platform, kind):
-        return self._get_dir() + self.DEBUG_INFO_MAP[platform][kind]
+    def _get_debug_info_name(self, platform, kind, compact):
+        name = self.DEBUG_INFO_MAP[platform][kind]
+        if compact:
+            name = name[:-len('.json')] + '.bin'
+        return name
 
-    def get_debug_info_url(self, platform, kind):
-        return self.get_url() + self.DEBUG_INFO_MAP[platform][kind]
+    def get_debug_info_filename(self, platform, kind, compact=False):
+        return self._get_dir() + self._get_debug_info_name(platform, kind, compact)
+
+    def get_debug_info_url(self, platform, kind, compact=False):
+        return self.get_url() + self._get_debug_info_name(platform, kind, compact)
 
     def get_simplyjs(self):
         return '%ssimply.js' % self._get_dir()
@@ -85,6 +105,12 @@ class BuildResult(IdeModel):
         else:
             s3.save_file('builds', self.build_log, text, public=True, content_type='text/plain')
 
+    def save_build_log_file(self, path):
+        if not settings.AWS_ENABLED:
+            shutil.copy(path, self.build_log)
+        else:
+            s3.upload_file('builds', self.build_log, path, public=True, content_type='text/plain')
+
     def read_build_log(self):
         if not settings.AWS_ENABLED:
             with open(self.build_log, 'r') as f:
@@ -92,13 +118,49 @@ class BuildResult(IdeModel):
         else:
             return s3.read_file('builds', self.build_log)
 
-    def save_debug_info(self, json_info, platform, kind):
-        text = json.dumps(json_info)
+    def save_debug_info_batch(self, items, compact=False):
+        """
+        Saves several sets of debug info at once.
+        :param items: a list of (platform, kind, data) tuples.
+        :param compact: whether the data is in the compact format from apptools.symbols, rather than JSON text.
+        """
         if not settings.AWS_ENABLED:
-            with open(self.get_debug_info_filename(platform, kind), 'w') as f:
-                f.write(text)
+            for platform, kind, data in items:
+                with open(self.get_debug_info_filename(platform, kind, compact), 'wb') as f:
+                    f.write(data)
+        else:
+            s3.save_files('builds', [(self.get_debug_info_filename(platform, kind, compact), data)
+                                     for platform, kind, data in items],
+                          public=True, content_type='application/octet-stream' if compact else 'application/json')
+
+    def _read_debug_info(self, platform, kind, compact):
+        path = self.get_debug_info_filename(platform, kind, compact)
+        if not settings.AWS_ENABLED:
+            if not os.path.exists(path):
+                return None
+            with open(path, 'rb') as f:
+                return f.read()
         else:
-            s3.save_file('builds', self.get_debug_info_filename(platform, kind), text, public=True, content_type='application/json')
+            return s3.read_file_if_exists('builds', path)
+
+    def get_symbol_table(self, platform, kind):
+        """
+        Loads the debug info for looking up addresses, preferring the compact format but falling back to JSON for
+        builds from before it existed. SDK 2 builds only have aplite debug info, which is used for every platform.
+        :return: a SymbolTable, or None if there is no debug info.
+        """
+        platforms = [platform, 'aplite'] if platform in self.DEBUG_INFO_MAP and platform != 'aplite' else ['aplite']
+        for platform in platforms:
+            data = self._read_debug_info(platform, kind, True)
+            if data is not None:
+                try:
+                    return SymbolTable.from_packed(data)
+                except SymbolFormatError as e:
+                    print "Couldn't read compact debug info for build %d: %s" % (self.id, e)
+            data = self._read_debug_info(platform, kind, False)
+            if data is not None:
+                return SymbolTable.from_dict(json.loads(data))
+        return None
 
     def save_pbw(self, pbw_path):
         if not settings.AWS_ENABLED:
@@ -113,6 +175,62 @@ class BuildResult(IdeModel):
         else:
             s3.save_file('builds', self.simplyjs, javascript, public=True, content_type='text/javascript')
 
+    def get_artifact_names(self):
+        names = ['watchface.pbw', 'build_log.txt', 'simply.js']
+        for platform, platform_names in self.DEBUG_INFO_MAP.iteritems():
+            names.extend(platform_names)
+            for kind in (self.DEBUG_APP, self.DEBUG_WORKER):
+                names.append(self._get_debug_info_name(platform, kind, True))
+        return names
+
+    def read_pbw_to_path(self, path):
+        if not settings.AWS_ENABLED:
+            shutil.copy(self.pbw, path)
+        else:
+            s3.read_file_to_filesystem('builds', self.pbw, path)
+
+    def _copy_artifact_from(self, other, name):
+        """
+        :return: False if the other build doesn't have the artifact.
+        """
+        if not settings.AWS_ENABLED:
+            src = other._get_dir() + name
+            if not os.path.exists(src):
+                return False
+            shutil.copy(src, self._get_dir() + name)
+            return True
+        else:
+            return s3.copy_file('builds', other._get_dir() + name, self._get_dir() + name, public=True)
+
+    def copy_artifacts_from(self, other):
+        """
+        Copies the stored output of another build (PBW, log, debug info and sizes) into this one.
+        Returns False, having copied nothing, if the other build no longer has a PBW.
+        """
+        for name in self.get_artifact_names():
+            if not self._copy_artifact_from(other, name) and name == 'watchface.pbw':
+                return False
+
+        for size in other.sizes.all():
+            BuildSize.objects.create(
+                build=self,
+                platform=size.platform,
+                total_size=size.total_size,
+                binary_size=size.binary_size,
+                resource_size=size.resource_size,
+                worker_size=size.worker_size,
+            )
+        return True
+
+    def copy_debug_info_from(self, other):
+        """
+        Copies another build's debug info into this one, for builds made from the same binaries.
+        """
+        for platform in self.DEBUG_INFO_MAP:
+            for kind in (self.DEBUG_APP, self.DEBUG_WORKER):
+                for compact in (True, False):
+                    self._copy_artifact_from(other, self._get_debug_info_name(platform, kind, compact))
+
     pbw = property(get_pbw_filename)
     build_log = property(get_build_log)
 
@@ -122,6 +240,14 @@ class BuildResult(IdeModel):
     simplyjs = property(get_simplyjs)
     simplyjs_url = property(get_simplyjs_url)
 
+    platform_list = property(lambda self: self.platforms.split(',') if self.platforms else [])
+    partial = property(lambda self: bool(self.platforms))
+
+    def get_metrics(self):
+        if not self.metrics:
+            return None
+        return json.loads(self.metrics)
+
     def get_sizes(self):
         sizes = {}
         for size in self.sizes.all():
@@ -143,3 +269,29 @@ class BuildSize(IdeModel):
     binary_size = models.IntegerField(blank=True, null=True)
     resource_size = models.IntegerField(blank=True, null=True)
     worker_size = models.IntegerField(blank=True, null=True)
+
+
+class BuildStats(IdeModel):
+    """
+    A rollup of the builds that finished in one hour for one SDK version, project type and platform, maintained by
+    ide.utils.build_stats as builds finish. Each build is counted once with a blank platform, and once for each
+    platform it was built for. Durations and queue waits are kept as histograms so percentiles can be estimated
+    across any number of rollups.
+    """
+    hour = models.DateTimeField(db_index=True)
+    sdk_version = models.CharField(max_length=6)
+    project_type = models.CharField(max_length=10)
+    platform = models.CharField(max_length=20, blank=True)
+
+    builds = models.IntegerField(default=0)
+    failures = models.IntegerField(default=0)
+    duration_total = models.FloatField(default=0)
+    duration_histogram = models.TextField(default="[]")
+    queue_wait_total = models.FloatField(default=0)
+    queue_wait_histogram = models.TextField(default="[]")
+    sized_builds = models.IntegerField(default=0)
+    binary_size_total = models.BigIntegerField(default=0)
+    resource_size_total = models.BigIntegerField(default=0)
+
+    class Meta(IdeModel.Meta):
+        unique_together = (('hour', 'sdk_version', 'project_type', 'platform'),)
@@ -50,12 +50,21 @@ class ResourceFile(IdeModel):
     def get_identifiers(self):
         return ResourceIdentifier.objects.filter(resource_file=self)
 
-    def copy_all_variants_to_dir(self, path):
+    def get_variant_targets(self, path):
+        """
+        :return: a list of (variant, destination) pairs giving where each variant belongs in the directory path.
+        """
         filename_parts = os.path.splitext(self.file_name)
+        targets = []
         for variant in self.variants.all():
             abs_target = "%s/%s%s%s" % (path, filename_parts[0], variant.get_tags_string(), filename_parts[1])
             if not abs_target.startswith(path):
                 raise Exception("Suspicious filename: %s" % self.file_name)
+            targets.append((variant, abs_target))
+        return targets
+
+    def copy_all_variants_to_dir(self, path):
+        for variant, abs_target in self.get_variant_targets(path):
             variant.copy_to_path(abs_target)
 
     def save(self, *args, **kwargs):
@@ -1,12 +1,16 @@
 import shutil
 import uuid
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils.translation import ugettext as _
 
 from ide.models.files import ResourceFile, ResourceIdentifier, SourceFile, ResourceVariant
 from ide.utils import generate_half_uuid
+from ide.utils.revisions import bump_project_revision
 
 from ide.models.meta import IdeModel
 
@@ -68,7 +72,7 @@ class Project(IdeModel):
 
     def get_last_build(self):
         try:
-            return self.builds.order_by('-id')[0]
+            return self.builds.filter(speculative=False).order_by('-id')[0]
         except IndexError:
             return None
 
@@ -81,6 +85,16 @@ class Project(IdeModel):
     def has_platform(self, platform):
         return self.app_platforms is None or platform in self.app_platform_list
 
+    def get_build_platforms(self):
+        """
+        :return: the platforms a build of the project is for.
+        """
+        if self.sdk_version == '2':
+            return ['aplite']
+        if self.project_type == 'pebblejs':
+            return ['aplite', 'basalt']
+        return self.app_platform_list or ['aplite', 'basalt', 'chalk']
+
     last_build = property(get_last_build)
     menu_icon = property(get_menu_icon)
 
@@ -133,3 +147,38 @@ class TemplateProject(Project):
         project.app_jshint = self.app_jshint
         project.app_modern_multi_js = self.app_modern_multi_js
         project.save()
+
+
+@receiver(post_save, sender=Project)
+@receiver(post_delete, sender=Project)
+def project_changed(sender, instance, **kwargs):
+    """
+    Keeps track of changes to anything that goes into building a project, so that speculative builds of an older
+    state of it are never mistaken for builds of the current one.
+    """
+    if settings.SPECULATIVE_BUILDS:
+        bump_project_revision(instance.id)
+
+
+@receiver(post_save, sender=SourceFile)
+@receiver(post_delete, sender=SourceFile)
+@receiver(post_save, sender=ResourceFile)
+@receiver(post_delete, sender=ResourceFile)
+def project_file_changed(sender, instance, **kwargs):
+    if settings.SPECULATIVE_BUILDS:
+        bump_project_revision(instance.project_id)
+
+
+@receiver(post_save, sender=ResourceVariant)
+@receiver(post_delete, sender=ResourceVariant)
+@receiver(post_save, sender=ResourceIdentifier)
+@receiver(post_delete, sender=ResourceIdentifier)
+def project_resource_changed(sender, instance, **kwargs):
+    if not settings.SPECULATIVE_BUILDS:
+        return
+    try:
+        project_id = ResourceFile.objects.values_list('project_id', flat=True).get(pk=instance.resource_file_id)
+    except ResourceFile.DoesNotExist:
+        # The whole resource file has been deleted, which project_file_changed hears about.
+        return
+    bump_project_revision(project_id)
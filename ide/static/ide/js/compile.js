@@ -12,13 +12,19 @@ CloudPebble.Compile = (function() {
     var mRunningBuild = false;
     var mLastScrollTop = 'bottom';
     var mLastBuild = null;
+    var mLastEstimateTime = 0;
 
     var build_history_row = function(build) {
         var tr = $('<tr>');
         tr.append($('<td class="build-id">' + (build.id === null ? '?' : build.id) + '</td>'));
         tr.append($('<td class="build-date">' + CloudPebble.Utils.FormatDatetime(build.started) + '</td>'));
-        tr.append($('<td class="build-state">' + COMPILE_SUCCESS_STATES[build.state].english + '</td>'));
-        tr.append($('<td class="build-pbw">' + (build.state == 3 ? ('<a href="'+build.pbw+'" class="btn btn-small">' + gettext("pbw") + '</a>') : ' ') + '</td>'));
+        var state = COMPILE_SUCCESS_STATES[build.state].english;
+        if(build.partial) {
+            state = interpolate(gettext("%s (%s only)"), [state, build.platforms.join(', ')]);
+        }
+        tr.append($('<td class="build-state">').text(state));
+        // Partial builds are only for the emulator, so there's no PBW to download.
+        tr.append($('<td class="build-pbw">' + (build.state == 3 && !build.partial ? ('<a href="'+build.pbw+'" class="btn btn-small">' + gettext("pbw") + '</a>') : ' ') + '</td>'));
         // Build log thingy.
         var td = $('<td class="build-log">');
         if(build.state > 1) {
@@ -79,6 +85,38 @@ CloudPebble.Compile = (function() {
         });
     };
 
+    // Follows the output of a build that is still running, then switches to the full log once it has finished.
+    var show_live_build_log = function(build) {
+        var log = $('<pre class="build-log">').css({'height': '100%', 'overflow': 'auto'});
+        CloudPebble.Sidebar.SuspendActive();
+        CloudPebble.Sidebar.SetActivePane(log);
+        var poll = function(cursor) {
+            $.getJSON('/ide/project/' + PROJECT_ID + '/build/' + build + '/log/tail', {cursor: cursor}, function(data) {
+                // Stop if someone has navigated away.
+                if(!$.contains(document.documentElement, log[0])) {
+                    return;
+                }
+                if(!data.success) {
+                    return;
+                }
+                var at_bottom = log.scrollTop() + log.innerHeight() >= log[0].scrollHeight - 10;
+                if(data.truncated) {
+                    log.append(document.createTextNode(gettext("[earlier output omitted]") + "\n"));
+                }
+                log.append(document.createTextNode(data.lines.join('')));
+                if(at_bottom) {
+                    log.scrollTop(log[0].scrollHeight);
+                }
+                if(data.finished) {
+                    show_build_log(build);
+                } else {
+                    setTimeout(function() { poll(data.cursor); }, 500);
+                }
+            });
+        };
+        poll(0);
+    };
+
     var update_build_history = function(pane) {
         $.getJSON('/ide/project/' + PROJECT_ID + '/build/history', function(data) {
             CloudPebble.ProgressBar.Hide();
@@ -196,11 +234,19 @@ CloudPebble.Compile = (function() {
         }
     };
 
-    var run_build = function(callback) {
+    var run_build = function(callback, platforms) {
         var temp_build = {started: (new Date()).toISOString(), finished: null, state: 1, uuid: null, id: null, size: {total: null, binary: null, resources: null}};
         update_last_build(pane, temp_build);
         pane.find('#run-build-table').prepend(build_history_row(temp_build));
-        $.post('/ide/project/' + PROJECT_ID + '/build/run', function() {
+        $.post('/ide/project/' + PROJECT_ID + '/build/run', platforms ? {platforms: platforms.join(',')} : {}, function(data) {
+            if(!data.success) {
+                alert(interpolate(gettext("Couldn't start a build:\n\n%s"), [data.error]));
+                if(callback) {
+                    callback(false);
+                }
+                update_build_history(pane);
+                return;
+            }
             mRunningBuild = true;
             if(callback) {
                 mPendingCallbacks.push(callback);
@@ -228,6 +274,29 @@ CloudPebble.Compile = (function() {
         }, true);
     };
 
+    var update_build_estimate = function(pane, build) {
+        // The build history is polled every second while a build is pending, which is more often than this needs.
+        if(build.id === null || Date.now() - mLastEstimateTime < 5000) {
+            return;
+        }
+        mLastEstimateTime = Date.now();
+        $.getJSON('/ide/project/' + PROJECT_ID + '/build/' + build.id + '/estimate', function(data) {
+            if(!data.success || data.state != 1 || mLastBuild === null || mLastBuild.id != build.id) {
+                return;
+            }
+            var finish = Math.round(data.seconds_until_finish);
+            var text;
+            if(data.started || data.builds_ahead === 0) {
+                text = interpolate(ngettext("done in about %s second", "done in about %s seconds", finish), [finish]);
+            } else {
+                text = interpolate(ngettext("%(ahead)s build ahead; done in about %(finish)s seconds",
+                                            "%(ahead)s builds ahead; done in about %(finish)s seconds", data.builds_ahead),
+                                   {ahead: data.builds_ahead, finish: finish}, true);
+            }
+            pane.find('#last-compilation-estimate').removeClass('hide').find('span').text(text);
+        });
+    };
+
     var update_last_build = function(pane, build) {
         mLastBuild = build;
         if(build === null) {
@@ -237,6 +306,7 @@ CloudPebble.Compile = (function() {
             pane.find('#last-compilation, .build-stats').removeClass('hide');
             pane.find('#last-compilation-started').text(CloudPebble.Utils.FormatDatetime(build.started));
             if(build.state > 1) {
+                pane.find('#last-compilation-estimate').addClass('hide');
                 pane.find('#last-compilation-time').removeClass('hide').find('span').text(CloudPebble.Utils.FormatInterval(build.started, build.finished));
                 pane.find('#last-compilation-log').removeClass('hide').attr('href', build.log).off('click').click(function(e) {
                     if(e.ctrlKey || e.metaKey) {
@@ -249,8 +319,14 @@ CloudPebble.Compile = (function() {
                 });
                 pane.find('#compilation-run-build-button').removeAttr('disabled');
                 if(build.state == 3) {
-                    pane.find('#last-compilation-pbw').removeClass('hide').attr('href', build.pbw);
-                    pane.find("#run-on-phone").removeClass('hide');
+                    if(build.partial) {
+                        pane.find('#last-compilation-pbw').addClass('hide');
+                        pane.find('#last-compilation-qr-code').addClass('hide');
+                        pane.find('#run-on-phone').addClass('hide');
+                    } else {
+                        pane.find('#last-compilation-pbw').removeClass('hide').attr('href', build.pbw);
+                        pane.find("#run-on-phone").removeClass('hide');
+                    }
                     if(build.sizes) {
                         if(build.sizes.aplite) {
                             var aplite_size_text = format_build_size(build.sizes.aplite, 24576, 10240, 98304);
@@ -278,8 +354,13 @@ CloudPebble.Compile = (function() {
                 }
             } else {
                 pane.find('#last-compilation-time').addClass('hide');
-                pane.find('#last-compilation-log').addClass('hide');
+                pane.find('#last-compilation-log').removeClass('hide').attr('href', '#').off('click').click(function(e) {
+                    e.preventDefault();
+                    show_live_build_log(build.id);
+                    ga('send', 'event', 'build log', 'show', 'live');
+                });
                 pane.find('#compilation-run-build-button').attr('disabled', 'disabled');
+                update_build_estimate(pane, build);
                 pane.find('#last-compilation-size-aplite').addClass('hide');
                 pane.find('#last-compilation-size-basalt').addClass('hide');
                 pane.find('#last-compilation-size-chalk').addClass('hide');
@@ -295,7 +376,7 @@ CloudPebble.Compile = (function() {
                 .removeClass('label-success label-error label-info')
                 .addClass('label-' + COMPILE_SUCCESS_STATES[build.state].label)
                 .text(COMPILE_SUCCESS_STATES[build.state].english);
-            mCrashAnalyser.set_debug_info_url(build.build_dir);
+            mCrashAnalyser.set_build_id(build.id);
         }
 
     };
@@ -529,6 +610,11 @@ CloudPebble.Compile = (function() {
                         chalk: mLastBuild.sizes.chalk
                     };
                     var size = sizes[platform];
+                    if(!size) {
+                        // Partial builds only have the platforms they were run for.
+                        report_error(interpolate(gettext("The last build didn't include %s. Build the project again to install it."), [platform]));
+                        return;
+                    }
                     var install_timer = setTimeout(function() {
                         if (SharedPebble.isVirtual()) {
                             report_error(gettext("Installation failed (timeout). Try rebooting the emulator and trying again."));
@@ -727,8 +813,13 @@ CloudPebble.Compile = (function() {
         Init: function() {
             init();
         },
-        RunBuild: function(callback) {
-            run_build(callback);
+        /**
+         * Build the project.
+         * @param callback called with whether the build succeeded.
+         * @param platforms if given, build only these platforms. The result can only be run on an emulator.
+         */
+        RunBuild: function(callback, platforms) {
+            run_build(callback, platforms);
         },
         /**
          * Get the platform to install and run the the app on, given details of the project and last build.
@@ -1,107 +1,38 @@
 CloudPebble.CrashChecker = function(app_uuid) {
-    var self = this;
-    var mSymbolCache = {};
-    var mBuildDir = null;
+    var mBuildId = null;
     var mAppUUID = app_uuid;
+    // How often, and how many times, to ask again for symbols from a build whose debug info hasn't been saved yet.
+    var SYMBOLICATE_RETRY_DELAY = 1000;
+    var SYMBOLICATE_ATTEMPTS = 15;
 
-    this.set_debug_info_url = function(build_dir) {
-        mBuildDir = build_dir;
-        mSymbolCache = {};
+    this.set_build_id = function(build_id) {
+        mBuildId = build_id;
     };
 
-    var find_pointer_sync = function(platform, process, pointer) {
-        var cache = cache_lookup(process, platform);
-        var files = cache.files;
-        var lines = cache.lines;
-        var functions = cache.functions;
-
-        // First figure out what line we're on.
-        var index = _.sortedIndex(lines, [pointer], function(x) { return x[0]; }) - 1;
-        if(index < 0) {
-            return null;
-        }
-        var line = lines[index][2];
-        var file = files[lines[index][1]];
-
-        // Now also figure out the function.
-        index = _.sortedIndex(functions, [pointer], function(x) { return x[0]; }) - 1;
-        if(index < 0) {
-            return null;
-        }
-        var fn_info = functions[index];
-        if(pointer > fn_info[1]) {
-            return null;
-        }
-
-        var fn_name = fn_info[2];
-        var fn_line = fn_info[3];
-        return {
-            file: file,
-            line: line,
-            fn_name: fn_name,
-            fn_line: fn_line
-        };
-    };
-
-    function cache_lookup(process, platform) {
-        return mSymbolCache[platform + '/' + process];
-    }
-
-    var platform_mappings = {
-        app: {
-            unknown: ['debug_info.json'],
-            aplite: ['debug_info.json'],
-            basalt: ['basalt_debug_info.json', 'debug_info.json'],
-            chalk: ['chalk_debug_info.json', 'debug_info.json']
-        },
-        worker: {
-            unknown: ['worker_debug_info.json'],
-            aplite: ['worker_debug_info.json'],
-            basalt: ['basalt_worker_debug_info.json', 'worker_debug_info.json'],
-            chalk: ['chalk_worker_debug_info.json', 'worker_debug_info.json']
-        }
-    };
-
-    function get_debug_json(platform, process) {
-        function go(urls) {
-            var deferred = $.Deferred();
-            if (urls.length == 0) {
-                deferred.reject();
-                return deferred.promise();
-            }
-            var url = urls[0];
-            $.ajax({
-                url: mBuildDir + url,
-                dataType: 'json'
-            }).done(function(data) {
-                deferred.resolve(data);
-            }).fail(function() {
-                go(urls.slice(1)).done(function(data) {
-                    deferred.resolve(data);
-                }).fail(function() {
-                    deferred.fail();
-                });
-            });
-            return deferred.promise();
-        }
-        return go(platform_mappings[process][platform]);
-    }
-
+    // Symbolication happens on the server, so we don't have to download the whole of the debug info.
     this.find_source_lines = function(process, version, pointers, callback) {
         var platform = Pebble.version_to_platform(version);
-        if(!cache_lookup(process, platform)) {
-            get_debug_json(platform, process).done(function(data) {
-                mSymbolCache[platform + '/' + process] = data;
-                self.find_source_lines(process, version, pointers, callback);
+        var url = '/ide/project/' + PROJECT_ID + '/build/' + mBuildId + '/symbolicate';
+        var attempts = 0;
+        var request = function() {
+            $.getJSON(url, {
+                platform: platform,
+                process: process,
+                addresses: pointers.join(',')
+            }, function(data) {
+                if(data.success) {
+                    if(data.pending) {
+                        // The build has finished, but its debug info hasn't been saved yet.
+                        if(++attempts < SYMBOLICATE_ATTEMPTS) {
+                            setTimeout(request, SYMBOLICATE_RETRY_DELAY);
+                        }
+                    } else {
+                        callback(data.symbols);
+                    }
+                }
             });
-            return;
-        }
-
-        var results = [];
-        _.each(pointers, function(pointer) {
-            results.push(find_pointer_sync(platform, process, pointer));
-        });
-        callback(results);
+        };
+        request();
     };
 
     this.check_line_for_crash = function(line, crash_callback) {
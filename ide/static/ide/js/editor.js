@@ -17,6 +17,12 @@ CloudPebble.Editor = (function() {
         CloudPebble.Prompts.Progress.Show(gettext("Saving..."));
         CloudPebble.Editor.SaveAll(function() {
             CloudPebble.Prompts.Progress.Show(gettext("Compiling..."));
+            // When running on an emulator, only build the platform it's emulating.
+            var run_platform = CloudPebble.Compile.GetPlatformForInstall();
+            var build_platforms;
+            if(CloudPebble.ProjectInfo.sdk_version == '3' && run_platform != ConnectionType.Phone) {
+                build_platforms = [run_platform == ConnectionType.Qemu ? SharedPebble.getPlatformName() : ConnectionPlatformNames[run_platform]];
+            }
             CloudPebble.Compile.RunBuild(function (success) {
                 CloudPebble.Prompts.Progress.Hide();
                 if(success) {
@@ -24,7 +30,7 @@ CloudPebble.Editor = (function() {
                 } else {
                     CloudPebble.Compile.Show();
                 }
-            });
+            }, build_platforms);
         });
     };
 
@@ -1,7 +1,8 @@
+from celery.signals import worker_init
 from django.conf import settings
 
 from ide.tasks.archive import add_project_to_archive, do_import_archive
-from ide.tasks.build import run_compile
+from ide.tasks.build import run_compile, run_speculative_compile
 from ide.tasks.git import github_push, github_pull
 from ide.tasks.gist import import_gist
 import apptools.addr2lines
@@ -10,6 +11,18 @@ import apptools.addr2lines
 apptools.addr2lines.ARM_CS_TOOLS = settings.ARM_CS_TOOLS
 
 
+@worker_init.connect
+def _make_psycopg_green(sender=None, **kwargs):
+    # In a gevent pool, database queries must let other greenlets run while they wait, just as they do in gunicorn.
+    try:
+        from gevent import monkey
+    except ImportError:
+        return
+    if monkey.is_module_patched('socket'):
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+
 
 
 
@@ -1,7 +1,6 @@
 import os
 import re
 import shutil
-import tempfile
 import uuid
 import zipfile
 import json
@@ -12,6 +11,7 @@ from django.core.exceptions import SuspiciousOperation
 from django.db import transaction
 from ide.utils.project import find_project_root
 from ide.utils.sdk import generate_manifest, generate_wscript_file, generate_jshint_file, dict_to_pretty_json
+from ide.utils.scratch import scratch_file
 from utils.td_helper import send_td_event
 
 from ide.models.files import SourceFile, ResourceFile, ResourceIdentifier, ResourceVariant
@@ -53,7 +53,7 @@ def add_project_to_archive(z, project, prefix=''):
 def create_archive(project_id):
     project = Project.objects.get(pk=project_id)
     prefix = re.sub(r'[^\w]+', '_', project.name).strip('_').lower()
-    with tempfile.NamedTemporaryFile(suffix='.zip', delete=False) as temp:
+    with scratch_file('export', suffix='.zip') as temp:
         filename = temp.name
         with zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED) as z:
             add_project_to_archive(z, project)
@@ -79,7 +79,7 @@ def create_archive(project_id):
 def export_user_projects(user_id):
     user = User.objects.get(pk=user_id)
     projects = Project.objects.filter(owner=user)
-    with tempfile.NamedTemporaryFile(suffix='.zip', delete=False) as temp:
+    with scratch_file('export', suffix='.zip') as temp:
         filename = temp.name
         with zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED) as z:
             for project in projects:
@@ -121,7 +121,7 @@ def make_filename_variant(file_name, variant):
 def do_import_archive(project_id, archive, delete_project=False):
     project = Project.objects.get(pk=project_id)
     try:
-        with tempfile.NamedTemporaryFile(suffix='.zip') as archive_file:
+        with scratch_file('import', suffix='.zip') as archive_file:
             archive_file.write(archive)
             archive_file.flush()
             with zipfile.ZipFile(str(archive_file.name), 'r') as z:
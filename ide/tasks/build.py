@@ -1,28 +1,71 @@
+import collections
+import errno
+import fcntl
+import hashlib
 import os
 import shutil
 import subprocess
+import sys
 import tempfile
 import traceback
 import zipfile
 import json
 import resource
+import time
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
 
 from celery import task
+from celery.signals import worker_ready
 
 from django.conf import settings
 from django.utils.timezone import now
 
 import apptools.addr2lines
+from ide.utils import link_tree, break_link
 from ide.utils.sdk import generate_wscript_file, generate_jshint_file, generate_manifest_dict, \
-    generate_simplyjs_manifest_dict, generate_pebblejs_manifest_dict
+    generate_simplyjs_manifest_dict, generate_pebblejs_manifest_dict, add_build_hooks
 from utils.td_helper import send_td_event
+import utils.s3 as s3
 
 from ide.models.build import BuildResult, BuildSize
 from ide.models.files import SourceFile, ResourceFile, ResourceVariant
 from ide.utils.prepreprocessor import process_file as check_preprocessor_directives
+from ide.utils.build_cache import build_cache_key, binary_cache_key
+from ide.utils.workspaces import acquire_pooled_workspace, acquire_project_workspace, evict_project_workspaces, \
+    workspace_pool_key
+from ide.utils.pbw import merge_pbws, patch_pbw, repackage_pbw, PBWPatchError
+from ide.utils.log_stream import BuildLogStream
+from ide.utils.scratch import ScratchDir, QuotaWatcher, scratch_root
+from ide.utils.build_scheduler import claim_build, release_build, release_build_slot, record_affinity, \
+    start_worker_heartbeat, start_dispatch_timer, start_speculative_build, CancellationWatcher
+from ide.utils.build_metrics import BuildMetrics, WafPhaseTimer
+from ide.utils.build_stats import record_build_stats
+from ide.utils.build_estimates import record_build_duration
+from ide.utils.resource_cache import resource_cache_dir, prune_resource_cache, runtime_cache_dir, \
+    prune_runtime_cache
 
 __author__ = 'katharine'
 
+# Anything waf might have left in the Pebble.js and Simply.js runtime trees, which it would write to in place if we
+# linked it into a build.
+TEMPLATE_BUILD_STATE = ('build', '.lock-waf*')
+
+# The only part of a Simply.js app that isn't the same for everyone.
+SIMPLYJS_USER_SCRIPT = """
+            (function() {
+                simply.mainScriptSource = %s;
+            })();
+            """
+SIMPLYJS_SCRIPT_PLACEHOLDER = json.dumps('__CLOUDPEBBLE_SIMPLYJS_USER_SCRIPT__')
+
+# The fields of a BuildResult that building it fills in. Only these are saved, because a speculative build can be
+# promoted while it's running and saving the whole thing would make it speculative again.
+BUILD_RESULT_FIELDS = ['state', 'finished', 'cache_key', 'binary_cache_key', 'object_cache_hits',
+                       'object_cache_misses', 'metrics']
+
+_simplyjs_runtime_key = None
+
 
 def _set_resource_limits():
     resource.setrlimit(resource.RLIMIT_CPU, (20, 20)) # 20 seconds of CPU time
@@ -31,15 +74,57 @@ def _set_resource_limits():
     resource.setrlimit(resource.RLIMIT_FSIZE, (5 * 1024 * 1024, 5 * 1024 * 1024)) # 5 MB output files.
 
 
+def _prepare_build_process():
+    # Give the build its own process group so that it can be killed along with everything it started.
+    os.setpgrp()
+    _set_resource_limits()
+
+
+def make_object_cache_environ(environ, base_dir):
+    """
+    Points the build at the shared ccache object cache. Paths are rewritten relative to base_dir so that builds
+    in different temporary directories share cache entries.
+    :return: the path of the ccache log, from which hits and misses can be counted after the build.
+    """
+    fd, log_path = tempfile.mkstemp(suffix='.log', prefix='ccache-')
+    os.close(fd)
+    environ['CLOUDPEBBLE_CCACHE'] = settings.CCACHE
+    environ['CCACHE_DIR'] = settings.OBJECT_CACHE_DIR
+    environ['CCACHE_MAXSIZE'] = settings.OBJECT_CACHE_MAX_SIZE
+    environ['CCACHE_BASEDIR'] = base_dir
+    environ['CCACHE_NOHASHDIR'] = '1'
+    environ['CCACHE_COMPILERCHECK'] = 'content'
+    environ['CCACHE_LOGFILE'] = log_path
+    return log_path
+
+
+def count_object_cache_results(log_path):
+    hits = 0
+    misses = 0
+    with open(log_path) as f:
+        for line in f:
+            if 'Result: ' not in line:
+                continue
+            result = line.split('Result: ', 1)[1]
+            if 'hit' in result:
+                hits += 1
+            elif 'miss' in result:
+                misses += 1
+    return hits, misses
+
+
 def create_source_files(project, base_dir):
     """
+    Creates the directories for the project's source files. The files themselves are fetched by fetch_project_files.
     :param project: Project
+    :return: a list of (SourceFile, path) pairs saying where each source file goes.
     """
     source_files = project.source_files.all()
     src_dir = os.path.join(base_dir, 'src')
     if project.project_type == 'pebblejs':
         src_dir = os.path.join(src_dir, 'js')
     worker_dir = None
+    transfers = []
     try:
         os.mkdir(src_dir)
     except OSError as e:
@@ -64,21 +149,116 @@ def create_source_files(project, base_dir):
         abs_target_dir = os.path.dirname(abs_target)
         if not os.path.exists(abs_target_dir):
             os.makedirs(abs_target_dir)
-        f.copy_to_path(abs_target)
-        # Make sure we don't duplicate downloading effort; just open the one we created.
-        with open(abs_target) as fh:
-            check_preprocessor_directives(abs_target_dir, abs_target, fh.read())
+        transfers.append((f, abs_target))
+    return transfers
 
 
-def save_debug_info(base_dir, build_result, kind, platform, elf_file):
-    path = os.path.join(base_dir, 'build', elf_file)
-    if os.path.exists(path):
-        try:
-            debug_info = apptools.addr2lines.create_coalesced_group(path)
-        except:
-            print traceback.format_exc()
+def fetch_project_files(transfers, keep=()):
+    """
+    Copies each SourceFile or ResourceVariant in transfers, a list of (file, path) pairs, to its path.
+    From S3, the files are fetched concurrently.
+    :param keep: paths whose contents should also be returned.
+    :return: a tuple of the total number of bytes fetched and a dict of the contents of each path in keep.
+    """
+    # The path might be a file linked from a runtime template, which mustn't be written to.
+    for f, path in transfers:
+        break_link(path)
+    if settings.AWS_ENABLED:
+        return s3.read_files_to_filesystem('source', [(f.s3_path, path) for f, path in transfers],
+                                           concurrency=settings.S3_FETCH_CONCURRENCY, keep=keep)
+    total = 0
+    contents = {}
+    for f, path in transfers:
+        if path in keep:
+            contents[path] = f.get_contents()
+            with open(path, 'wb') as fh:
+                fh.write(contents[path])
         else:
-            build_result.save_debug_info(debug_info, platform, kind)
+            f.copy_to_path(path)
+        total += os.path.getsize(path)
+    return total, contents
+
+
+def check_source_files(transfers, contents):
+    """
+    Checks that no source file includes anything from outside the project.
+    :param contents: the contents of each file, by path.
+    """
+    for f, path in transfers:
+        check_preprocessor_directives(os.path.dirname(path), path, contents[path])
+
+
+def find_debug_info_elfs(project, build_dir):
+    """
+    :return: a list of (platform, kind, path) tuples for each ELF the build produced.
+    """
+    if project.sdk_version == '2':
+        candidates = [('aplite', BuildResult.DEBUG_APP, 'pebble-app.elf'),
+                      ('aplite', BuildResult.DEBUG_WORKER, 'pebble-worker.elf')]
+    else:
+        candidates = []
+        for platform in ('aplite', 'basalt', 'chalk'):
+            candidates.append((platform, BuildResult.DEBUG_APP, '%s/pebble-app.elf' % platform))
+            candidates.append((platform, BuildResult.DEBUG_WORKER, '%s/pebble-worker.elf' % platform))
+    elfs = []
+    for platform, kind, elf_file in candidates:
+        path = os.path.join(build_dir, 'build', elf_file)
+        if os.path.exists(path):
+            elfs.append((platform, kind, path))
+    return elfs
+
+
+def extract_debug_info(elfs, time_budget, concurrency):
+    """
+    Runs apptools.addr2lines over each of elfs, a list of (platform, kind, path) tuples, several at a time.
+    Anything that hasn't finished within time_budget seconds of starting the first is killed and left out.
+    :return: a list of (platform, kind, compact debug info) tuples.
+    """
+    environ = os.environ.copy()
+    environ['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(apptools.addr2lines.__file__)))
+    deadline = time.time() + time_budget
+    pending = list(elfs)
+    running = []
+    results = []
+    with ScratchDir('debug') as scratch:
+        try:
+            while pending or running:
+                while pending and len(running) < concurrency:
+                    platform, kind, path = pending.pop(0)
+                    output_path = os.path.join(scratch.path, '%s-%d.bin' % (platform, kind))
+                    process = subprocess.Popen([sys.executable, '-m', 'apptools.addr2lines', '--tools',
+                                                settings.ARM_CS_TOOLS, '--format', 'compact', '--output',
+                                                output_path, path], env=environ)
+                    running.append((platform, kind, output_path, process))
+                for item in list(running):
+                    platform, kind, output_path, process = item
+                    if process.poll() is None:
+                        continue
+                    running.remove(item)
+                    if process.returncode == 0:
+                        with open(output_path, 'rb') as f:
+                            results.append((platform, kind, f.read()))
+                    else:
+                        print "Extracting %s debug info for %s failed." % (platform, kind)
+                if time.time() > deadline:
+                    print "Ran out of time extracting debug info; skipped %d ELFs." % (len(pending) + len(running))
+                    break
+                time.sleep(0.05)
+        finally:
+            for platform, kind, output_path, process in running:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+    return results
+
+
+def save_debug_info(project, build_result, build_dir):
+    try:
+        elfs = find_debug_info_elfs(project, build_dir)
+        debug_info = extract_debug_info(elfs, settings.DEBUG_INFO_TIME_BUDGET, settings.DEBUG_INFO_CONCURRENCY)
+        build_result.save_debug_info_batch(debug_info, compact=True)
+    except:
+        print traceback.format_exc()
 
 
 def store_size_info(project, build_result, platform, zip_file):
@@ -101,58 +281,538 @@ def store_size_info(project, build_result, platform, zip_file):
         pass
 
 
+def acquire_build_dir(project, manifest_dict, base_dir, name=None):
+    """
+    Moves the project assembled in base_dir into the project's own workspace, if we keep those, so that waf only
+    has to rebuild what changed. Failing that, if there's a workspace free that has already been configured for
+    this kind of project, moves it into that so we can skip 'waf configure'.
+    :param name: the name of the project's workspace, if it isn't just the project's ID.
+    :return: a tuple of the directory to build in and the Workspace holding it, if any.
+    """
+    if not settings.BUILD_WORKSPACE_ROOT:
+        return base_dir, None
+    workspace = None
+    try:
+        config_key = workspace_pool_key(project, manifest_dict)
+        if settings.PROJECT_WORKSPACES:
+            workspace = acquire_project_workspace(name or str(project.id), config_key)
+        if workspace is None:
+            workspace = acquire_pooled_workspace(config_key)
+        if workspace is not None:
+            workspace.sync_from(base_dir)
+            return workspace.path, workspace
+    except Exception as e:
+        print "Couldn't use a pooled workspace: %s" % e
+        if workspace is not None:
+            workspace.release()
+    return base_dir, None
+
+
+# How many of the last lines of a command's output check_output_streaming keeps hold of.
+OUTPUT_TAIL_LINES = 1000
+
+
+def check_output_streaming(command, on_line=None, on_start=None, on_exit=None, **kwargs):
+    """
+    Like subprocess.check_output with stderr=STDOUT, but also passes each line of output to on_line as it arrives.
+    Only the last OUTPUT_TAIL_LINES lines are returned (or given to the CalledProcessError), so anything that
+    needs all of the output should collect it from on_line.
+    on_start is given the Popen object as soon as the process has started, and on_exit the resource usage of it
+    and everything it waited for once it has exited.
+    """
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
+    if on_start is not None:
+        on_start(process)
+    tail = collections.deque(maxlen=OUTPUT_TAIL_LINES)
+    # Iterating over the file directly would read ahead and hold lines back until its buffer filled.
+    for line in iter(process.stdout.readline, ''):
+        tail.append(line)
+        if on_line is not None:
+            try:
+                on_line(line)
+            except Exception as e:
+                print "Couldn't stream build output: %s" % e
+                on_line = None
+    process.stdout.close()
+    output = ''.join(tail)
+    try:
+        pid, status, usage = os.wait4(process.pid, 0)
+    except OSError as e:
+        if e.errno != errno.ECHILD:
+            raise
+        # Something else polling the process got to it first, so its resource usage is lost.
+        returncode = process.wait()
+    else:
+        # Let the Popen object know, so that anything else holding it doesn't try to wait for it again.
+        returncode = process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        if on_exit is not None:
+            on_exit(usage)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command, output=output)
+    return output
+
+
+def run_waf(waf, build_dir, environ, workspace=None, on_line=None, on_start=None, metrics=None):
+    """
+    Builds the project in build_dir, only running 'waf configure' if its workspace hasn't been configured yet.
+    waf is killed if build_dir grows beyond settings.SCRATCH_QUOTA while it's running.
+    :param metrics: a BuildMetrics to add the time spent configuring, compiling and bundling, and waf's resource
+    usage, to.
+    :return: waf's output. Raises CalledProcessError if the build fails, or ScratchQuotaExceeded if it got too big.
+    """
+    quota = QuotaWatcher(build_dir)
+
+    def on_waf_line(line):
+        quota.on_line(line)
+        if on_line is not None:
+            on_line(line)
+
+    def on_waf_start(process):
+        quota.register(process)
+        if on_start is not None:
+            on_start(process)
+
+    timer = WafPhaseTimer(on_waf_line)
+
+    def waf_run(*commands):
+        try:
+            output = check_output_streaming([waf] + list(commands), on_line=timer, on_start=on_waf_start,
+                                            on_exit=metrics.add_rusage if metrics else None, cwd=build_dir,
+                                            preexec_fn=_prepare_build_process, env=environ)
+        except subprocess.CalledProcessError:
+            # If we killed it for being too big, say so rather than that it failed.
+            quota.check()
+            raise
+        quota.check()
+        return output
+
+    try:
+        if workspace is not None and workspace.is_configured():
+            try:
+                return waf_run("build")
+            except subprocess.CalledProcessError as e:
+                if 'waf configure' not in e.output:
+                    raise
+                # waf doesn't trust the configuration it has; throw it away and start again.
+                workspace.unconfigure()
+        return waf_run("configure", "build")
+    finally:
+        if metrics is not None:
+            timer.record(metrics)
+
+
+def get_parallel_platforms(project, manifest_dict):
+    """
+    :return: the platforms to build in separate processes, or None if the project should be built in one go.
+    """
+    if not settings.PARALLEL_PLATFORM_BUILDS or project.project_type != 'native' or project.sdk_version != '3':
+        return None
+    platforms = manifest_dict.get('targetPlatforms', None)
+    if not platforms or len(platforms) < 2:
+        return None
+    return platforms
+
+
+def build_platform(project, base_dir, manifest_dict, platform, waf, environ, log_stream=None, watcher=None):
+    """
+    Builds one platform of the project assembled in base_dir in a directory of its own, then copies its
+    binaries to base_dir/build/<platform>/ and its PBW to base_dir/build/<platform>.pbw.
+    :return: a tuple of waf's return code and output, the object cache hits and misses, and the BuildMetrics of
+    the build.
+    """
+    scratch = ScratchDir('platform')
+    platform_dir = os.path.join(scratch.path, platform)
+    shutil.copytree(base_dir, platform_dir, ignore=lambda path, names: ['build'] if path == base_dir else [])
+    platform_manifest = dict(manifest_dict, targetPlatforms=[platform])
+    open(os.path.join(platform_dir, 'appinfo.json'), 'w').write(json.dumps(platform_manifest))
+
+    build_dir, workspace = acquire_build_dir(project, platform_manifest, platform_dir,
+                                             name='%d-%s' % (project.id, platform))
+    environ = environ.copy()
+    object_cache_log = make_object_cache_environ(environ, build_dir) if settings.OBJECT_CACHE_DIR else None
+    hits = misses = None
+    metrics = BuildMetrics()
+    try:
+        try:
+            on_line = (lambda line: log_stream.write_line('[%s] %s' % (platform, line))) if log_stream else None
+            output = run_waf(waf, build_dir, environ, workspace, on_line=on_line,
+                             on_start=watcher.register if watcher else None, metrics=metrics)
+            returncode = 0
+        except subprocess.CalledProcessError as e:
+            output = e.output
+            returncode = e.returncode
+        else:
+            shutil.copytree(os.path.join(build_dir, 'build', platform), os.path.join(base_dir, 'build', platform))
+            shutil.copy(os.path.join(build_dir, 'build', '%s.pbw' % os.path.basename(build_dir)),
+                        os.path.join(base_dir, 'build', '%s.pbw' % platform))
+    finally:
+        if object_cache_log is not None:
+            try:
+                hits, misses = count_object_cache_results(object_cache_log)
+            except Exception as e:
+                print "Couldn't read object cache log: %s" % e
+            finally:
+                os.unlink(object_cache_log)
+        if workspace is not None:
+            workspace.release()
+        scratch.remove()
+    return returncode, output, hits, misses, metrics
+
+
+def build_platforms_in_parallel(project, build_result, base_dir, manifest_dict, platforms, waf, environ,
+                                log_stream=None, watcher=None, metrics=None):
+    """
+    Builds each platform in its own waf process, so they run concurrently and each gets its own resource limits,
+    then bundles them into base_dir/build/<basename>.pbw as though they had been built together.
+    :param metrics: a BuildMetrics to add the platforms' metrics to.
+    :return: the combined output of the builds. Raises CalledProcessError if any of them failed.
+    """
+    os.mkdir(os.path.join(base_dir, 'build'))
+    pool = ThreadPool(len(platforms))
+    try:
+        results = pool.map(lambda platform: build_platform(project, base_dir, manifest_dict, platform, waf, environ,
+                                                           log_stream, watcher), platforms)
+    finally:
+        pool.close()
+
+    output = ''.join("[%s]\n%s\n" % (platform, result[1]) for platform, result in zip(platforms, results))
+    hits = [result[2] for result in results if result[2] is not None]
+    misses = [result[3] for result in results if result[3] is not None]
+    if hits or misses:
+        build_result.object_cache_hits = sum(hits)
+        build_result.object_cache_misses = sum(misses)
+    if metrics is not None:
+        metrics.merge_concurrent([result[4] for result in results])
+
+    failed = [result[0] for result in results if result[0] != 0]
+    if failed:
+        raise subprocess.CalledProcessError(failed[0], waf, output=output)
+
+    bundle_start = time.time()
+    merge_pbws([os.path.join(base_dir, 'build', '%s.pbw' % platform) for platform in platforms],
+               os.path.join(base_dir, 'build', '%s.pbw' % os.path.basename(base_dir)))
+    if metrics is not None:
+        metrics.add_time('bundle', time.time() - bundle_start)
+    return output
+
+
+def restore_cached_build(project, build_result):
+    """
+    Completes build_result using the output of an earlier successful build with the same cache key, if there is one.
+    :return: True if the build was satisfied from the cache.
+    """
+    try:
+        cached = BuildResult.objects.filter(cache_key=build_result.cache_key, state=BuildResult.STATE_SUCCEEDED)\
+            .exclude(pk=build_result.pk).order_by('-id')[0]
+    except IndexError:
+        return False
+
+    if not build_result.copy_artifacts_from(cached):
+        return False
+
+    build_result.state = BuildResult.STATE_SUCCEEDED
+    build_result.finished = now()
+    build_result.save(update_fields=BUILD_RESULT_FIELDS)
+
+    send_td_event('app_build_succeeded', {
+        'data': {
+            'cloudpebble': {
+                'build_id': build_result.id,
+                'job_run_time': (build_result.finished - build_result.started).total_seconds(),
+                'cached_build_id': cached.id,
+            },
+            'build_time': 0,
+        }
+    }, project=project)
+    return True
+
+
+def _get_simplyjs_runtime_key():
+    """
+    :return: a hash of the Simply.js runtime's files, so that templates are rebuilt when it changes.
+    """
+    global _simplyjs_runtime_key
+    if _simplyjs_runtime_key is None:
+        h = hashlib.sha1(settings.BUILD_CACHE_SALT)
+        for root, dirs, files in os.walk(settings.SIMPLYJS_ROOT, followlinks=True):
+            dirs.sort()
+            for name in sorted(files):
+                st = os.stat(os.path.join(root, name))
+                h.update('%s %d %d\n' % (os.path.relpath(os.path.join(root, name), settings.SIMPLYJS_ROOT),
+                                         st.st_size, st.st_mtime))
+        _simplyjs_runtime_key = h.hexdigest()
+    return _simplyjs_runtime_key
+
+
+def simplyjs_template_manifest(manifest_dict):
+    """
+    :return: manifest_dict with placeholders in place of everything particular to the project.
+    """
+    return dict(manifest_dict, uuid='00000000-0000-4000-8000-000000000000', shortName='Simply.js',
+                longName='Simply.js', companyName='CloudPebble', versionLabel='1.0', capabilities=[''],
+                watchapp={'watchface': False})
+
+
+def _build_simplyjs_template(path, manifest_dict):
+    template_manifest = simplyjs_template_manifest(manifest_dict)
+    with ScratchDir('template') as scratch:
+        link_tree(settings.SIMPLYJS_ROOT, scratch.path, ignore=TEMPLATE_BUILD_STATE)
+        for name, content in (('appinfo.json', json.dumps(template_manifest)),
+                              (os.path.join('src', 'js', 'zzz_userscript.js'),
+                               SIMPLYJS_USER_SCRIPT % SIMPLYJS_SCRIPT_PLACEHOLDER)):
+            break_link(os.path.join(scratch.path, name))
+            with open(os.path.join(scratch.path, name), 'w') as f:
+                f.write(content)
+        environ = os.environ.copy()
+        environ['PATH'] = '{}:{}'.format(settings.ARM_CS_TOOLS, environ['PATH'])
+        run_waf(settings.SDK2_PEBBLE_WAF, scratch.path, environ)
+        pbw = os.path.join(scratch.path, 'build', '%s.pbw' % os.path.basename(scratch.path))
+        # Patching the template into itself checks that it's laid out the way patch_pbw expects.
+        patch_pbw(pbw, path + '.tmp', template_manifest, template_manifest, SIMPLYJS_SCRIPT_PLACEHOLDER,
+                  SIMPLYJS_SCRIPT_PLACEHOLDER)
+        os.rename(path + '.tmp', path)
+
+
+def get_simplyjs_template(manifest_dict):
+    """
+    Finds the PBW built from the Simply.js runtime with placeholder metadata and script, from which every Simply.js
+    project's PBW can be made without compiling anything. It is built the first time it's needed on each worker.
+    :return: the path of the template, or None if there isn't one we can use.
+    """
+    path = os.path.join(scratch_root(), '.simplyjs-template-%s.pbw' % _get_simplyjs_runtime_key())
+    if os.path.exists(path):
+        return path
+    if os.path.exists(path + '.unusable'):
+        return None
+    fd = os.open(path + '.lock', os.O_CREAT | os.O_RDWR, 0600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        if not os.path.exists(path):
+            _build_simplyjs_template(path, manifest_dict)
+        return path
+    except PBWPatchError as e:
+        # This runtime doesn't build PBWs the way we expect, so there's no point trying again.
+        print "Simply.js template can't be patched: %s" % e
+        open(path + '.unusable', 'w').close()
+    except Exception as e:
+        print "Couldn't build a Simply.js template: %s" % e
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+    return None
+
+
+def build_simplyjs_from_template(template_path, build_dir, manifest_dict, escaped_js):
+    """
+    Makes the PBW for a Simply.js project at build_dir/build/<basename>.pbw by patching its metadata and script into
+    the template, without running waf.
+    :return: the build log, or None if the project can't be built that way.
+    """
+    if not os.path.exists(os.path.join(build_dir, 'build')):
+        os.mkdir(os.path.join(build_dir, 'build'))
+    try:
+        patch_pbw(template_path, os.path.join(build_dir, 'build', '%s.pbw' % os.path.basename(build_dir)),
+                  simplyjs_template_manifest(manifest_dict), manifest_dict, SIMPLYJS_SCRIPT_PLACEHOLDER, escaped_js)
+    except PBWPatchError as e:
+        print "Couldn't build from the Simply.js template: %s" % e
+        return None
+    return "Built from the prebuilt Simply.js runtime; nothing needed compiling.\n"
+
+
+def find_js_files(base_dir):
+    """
+    :return: the paths of the JavaScript files that the native wscripts lint and concatenate into pebble-js-app.js,
+    in the order that waf's ant_glob finds them.
+    """
+    def walk(path):
+        for name in sorted(os.listdir(path)):
+            child = os.path.join(path, name)
+            if os.path.isdir(child):
+                for found in walk(child):
+                    yield found
+            elif name.endswith('.js'):
+                yield child
+    src_dir = os.path.join(base_dir, 'src')
+    return list(walk(src_dir)) if os.path.isdir(src_dir) else []
+
+
+def concatenate_js(paths):
+    if not paths:
+        return None
+    contents = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            contents.append(f.read())
+    return ''.join(contents)
+
+
+def can_repackage(project):
+    """
+    :return: True if the project is built with a wscript whose JavaScript can be bundled without waf's help.
+    """
+    return project.project_type == 'native' and (project.sdk_version == '2' or not project.app_modern_multi_js)
+
+
+def pbw_has_concatenated_js(pbw_path, build_dir):
+    """
+    :return: True if the JavaScript in a PBW that waf built is exactly what repackage_build would put there, so that
+    builds can safely be made from it by repackaging.
+    """
+    with zipfile.ZipFile(pbw_path, 'r') as z:
+        try:
+            built_js = z.read('pebble-js-app.js')
+        except KeyError:
+            built_js = None
+    return built_js == concatenate_js(find_js_files(build_dir))
+
+
+def find_repackage_base(project, build_result):
+    """
+    :return: the latest successful build of the project with the same binary cache key, or None.
+    """
+    try:
+        return BuildResult.objects.filter(project=project, binary_cache_key=build_result.binary_cache_key,
+                                          state=BuildResult.STATE_SUCCEEDED)\
+            .exclude(pk=build_result.pk).order_by('-id')[0]
+    except IndexError:
+        return None
+
+
+def lint_js(project, build_dir, paths, environ):
+    """
+    Runs jshint over paths just as the project's wscript would, if the project wants it and jshint is installed.
+    :return: jshint's output. Raises CalledProcessError if linting fails.
+    """
+    jshint = find_executable('jshint', environ['PATH'])
+    if not project.app_jshint or jshint is None or not paths:
+        return ''
+    command = [jshint] + (['--config', 'pebble-jshintrc'] if project.sdk_version == '2' else []) + paths
+    try:
+        return check_output_streaming(command, cwd=build_dir, preexec_fn=_prepare_build_process, env=environ)
+    except subprocess.CalledProcessError as e:
+        e.output = "JavaScript linting failed (you can disable this in Project Settings):\n" + e.output
+        raise
+
+
+def repackage_build(project, base_build, build_dir, manifest_dict, environ):
+    """
+    Makes the PBW for a native project at build_dir/build/<basename>.pbw from the PBW of base_build, an earlier
+    build with the same binaries and resources, with the project's own JavaScript and appinfo.json put in and the
+    binaries' version updated, without running waf.
+    :return: the build log, or None if base_build's PBW can't be reused. Raises CalledProcessError if the
+    JavaScript fails linting.
+    """
+    js_paths = find_js_files(build_dir)
+    output = lint_js(project, build_dir, js_paths, environ)
+    os.mkdir(os.path.join(build_dir, 'build'))
+    old_pbw = os.path.join(build_dir, 'build', 'repackage-base.pbw')
+    try:
+        base_build.read_pbw_to_path(old_pbw)
+        repackage_pbw(old_pbw, os.path.join(build_dir, 'build', '%s.pbw' % os.path.basename(build_dir)),
+                      manifest_dict, concatenate_js(js_paths))
+    except Exception as e:
+        print "Couldn't repackage build %d: %s" % (base_build.id, e)
+        shutil.rmtree(os.path.join(build_dir, 'build'))
+        return None
+    finally:
+        if os.path.exists(old_pbw):
+            os.unlink(old_pbw)
+    return output + "Repackaged the binaries of build %d; nothing needed compiling.\n" % base_build.id
+
+
+@worker_ready.connect
+def _worker_ready(sender=None, **kwargs):
+    if settings.PROJECT_WORKSPACES:
+        start_worker_heartbeat(sender.hostname)
+    if settings.FAIR_BUILD_SCHEDULING:
+        start_dispatch_timer()
+
+
 @task(ignore_result=True, acks_late=True)
-def run_compile(build_result):
-    build_result = BuildResult.objects.get(pk=build_result)
-    project = build_result.project
-    source_files = SourceFile.objects.filter(project=project)
-    resources = ResourceFile.objects.filter(project=project)
+def run_compile(build_result, debug_info=None):
+    """
+    :param debug_info: 'inline' to extract debug info before the build is marked finished, 'deferred' to do it
+    afterwards, or 'skip' not to. Defaults to settings.DEBUG_INFO_MODE.
+    """
+    metrics = BuildMetrics()
+    with metrics.phase('db_fetch'):
+        try:
+            build_result = BuildResult.objects.get(pk=build_result)
+        except BuildResult.DoesNotExist:
+            # Nothing to build, but it may still have been given a place that someone else could use.
+            if settings.FAIR_BUILD_SCHEDULING:
+                release_build_slot(build_result)
+            raise
+    metrics.extra['queue_wait'] = round((now() - build_result.started).total_seconds(), 3)
+    if debug_info not in ('inline', 'deferred', 'skip'):
+        debug_info = settings.DEBUG_INFO_MODE
 
     # Assemble the project somewhere
-    base_dir = tempfile.mkdtemp(dir=os.path.join(settings.CHROOT_ROOT, 'tmp') if settings.CHROOT_ROOT else None)
+    scratch = ScratchDir('build')
+    base_dir = scratch.path
+    workspace = None
+    # Everything the build outputs goes through the stream to a file here, which is saved as the build log.
+    log_scratch = ScratchDir('log')
+    log_stream = BuildLogStream(build_result.id, os.path.join(log_scratch.path, 'build.log'))
+    watcher = CancellationWatcher(build_result.id)
 
     try:
+        # Claim the build before looking at the project, so that anything changed after this gets a build of its own.
+        claim_build(build_result)
+        if settings.CANCEL_SUPERSEDED_BUILDS:
+            watcher.start()
+
+        with metrics.phase('db_fetch'):
+            project = build_result.project
+            source_files = list(SourceFile.objects.filter(project=project))
+            resources = list(ResourceFile.objects.filter(project=project))
+
+        assembly_start = time.time()
+
         # Resources
         resource_root = 'resources'
+        source_transfers = []
+        resource_transfers = []
         os.makedirs(os.path.join(base_dir, resource_root, 'images'))
         os.makedirs(os.path.join(base_dir, resource_root, 'fonts'))
         os.makedirs(os.path.join(base_dir, resource_root, 'data'))
 
         if project.project_type == 'native':
             # Source code
-            create_source_files(project, base_dir)
+            source_transfers = create_source_files(project, base_dir)
 
             manifest_dict = generate_manifest_dict(project, resources)
             open(os.path.join(base_dir, 'appinfo.json'), 'w').write(json.dumps(manifest_dict))
 
             for f in resources:
                 target_dir = os.path.abspath(os.path.join(base_dir, resource_root, ResourceFile.DIR_MAP[f.kind]))
-                abs_target = os.path.abspath(os.path.join(target_dir, f.file_name))
-                f.copy_all_variants_to_dir(target_dir)
+                resource_transfers.extend(f.get_variant_targets(target_dir))
 
             # Reconstitute the SDK
             open(os.path.join(base_dir, 'wscript'), 'w').write(generate_wscript_file(project))
             open(os.path.join(base_dir, 'pebble-jshintrc'), 'w').write(generate_jshint_file(project))
         elif project.project_type == 'simplyjs':
-            shutil.rmtree(base_dir)
-            shutil.copytree(settings.SIMPLYJS_ROOT, base_dir)
+            link_tree(settings.SIMPLYJS_ROOT, base_dir, ignore=TEMPLATE_BUILD_STATE)
             manifest_dict = generate_simplyjs_manifest_dict(project)
 
             js = '\n\n'.join(x.get_contents() for x in source_files if x.file_name.endswith('.js'))
             escaped_js = json.dumps(js)
             build_result.save_simplyjs(js)
 
+            break_link(os.path.join(base_dir, 'appinfo.json'))
             open(os.path.join(base_dir, 'appinfo.json'), 'w').write(json.dumps(manifest_dict))
-            open(os.path.join(base_dir, 'src', 'js', 'zzz_userscript.js'), 'w').write("""
-            (function() {
-                simply.mainScriptSource = %s;
-            })();
-            """ % escaped_js)
+            break_link(os.path.join(base_dir, 'src', 'js', 'zzz_userscript.js'))
+            open(os.path.join(base_dir, 'src', 'js', 'zzz_userscript.js'), 'w').write(SIMPLYJS_USER_SCRIPT % escaped_js)
         elif project.project_type == 'pebblejs':
-            shutil.rmtree(base_dir)
-            shutil.copytree(settings.PEBBLEJS_ROOT, base_dir)
+            link_tree(settings.PEBBLEJS_ROOT, base_dir, ignore=TEMPLATE_BUILD_STATE)
+            # The runtime's own wscript needs our build hooks to share its compiled objects with other projects.
+            wscript_path = os.path.join(base_dir, 'wscript')
+            with open(wscript_path) as f:
+                wscript = f.read()
+            break_link(wscript_path)
+            open(wscript_path, 'w').write(add_build_hooks(wscript, False))
             manifest_dict = generate_pebblejs_manifest_dict(project, resources)
-            create_source_files(project, base_dir)
+            source_transfers = create_source_files(project, base_dir)
 
             for f in resources:
                 if f.kind not in ('png', 'bitmap'):
@@ -161,39 +821,107 @@ def run_compile(build_result):
                 abs_target = os.path.abspath(os.path.join(target_dir, f.file_name))
                 if not abs_target.startswith(target_dir):
                     raise Exception("Suspicious filename: %s" % f.file_name)
-                f.get_default_variant().copy_to_path(abs_target)
+                resource_transfers.append((f.get_default_variant(), abs_target))
+
+            break_link(os.path.join(base_dir, 'appinfo.json'))
+            open(os.path.join(base_dir, 'appinfo.json'), 'w').write(json.dumps(manifest_dict))
 
+        if build_result.partial:
+            # Only build the platforms that were asked for.
+            manifest_dict['targetPlatforms'] = build_result.platform_list
             open(os.path.join(base_dir, 'appinfo.json'), 'w').write(json.dumps(manifest_dict))
 
+        metrics.add_time('assembly', time.time() - assembly_start)
+
+        fetch_start = time.time()
+        fetch_bytes, source_contents = fetch_project_files(source_transfers + resource_transfers,
+                                                           keep=set(path for f, path in source_transfers))
+        fetch_time = time.time() - fetch_start
+        metrics.add_time('fetch', fetch_time)
+        metrics.extra['fetch_bytes'] = fetch_bytes
+        with metrics.phase('preprocessor_check'):
+            check_source_files(source_transfers, source_contents)
+
+        scratch.check_quota()
+
+        # If we've built exactly this before, just reuse the result.
+        if settings.BUILD_CACHE_ENABLED:
+            build_result.cache_key = build_cache_key(project, base_dir)
+            build_result.metrics = metrics.to_json()
+            if restore_cached_build(project, build_result):
+                return
+
+        simplyjs_template = None
+        if project.project_type == 'simplyjs' and project.sdk_version == '2' and settings.SIMPLYJS_TEMPLATE_BUILDS:
+            simplyjs_template = get_simplyjs_template(manifest_dict)
+
+        # If only the JavaScript or the app's version has changed since an earlier build, we can reuse its binaries.
+        repackage_base = None
+        if settings.REPACKAGE_BUILDS and can_repackage(project):
+            build_result.binary_cache_key = binary_cache_key(project, base_dir, manifest_dict)
+            repackage_base = find_repackage_base(project, build_result)
+
+        parallel_platforms = get_parallel_platforms(project, manifest_dict)
+        if parallel_platforms or simplyjs_template or repackage_base:
+            build_dir = base_dir
+        else:
+            build_dir, workspace = acquire_build_dir(project, manifest_dict, base_dir)
+
         # Build the thing
         cwd = os.getcwd()
         success = False
-        output = 'Failed to get output'
+        # Whether waf's output has already gone to the log as it ran.
+        streamed = False
         build_start_time = now()
+        object_cache_log = None
+        repackaged = False
         try:
-            os.chdir(base_dir)
+            os.chdir(build_dir)
             if project.sdk_version == '2':
-                environ = os.environ
-                environ['PATH'] = '{}:{}'.format(settings.ARM_CS_TOOLS, environ['PATH'])
-                command = [settings.SDK2_PEBBLE_WAF, "configure", "build"]
+                waf = settings.SDK2_PEBBLE_WAF
             elif project.sdk_version == '3':
-                environ = os.environ.copy()
-                environ['PATH'] = '{}:{}'.format(settings.ARM_CS_TOOLS, environ['PATH'])
-                command = [settings.SDK3_PEBBLE_WAF, "configure", "build"]
+                waf = settings.SDK3_PEBBLE_WAF
             else:
                 raise Exception("invalid sdk version.")
-            output = subprocess.check_output(command, stderr=subprocess.STDOUT, preexec_fn=_set_resource_limits,
-                                             env=environ)
+            environ = os.environ.copy()
+            environ['PATH'] = '{}:{}'.format(settings.ARM_CS_TOOLS, environ['PATH'])
+            if settings.RESOURCE_CACHE_DIR:
+                environ['CLOUDPEBBLE_RESOURCE_CACHE'] = resource_cache_dir(waf)
+            if settings.PEBBLEJS_RUNTIME_CACHE_DIR and project.project_type == 'pebblejs':
+                environ['CLOUDPEBBLE_RUNTIME_CACHE'] = runtime_cache_dir(waf, project.sdk_version,
+                                                                         manifest_dict.get('targetPlatforms'))
+            prebuilt_output = None
+            if simplyjs_template:
+                with metrics.phase('bundle'):
+                    prebuilt_output = build_simplyjs_from_template(simplyjs_template, build_dir, manifest_dict,
+                                                                   escaped_js)
+            elif repackage_base:
+                with metrics.phase('bundle'):
+                    prebuilt_output = repackage_build(project, repackage_base, build_dir, manifest_dict, environ)
+                repackaged = prebuilt_output is not None
+            if prebuilt_output is not None:
+                log_stream.write(prebuilt_output)
+            elif parallel_platforms:
+                streamed = True
+                build_platforms_in_parallel(project, build_result, base_dir, manifest_dict, parallel_platforms, waf,
+                                            environ, log_stream, watcher, metrics)
+            else:
+                if settings.OBJECT_CACHE_DIR:
+                    object_cache_log = make_object_cache_environ(environ, build_dir)
+                streamed = True
+                run_waf(waf, build_dir, environ, workspace, on_line=log_stream.write_line,
+                        on_start=watcher.register, metrics=metrics)
         except subprocess.CalledProcessError as e:
-            output = e.output
-            print output
+            print e.output
+            if not streamed:
+                log_stream.write(e.output)
             success = False
         except Exception as e:
             success = False
-            output = str(e)
+            log_stream.write(str(e))
         else:
             success = True
-            temp_file = os.path.join(base_dir, 'build', '%s.pbw' % os.path.basename(base_dir))
+            temp_file = os.path.join(build_dir, 'build', '%s.pbw' % os.path.basename(build_dir))
             if not os.path.exists(temp_file):
                 success = False
                 print "Success was a lie."
@@ -201,8 +929,22 @@ def run_compile(build_result):
             build_end_time = now()
             os.chdir(cwd)
 
+            if watcher.cancelled:
+                success = False
+                log_stream.write("\nBuild cancelled: a newer build of this project was requested.\n")
+
+            if object_cache_log is not None:
+                try:
+                    build_result.object_cache_hits, build_result.object_cache_misses = \
+                        count_object_cache_results(object_cache_log)
+                except Exception as e:
+                    print "Couldn't read object cache log: %s" % e
+                finally:
+                    os.unlink(object_cache_log)
+
             if success:
                 # Try reading file sizes out of it first.
+                size_start = time.time()
                 try:
                     s = os.stat(temp_file)
                     build_result.total_size = s.st_size
@@ -214,31 +956,44 @@ def run_compile(build_result):
 
                 except Exception as e:
                     print "Couldn't extract filesizes: %s" % e
+                metrics.add_time('size_extraction', time.time() - size_start)
+
+                if build_result.binary_cache_key and not repackaged:
+                    try:
+                        if not pbw_has_concatenated_js(temp_file, build_dir):
+                            build_result.binary_cache_key = None
+                    except Exception as e:
+                        print "Couldn't check the build's JavaScript: %s" % e
+                        build_result.binary_cache_key = None
 
-                # Try pulling out debug information.
-                if project.sdk_version == '2':
-                    save_debug_info(base_dir, build_result, BuildResult.DEBUG_APP, 'aplite', os.path.join(base_dir, 'build', 'pebble-app.elf'))
-                    save_debug_info(base_dir, build_result, BuildResult.DEBUG_WORKER, 'aplite', os.path.join(base_dir, 'build', 'pebble-worker.elf'))
-                else:
-                    save_debug_info(base_dir, build_result, BuildResult.DEBUG_APP, 'aplite', os.path.join(base_dir, 'build', 'aplite/pebble-app.elf'))
-                    save_debug_info(base_dir, build_result, BuildResult.DEBUG_WORKER, 'aplite', os.path.join(base_dir, 'build', 'aplite/pebble-worker.elf'))
-                    save_debug_info(base_dir, build_result, BuildResult.DEBUG_APP, 'basalt', os.path.join(base_dir, 'build', 'basalt/pebble-app.elf'))
-                    save_debug_info(base_dir, build_result, BuildResult.DEBUG_WORKER, 'basalt', os.path.join(base_dir, 'build', 'basalt/pebble-worker.elf'))
-                    save_debug_info(base_dir, build_result, BuildResult.DEBUG_APP, 'chalk', os.path.join(base_dir, 'build', 'chalk/pebble-app.elf'))
-                    save_debug_info(base_dir, build_result, BuildResult.DEBUG_WORKER, 'chalk', os.path.join(base_dir, 'build', 'chalk/pebble-worker.elf'))
-
-
-                build_result.save_pbw(temp_file)
-            build_result.save_build_log(output)
+                # Try pulling out debug information, unless we're leaving that until the build is marked finished.
+                if repackaged:
+                    with metrics.phase('debug_info'):
+                        build_result.copy_debug_info_from(repackage_base)
+                elif debug_info == 'inline':
+                    with metrics.phase('debug_info'):
+                        save_debug_info(project, build_result, build_dir)
+
+                with metrics.phase('artifact_upload'):
+                    build_result.save_pbw(temp_file)
+            with metrics.phase('log_upload'):
+                log_stream.flush()
+                build_result.save_build_log_file(log_stream.sink_path)
             build_result.state = BuildResult.STATE_SUCCEEDED if success else BuildResult.STATE_FAILED
             build_result.finished = now()
-            build_result.save()
+            build_result.metrics = metrics.to_json()
+            build_result.save(update_fields=BUILD_RESULT_FIELDS)
 
             data = {
                 'data': {
                     'cloudpebble': {
                         'build_id': build_result.id,
                         'job_run_time': (build_result.finished - build_result.started).total_seconds(),
+                        'object_cache_hits': build_result.object_cache_hits,
+                        'object_cache_misses': build_result.object_cache_misses,
+                        'fetch_time': fetch_time,
+                        'fetch_bytes': fetch_bytes,
+                        'metrics': metrics.as_dict(),
                     },
                     'build_time': (build_end_time - build_start_time).total_seconds(),
                 }
@@ -248,16 +1003,77 @@ def run_compile(build_result):
 
             send_td_event(event_name, data, project=project)
 
+            if success and debug_info == 'deferred' and not repackaged:
+                with metrics.phase('debug_info'):
+                    save_debug_info(project, build_result, build_dir)
+                build_result.metrics = metrics.to_json()
+                build_result.save(update_fields=['metrics'])
+
     except Exception as e:
         print "Build failed due to internal error: %s" % e
         traceback.print_exc()
         build_result.state = BuildResult.STATE_FAILED
         build_result.finished = now()
+        build_result.metrics = metrics.to_json()
         try:
             build_result.save_build_log("Something broke:\n%s" % e)
         except:
             pass
-        build_result.save()
+        build_result.save(update_fields=BUILD_RESULT_FIELDS)
     finally:
-        # shutil.rmtree(base_dir)
-        print base_dir
\ No newline at end of file
+        watcher.stop()
+        try:
+            release_build(build_result)
+        except Exception as e:
+            print "Couldn't release build: %s" % e
+        if build_result.state != BuildResult.STATE_WAITING:
+            try:
+                record_build_stats(build_result)
+            except Exception as e:
+                print "Couldn't record build stats: %s" % e
+        if build_result.state == BuildResult.STATE_SUCCEEDED:
+            try:
+                record_build_duration(build_result, len(source_files))
+            except Exception as e:
+                print "Couldn't record build duration: %s" % e
+        if workspace is not None:
+            workspace.release()
+        if settings.PROJECT_WORKSPACES:
+            try:
+                if run_compile.request.hostname:
+                    record_affinity(build_result.project_id, run_compile.request.hostname)
+                evict_project_workspaces(settings.PROJECT_WORKSPACE_DISK_BUDGET)
+            except Exception as e:
+                print "Couldn't tidy up project workspaces: %s" % e
+        if settings.RESOURCE_CACHE_DIR:
+            try:
+                prune_resource_cache(settings.RESOURCE_CACHE_DISK_BUDGET)
+            except Exception as e:
+                print "Couldn't prune the resource cache: %s" % e
+        if settings.PEBBLEJS_RUNTIME_CACHE_DIR:
+            try:
+                prune_runtime_cache(settings.PEBBLEJS_RUNTIME_CACHE_DISK_BUDGET)
+            except Exception as e:
+                print "Couldn't prune the runtime cache: %s" % e
+        try:
+            log_stream.finish()
+        except Exception as e:
+            print "Couldn't finish build log stream: %s" % e
+        try:
+            scratch.remove()
+        except Exception as e:
+            print "Couldn't remove %s: %s" % (base_dir, e)
+        try:
+            log_scratch.remove()
+        except Exception as e:
+            print "Couldn't remove %s: %s" % (log_scratch.path, e)
+
+
+@task(ignore_result=True, acks_late=True)
+def run_speculative_compile(project_id, token):
+    """
+    Builds the project as it is now, unless another speculative build of it was requested after this one.
+    """
+    build_result = start_speculative_build(project_id, token, run_speculative_compile.request.id)
+    if build_result is not None:
+        run_compile(build_result.id)
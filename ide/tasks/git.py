@@ -8,9 +8,9 @@ from django.utils.timezone import now
 from github.GithubObject import NotSet
 from github import Github, GithubException, InputGitTreeElement
 from ide.git import git_auth_check, get_github
-from ide.models.build import BuildResult
 from ide.models.project import Project
-from ide.tasks import do_import_archive, run_compile
+from ide.tasks import do_import_archive
+from ide.utils.build_scheduler import schedule_build, BuildRejected
 from ide.utils.git import git_sha, git_blob
 from ide.utils.project import find_project_root
 from ide.utils.sdk import generate_manifest_dict, generate_manifest, generate_wscript_file
@@ -321,8 +321,11 @@ def hooked_commit(project_id, target_commit):
         did_something = True
 
     if project.github_hook_build:
-        build = BuildResult.objects.create(project=project)
-        run_compile(build.id)
-        did_something = True
+        try:
+            schedule_build(project)
+        except BuildRejected as e:
+            print "Not building %s at %s: %s" % (project.github_repo, target_commit, e)
+        else:
+            did_something = True
 
     return did_something
@@ -2,8 +2,41 @@
 Tests in this file can be run with run_tests.py
 """
 
+import datetime
+import json
+import os
+import re
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import unittest
+import uuid
+import zipfile
+import zlib
+from array import array
+
+import fakeredis
+import redis
+from django.conf import settings
 from django.test import TestCase
+from django.test.utils import override_settings
 import git
+from apptools import addr2lines, symbols
+from ide.models.build import BuildResult
+from ide.tasks import build as build_tasks
+from ide.utils import build_estimates, build_scheduler, build_stats, log_stream, prepreprocessor, scratch
+from ide.utils.build_cache import build_cache_key, binary_cache_key
+from ide.utils.resource_cache import runtime_cache_dir
+from ide.utils.sdk import BUILD_HOOKS
+from ide.utils.pbw import stm32_crc, patch_pbw, repackage_pbw, PBWPatchError
+from ide.utils.workspaces import sync_tree, workspace_pool_key, acquire_pooled_workspace, acquire_project_workspace
+from ide.utils.workspaces import evict_project_workspaces, WAF_CONFIGURE_STATE
 
 
 class UrlToReposTest(TestCase):
@@ -28,3 +61,1407 @@ class UrlToReposTest(TestCase):
         Tests that a entirely different url returns None.
         """
         self.assertEqual(None, git.url_to_repo("http://www.cuteoverload.com"))
+
+
+def _old_extract_includes(source):
+    """
+    The include check as it was before it became a single scan, to compare the current one against.
+    """
+    source = re.sub(r'\r\n|\r|\n', '\n', source).replace('\\\n', '')
+    source = re.sub(r'/\*.*?\*/', ' ', source, flags=re.DOTALL | re.MULTILINE)
+    source = re.sub(r'//.*$', ' ', source, flags=re.MULTILINE)
+    return re.findall(r'^#\s*include\s*[<"](.+)[">]\s*$', source, flags=re.MULTILINE)
+
+
+class PrepreprocessorTest(TestCase):
+    ORDINARY_SOURCES = [
+        '#include <pebble.h>\n\nint main(void) {\n  return 0;\n}\n',
+        '#include "a.h"\r\n#include "b/c.h"\r\n',
+        '#include <pebble.h>\n/* #include "commented.h" */\n// #include "also_commented.h"\n#include "real.h"\n',
+        '#  include <spaced.h>\n#include"tight.h"\n',
+        '#include \\\n"continued.h"\n',
+        '/* a comment\n * over several lines\n */\n#include "after.h"\nstatic int x = 1 / 2;\n',
+        'char *s = "no include here";\nchar c = \'#\';\n',
+        '',
+    ]
+
+    def test_matches_old_implementation(self):
+        """
+        Tests that ordinary sources have the same includes found in them as they did before.
+        """
+        for source in self.ORDINARY_SOURCES:
+            self.assertEqual(_old_extract_includes(source), prepreprocessor.extract_includes(source))
+
+    def test_comments(self):
+        """
+        Tests that directives inside comments are ignored, and that comments before a directive don't hide it.
+        """
+        source = ('/*\n#include "block.h"\n*/\n'
+                  '// #include "line.h"\n'
+                  '/* before */ #include "found.h"\n'
+                  '#include /* between */ "also_found.h"\n'
+                  '// continued \\\n#include "continued_comment.h"\n')
+        self.assertEqual(['found.h', 'also_found.h'], prepreprocessor.extract_includes(source))
+
+    def test_strings(self):
+        """
+        Tests that directives inside string and character literals are ignored, and that a // inside a string
+        doesn't hide what comes after it.
+        """
+        source = ('char *a = "\\n#include \\"in_string.h\\"";\n'
+                  'char *b = "http://example.com"; /*\n#include "in_comment.h"\n*/\n'
+                  'char c = \'"\';\n'
+                  '#include "found.h"\n')
+        self.assertEqual(['found.h'], prepreprocessor.extract_includes(source))
+
+    def test_other_directive_forms(self):
+        """
+        Tests that indented directives, the %: digraph, #include_next and #import are all found.
+        """
+        source = '  #include "indented.h"\n%:include "digraph.h"\n#include_next <next.h>\n#import "imported.h"\n'
+        self.assertEqual(['indented.h', 'digraph.h', 'next.h', 'imported.h'],
+                         prepreprocessor.extract_includes(source))
+
+    def test_include_rejected(self):
+        """
+        Tests that includes of files outside the project are rejected, however they're written.
+        """
+        for source in ['#include "../../../etc/passwd"\n',
+                       '  #include </etc/passwd>\n',
+                       '/* hidden? */ #include "../../../etc/passwd"\n',
+                       '#include "../../../\\\netc/passwd"\n',
+                       '%:include "../../../etc/passwd"\n']:
+            with self.assertRaises(Exception):
+                prepreprocessor.process_file('/tmp/project', 'src', source)
+
+    def test_include_allowed(self):
+        """
+        Tests that includes of files inside the project are allowed.
+        """
+        prepreprocessor.process_file('/tmp/project', 'src', '#include <pebble.h>\n#include "../include/foo.h"\n')
+
+    def test_cache_distinguishes_sources(self):
+        """
+        Tests that sources differing only slightly don't share cached includes.
+        """
+        prepreprocessor.process_file('/tmp/project', 'src', '#include "safe.h"\n')
+        with self.assertRaises(Exception):
+            prepreprocessor.process_file('/tmp/project', 'src', '#include "../../safe.h"\n')
+        prepreprocessor.process_file('/tmp/project', 'src', '// #include "../../safe.h"\n')
+        with self.assertRaises(Exception):
+            prepreprocessor.process_file('/tmp/project', 'src', '#include "../../safe.h"\n')
+
+    def test_cache_checks_each_target(self):
+        """
+        Tests that a source whose includes are cached is still checked against the directory it's being built in.
+        """
+        source = '#include "../../lib.h"\n'
+        prepreprocessor.process_file('/tmp/project', 'src/a/b', source)
+        with self.assertRaises(Exception):
+            prepreprocessor.process_file('/tmp/project', 'src', source)
+
+
+def _mpeg2_crc(data):
+    """
+    CRC-32/MPEG-2, worked out a bit at a time.
+    """
+    crc = 0xffffffff
+    for char in data:
+        crc ^= ord(char) << 24
+        for i in xrange(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) & 0xffffffff if crc & 0x80000000 else (crc << 1) & 0xffffffff
+    return crc
+
+
+def _app_manifest(name, company, version, app_uuid, watchface=False):
+    return {'shortName': name, 'companyName': company, 'versionLabel': version, 'uuid': app_uuid,
+            'watchapp': {'watchface': watchface}}
+
+
+def _app_binary(manifest_dict):
+    """
+    :return: a pebble-app.bin whose header has what the SDK's inject_metadata would have put there for manifest_dict.
+    """
+    binary = bytearray('\xaa' * 256)
+    major, minor = manifest_dict['versionLabel'].split('.')
+    struct.pack_into('<BB', binary, 12, int(major), int(minor))
+    struct.pack_into('<32s', binary, 24, str(manifest_dict['shortName']))
+    struct.pack_into('<32s', binary, 56, str(manifest_dict['companyName']))
+    struct.pack_into('<I', binary, 96, 0x10 | (1 if manifest_dict['watchapp']['watchface'] else 0))
+    binary[104:120] = uuid.UUID(manifest_dict['uuid']).bytes
+    return str(binary)
+
+
+class PBWTest(TestCase):
+    TEMPLATE_UUID = '00000000-0000-0000-0000-000000000001'
+    APP_UUID = '12345678-1234-5678-1234-567812345678'
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.template_manifest = _app_manifest('Template', 'Pebble', '1.0', self.TEMPLATE_UUID)
+        self.binary = _app_binary(self.template_manifest)
+        self.template_path = self.make_pbw('template.pbw', self.template_manifest, self.binary,
+                                           'var x = 1;\n/*PLACEHOLDER*/\n')
+        self.dest_path = os.path.join(self.tmp, 'dest.pbw')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_pbw(self, name, manifest_dict, binary, js=None, crc=None):
+        path = os.path.join(self.tmp, name)
+        with zipfile.ZipFile(path, 'w') as z:
+            z.writestr('manifest.json', json.dumps({'application': {
+                'name': 'pebble-app.bin', 'crc': stm32_crc(binary) if crc is None else crc}}))
+            z.writestr('appinfo.json', json.dumps(manifest_dict))
+            z.writestr('pebble-app.bin', binary)
+            if js is not None:
+                z.writestr('pebble-js-app.js', js)
+        return path
+
+    def test_crc(self):
+        """
+        Tests the CRC of word-aligned data against CRC-32/MPEG-2 of the same words in big-endian order.
+        """
+        self.assertEqual(0x0376E6E7, _mpeg2_crc('123456789'))
+        for data in ['', '\0\0\0\0', '4321', 'abcdefgh' * 33, ''.join(chr(i) for i in xrange(256))]:
+            words = ''.join(data[i:i + 4][::-1] for i in xrange(0, len(data), 4))
+            self.assertEqual(_mpeg2_crc(words), stm32_crc(data))
+
+    def test_patch_pbw(self):
+        """
+        Tests that patching rewrites the binary's header and JavaScript, and recomputes the binary's CRC.
+        """
+        manifest_dict = _app_manifest('My App', 'Someone', '2.3', self.APP_UUID, watchface=True)
+        patch_pbw(self.template_path, self.dest_path, self.template_manifest, manifest_dict, '/*PLACEHOLDER*/',
+                  'doThings();')
+        with zipfile.ZipFile(self.dest_path) as z:
+            binary = z.read('pebble-app.bin')
+            self.assertEqual(_app_binary(manifest_dict), binary)
+            self.assertEqual(stm32_crc(binary), json.loads(z.read('manifest.json'))['application']['crc'])
+            self.assertEqual(manifest_dict, json.loads(z.read('appinfo.json')))
+            self.assertEqual('var x = 1;\ndoThings();\n', z.read('pebble-js-app.js'))
+
+    def test_patch_pbw_bad_crc(self):
+        """
+        Tests that a template whose manifest doesn't match its binary is refused.
+        """
+        path = self.make_pbw('bad.pbw', self.template_manifest, self.binary, '/*PLACEHOLDER*/',
+                             crc=stm32_crc(self.binary) ^ 1)
+        manifest_dict = _app_manifest('My App', 'Someone', '2.3', self.APP_UUID)
+        with self.assertRaises(PBWPatchError):
+            patch_pbw(path, self.dest_path, self.template_manifest, manifest_dict, '/*PLACEHOLDER*/', '')
+        self.assertFalse(os.path.exists(self.dest_path))
+
+    def test_patch_pbw_wrong_metadata(self):
+        """
+        Tests that a template whose binary doesn't have the template's metadata in its header is refused.
+        """
+        manifest_dict = _app_manifest('My App', 'Someone', '2.3', self.APP_UUID)
+        wrong_template = _app_manifest('Template', 'Pebble', '1.1', self.TEMPLATE_UUID)
+        with self.assertRaises(PBWPatchError):
+            patch_pbw(self.template_path, self.dest_path, wrong_template, manifest_dict, '/*PLACEHOLDER*/', '')
+
+    def test_patch_pbw_long_name(self):
+        """
+        Tests that a name too long for the header is refused rather than truncated.
+        """
+        manifest_dict = _app_manifest('x' * 32, 'Someone', '2.3', self.APP_UUID)
+        with self.assertRaises(PBWPatchError):
+            patch_pbw(self.template_path, self.dest_path, self.template_manifest, manifest_dict, '/*PLACEHOLDER*/',
+                      '')
+
+    def test_repackage_pbw(self):
+        """
+        Tests that repackaging changes only the version in the binary's header, and recomputes its CRC.
+        """
+        manifest_dict = dict(self.template_manifest, versionLabel='4.5')
+        repackage_pbw(self.template_path, self.dest_path, manifest_dict, 'newScript();')
+        with zipfile.ZipFile(self.dest_path) as z:
+            binary = z.read('pebble-app.bin')
+            self.assertEqual(self.binary[:12] + '\x04\x05' + self.binary[14:], binary)
+            self.assertEqual(stm32_crc(binary), json.loads(z.read('manifest.json'))['application']['crc'])
+            self.assertEqual('newScript();', z.read('pebble-js-app.js'))
+
+    def test_repackage_pbw_cant_add_js(self):
+        """
+        Tests that a PBW without JavaScript can't be repackaged with some.
+        """
+        path = self.make_pbw('no_js.pbw', self.template_manifest, self.binary)
+        with self.assertRaises(PBWPatchError):
+            repackage_pbw(path, self.dest_path, self.template_manifest, 'newScript();')
+
+
+class SymbolsTest(TestCase):
+    INFO = {
+        'files': ['src/main.c', u'src/\u00fcber.c', 'build/../src/worker.c'],
+        'lines': [
+            (0x200, 0, 10),
+            (0x80, 1, 1000),
+            (0x84, 1, 3),
+            (0x10000000, 2, 7),
+            (0x204, 0, 9),
+        ],
+        'functions': [
+            (0x200, 0x210, 'main', 8),
+            (0x80, 0x90, u'\u00fcber', None),
+            (0x10000000, 0x10000020, 'worker_main', 0),
+        ],
+    }
+
+    def test_uleb128(self):
+        """
+        Tests that integers on either side of each byte boundary survive encoding and decoding.
+        """
+        values = [0, 1, 127, 128, 255, 16383, 16384, 2 ** 32 - 1, 2 ** 32, 2 ** 63]
+        out = array('B')
+        for value in values:
+            symbols._write_uleb128(out, value)
+        self.assertEqual(1 + 1 + 1 + 2 + 2 + 2 + 3 + 5 + 5 + 10, len(out))
+        self.assertEqual(values, symbols._Reader(out.tostring()).column(len(values)))
+
+    def test_zigzag(self):
+        """
+        Tests that signed integers are interleaved with the non-negative ones, and survive the round trip.
+        """
+        self.assertEqual([0, 1, 2, 3, 4], [symbols._zigzag(x) for x in [0, -1, 1, -2, 2]])
+        for value in range(-300, 300) + [-2 ** 40, 2 ** 40]:
+            self.assertEqual(value, symbols._unzigzag(symbols._zigzag(value)))
+
+    def test_round_trip(self):
+        """
+        Tests that packed debug info unpacks to the same table as the dict it was packed from.
+        """
+        packed = symbols.SymbolTable.from_packed(symbols.pack_debug_info(self.INFO))
+        expected = symbols.SymbolTable.from_dict(self.INFO)
+        for field in ('files', 'line_addresses', 'line_files', 'line_numbers', 'function_starts',
+                      'function_ends', 'function_names', 'function_lines'):
+            self.assertEqual(list(getattr(expected, field)), list(getattr(packed, field)))
+        for address in [0, 0x7f, 0x80, 0x86, 0x90, 0x91, 0x1ff, 0x206, 0x210, 0x10000010, 0x10000021]:
+            self.assertEqual(expected.lookup(address), packed.lookup(address))
+
+    def test_bad_data(self):
+        """
+        Tests that anything but intact compact debug info is refused.
+        """
+        packed = symbols.pack_debug_info(self.INFO)
+        for data in ['', '{"files": []}', packed[:4] + chr(symbols.VERSION + 1) + packed[5:], packed[:-4]]:
+            with self.assertRaises(symbols.SymbolFormatError):
+                symbols.SymbolTable.from_packed(data)
+
+    def test_function_ends_before_start(self):
+        """
+        Tests that a function ending before it starts is refused, rather than packed as a huge one.
+        """
+        info = dict(self.INFO, functions=[(0x10000000, 0x20, 'worker_main', 0)])
+        with self.assertRaises(ValueError):
+            symbols.pack_debug_info(info)
+
+    def test_version_1(self):
+        """
+        Tests that debug info packed before function lengths stopped being zigzag-encoded can still be read.
+        """
+        body = array('B', [1, 3] + [ord(c) for c in 'a.c'] +
+                          [1, 0x10, 0, symbols._zigzag(5)] +
+                          [1, 0x10, symbols._zigzag(8), 6, 4] + [ord(c) for c in 'main'])
+        table = symbols.SymbolTable.from_packed(symbols.MAGIC + chr(1) + zlib.compress(body.tostring()))
+        self.assertEqual([0x18], list(table.function_ends))
+        self.assertEqual({'file': 'a.c', 'line': 5, 'fn_name': 'main', 'fn_line': 5}, table.lookup(0x14))
+
+
+def _find_tool(name):
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(path, name), os.X_OK):
+            return os.path.join(path, name)
+    return None
+
+
+@unittest.skipIf(_find_tool('gcc') is None or _find_tool('objdump') is None, "needs gcc and objdump")
+class DWARFReaderTest(TestCase):
+    SOURCE = (
+        'static int twice(int x)\n'
+        '{\n'
+        '    return x * 2;\n'
+        '}\n'
+        '\n'
+        'int main(void)\n'
+        '{\n'
+        '    return twice(3);\n'
+        '}\n'
+    )
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        # The objdump reader runs arm-none-eabi-objdump from ARM_CS_TOOLS; this machine's own will do for its ELFs.
+        os.symlink(_find_tool('objdump'), os.path.join(self.dir, 'arm-none-eabi-objdump'))
+        self.old_tools = addr2lines.ARM_CS_TOOLS
+        addr2lines.ARM_CS_TOOLS = self.dir + '/'
+        write_file(self.dir, 'main.c', self.SOURCE)
+
+    def tearDown(self):
+        addr2lines.ARM_CS_TOOLS = self.old_tools
+        shutil.rmtree(self.dir)
+
+    def compile(self, dwarf_version):
+        elf = os.path.join(self.dir, 'dwarf%d.elf' % dwarf_version)
+        subprocess.check_call(['gcc', '-gdwarf-%d' % dwarf_version, '-O0', '-nostdlib', '-Wl,-e,main', '-o', elf,
+                               os.path.join(self.dir, 'main.c')])
+        return elf
+
+    def read_functions(self, elf):
+        reader = addr2lines.FunctionReader(elf)
+        native = [(x.name, x.start, x.end, x.line) for x in reader.get_native_info_groups()]
+        objdump = [(x.name, x.start, x.end, x.line) for x in reader.iter_objdump_info_groups()]
+        return native, objdump
+
+    def test_readers_agree(self):
+        """
+        Tests that both function readers report each function's end address, whichever way its DWARF gives it.
+        """
+        for dwarf_version in (2, 3, 4):
+            native, objdump = self.read_functions(self.compile(dwarf_version))
+            self.assertEqual(sorted(native), sorted(objdump))
+            self.assertEqual(['main', 'twice'], sorted(name for name, start, end, line in native))
+            for name, start, end, line in native:
+                self.assertTrue(start < end < start + 0x100)
+
+
+def write_file(root, path, contents, mtime=None):
+    path = os.path.join(root, path)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(contents)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+class SyncTreeTest(TestCase):
+    def setUp(self):
+        self.src = tempfile.mkdtemp()
+        self.dest = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.src)
+        shutil.rmtree(self.dest)
+
+    def write(self, root, path, contents, mtime=None):
+        write_file(root, path, contents, mtime)
+
+    def read(self, root, path):
+        with open(os.path.join(root, path)) as f:
+            return f.read()
+
+    def test_copies_new_and_changed_files(self):
+        """
+        Tests that files missing from dest or different there are copied over, mtime and all.
+        """
+        self.write(self.src, 'src/main.c', 'new', mtime=1000000000)
+        self.write(self.src, 'wscript', 'script', mtime=1000000000)
+        self.write(self.dest, 'src/main.c', 'old', mtime=900000000)
+        sync_tree(self.src, self.dest)
+        self.assertEqual('new', self.read(self.dest, 'src/main.c'))
+        self.assertEqual('script', self.read(self.dest, 'wscript'))
+        self.assertEqual(1000000000, os.stat(os.path.join(self.dest, 'wscript')).st_mtime)
+
+    def test_keeps_mtime_of_unchanged_files(self):
+        """
+        Tests that a file with the same contents is left alone, even though its source is newer.
+        """
+        self.write(self.src, 'src/main.c', 'same', mtime=2000000000)
+        self.write(self.dest, 'src/main.c', 'same', mtime=1000000000)
+        sync_tree(self.src, self.dest)
+        self.assertEqual(1000000000, os.stat(os.path.join(self.dest, 'src/main.c')).st_mtime)
+
+    def test_deletes_extra_files(self):
+        """
+        Tests that files and directories that aren't in src are deleted, unless they're preserved.
+        """
+        self.write(self.src, 'src/main.c', 'main')
+        self.write(self.dest, 'src/main.c', 'main')
+        self.write(self.dest, 'src/deleted.c', 'gone')
+        self.write(self.dest, 'resources/images/gone.png', 'gone')
+        self.write(self.dest, '.lock-waf', 'kept')
+        self.write(self.dest, 'build/c4che/_cache.py', 'kept')
+        self.write(self.dest, 'build/src/main.c.1.o', 'gone')
+        sync_tree(self.src, self.dest, preserve=WAF_CONFIGURE_STATE)
+        self.assertFalse(os.path.exists(os.path.join(self.dest, 'src/deleted.c')))
+        self.assertFalse(os.path.exists(os.path.join(self.dest, 'resources')))
+        self.assertFalse(os.path.exists(os.path.join(self.dest, 'build/src')))
+        self.assertEqual('kept', self.read(self.dest, '.lock-waf'))
+        self.assertEqual('kept', self.read(self.dest, 'build/c4che/_cache.py'))
+        self.assertEqual('main', self.read(self.dest, 'src/main.c'))
+
+    def test_replaces_files_with_directories(self):
+        """
+        Tests that a file in dest where src has a directory, or a directory where src has a file, is replaced.
+        """
+        self.write(self.src, 'src/main.c', 'main')
+        self.write(self.src, 'include', 'file')
+        self.write(self.dest, 'src', 'file')
+        self.write(self.dest, 'include/header.h', 'header')
+        sync_tree(self.src, self.dest)
+        self.assertEqual('main', self.read(self.dest, 'src/main.c'))
+        self.assertEqual('file', self.read(self.dest, 'include'))
+
+
+class WorkspaceTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.src = tempfile.mkdtemp()
+        self.settings = override_settings(BUILD_WORKSPACE_ROOT=self.root, BUILD_WORKSPACE_POOL_SIZE=2)
+        self.settings.enable()
+        self.workspaces = []
+
+    def tearDown(self):
+        for workspace in self.workspaces:
+            workspace.release()
+        self.settings.disable()
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.src)
+
+    def hold(self, workspace):
+        if workspace is not None:
+            self.workspaces.append(workspace)
+        return workspace
+
+    def test_pool_key(self):
+        """
+        Tests that projects only share pooled workspaces if they'd be configured the same way.
+        """
+        native = _FakeProject()
+        self.assertEqual(workspace_pool_key(native, {'targetPlatforms': ['basalt', 'aplite']}),
+                         workspace_pool_key(native, {'targetPlatforms': ['aplite', 'basalt']}))
+        self.assertEqual('native-3-default', workspace_pool_key(native, {}))
+        keys = set([workspace_pool_key(native, {'targetPlatforms': ['aplite']}),
+                    workspace_pool_key(native, {'targetPlatforms': ['aplite', 'basalt']}),
+                    workspace_pool_key(_FakeProject(sdk_version='2'), {'targetPlatforms': ['aplite']}),
+                    workspace_pool_key(_FakeProject(project_type='pebblejs'), {'targetPlatforms': ['aplite']})])
+        self.assertEqual(4, len(keys))
+
+    def test_pool_locking(self):
+        """
+        Tests that each pooled workspace is only handed to one build at a time, and to the next once it's released.
+        """
+        first = self.hold(acquire_pooled_workspace('key'))
+        second = self.hold(acquire_pooled_workspace('key'))
+        self.assertNotEqual(first.path, second.path)
+        self.assertIsNone(acquire_pooled_workspace('key'))
+        self.assertIsNotNone(self.hold(acquire_pooled_workspace('other')))
+        second.release()
+        self.assertEqual(second.path, self.hold(acquire_pooled_workspace('key')).path)
+
+    def test_pool_keeps_configuration_only(self):
+        """
+        Tests that a pooled workspace keeps waf's configuration between builds, but not its outputs.
+        """
+        workspace = self.hold(acquire_pooled_workspace('key'))
+        write_file(workspace.path, 'build/c4che/_cache.py', 'config')
+        write_file(workspace.path, 'build/basalt/pebble-app.elf', 'elf')
+        write_file(workspace.path, 'src/other.c', 'other project')
+        write_file(self.src, 'src/main.c', 'main')
+        workspace.sync_from(self.src)
+        self.assertTrue(workspace.is_configured())
+        self.assertFalse(os.path.exists(os.path.join(workspace.path, 'build/basalt')))
+        self.assertFalse(os.path.exists(os.path.join(workspace.path, 'src/other.c')))
+        self.assertTrue(os.path.exists(os.path.join(workspace.path, 'src/main.c')))
+
+    def test_project_workspace_locking(self):
+        """
+        Tests that a project's workspace is only used by one build at a time.
+        """
+        workspace = self.hold(acquire_project_workspace('1', 'key'))
+        self.assertIsNone(acquire_project_workspace('1', 'key'))
+        self.assertIsNotNone(self.hold(acquire_project_workspace('2', 'key')))
+        workspace.release()
+        self.assertEqual(workspace.path, self.hold(acquire_project_workspace('1', 'key')).path)
+
+    def test_project_workspace_keeps_outputs(self):
+        """
+        Tests that a project's workspace keeps waf's outputs between builds, apart from the final ones, and throws
+        them away if it's configured differently.
+        """
+        workspace = acquire_project_workspace('1', 'key')
+        write_file(workspace.path, 'build/c4che/_cache.py', 'config')
+        write_file(workspace.path, 'build/src/main.c.16.o', 'object')
+        write_file(workspace.path, 'build/basalt/pebble-app.elf', 'elf')
+        write_file(workspace.path, 'build/1.pbw', 'pbw')
+        write_file(self.src, 'src/main.c', 'main')
+        workspace.sync_from(self.src)
+        self.assertTrue(os.path.exists(os.path.join(workspace.path, 'build/src/main.c.16.o')))
+        self.assertFalse(os.path.exists(os.path.join(workspace.path, 'build/basalt/pebble-app.elf')))
+        self.assertFalse(os.path.exists(os.path.join(workspace.path, 'build/1.pbw')))
+        workspace.release()
+
+        workspace = self.hold(acquire_project_workspace('1', 'other key'))
+        self.assertFalse(workspace.is_configured())
+        self.assertFalse(os.path.exists(os.path.join(workspace.path, 'build/src/main.c.16.o')))
+
+    def make_project_workspace(self, name, size, last_used):
+        workspace = acquire_project_workspace(name, 'key')
+        write_file(workspace.path, 'src/main.c', 'x' * size)
+        workspace.release()
+        os.utime(workspace.path + '.lock', (last_used, last_used))
+        with open(workspace.path + '.size') as f:
+            return int(f.read())
+
+    def test_eviction(self):
+        """
+        Tests that the least recently used workspaces are evicted until the rest fit, skipping any in use.
+        """
+        size = self.make_project_workspace('1', 10000, 1000000000)
+        self.make_project_workspace('2', 10000, 1000000100)
+        self.make_project_workspace('3', 10000, 1000000200)
+        self.make_project_workspace('4', 10000, 1000000300)
+        in_use = self.hold(acquire_project_workspace('1', 'key'))
+        os.utime(in_use.path + '.lock', (1000000000, 1000000000))
+        evict_project_workspaces(size * 2)
+        projects = os.path.join(self.root, 'projects')
+        self.assertEqual([True, False, False, True], [os.path.exists(os.path.join(projects, name))
+                                                      for name in ('1', '2', '3', '4')])
+        self.assertFalse(os.path.exists(os.path.join(projects, '2.size')))
+        self.assertTrue(os.path.exists(os.path.join(projects, '2.lock')))
+        self.assertIsNotNone(self.hold(acquire_project_workspace('2', 'key')))
+
+
+class _FakeProject(object):
+    def __init__(self, project_type='native', sdk_version='3'):
+        self.project_type = project_type
+        self.sdk_version = sdk_version
+
+
+@override_settings(SDK2_PEBBLE_WAF='/sdk2/pebble/waf', SDK3_PEBBLE_WAF='/sdk3/pebble/waf', BUILD_CACHE_SALT='')
+class BuildCacheKeyTest(TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.project = _FakeProject()
+        write_file(self.base_dir, 'appinfo.json', json.dumps({'targetPlatforms': ['aplite', 'basalt']}))
+        write_file(self.base_dir, 'wscript', 'script')
+        write_file(self.base_dir, 'src/main.c', 'main')
+        write_file(self.base_dir, 'src/js/app.js', 'app')
+        write_file(self.base_dir, 'resources/images/icon.png', 'icon')
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def assertKeyChanges(self, path, contents):
+        before = build_cache_key(self.project, self.base_dir)
+        write_file(self.base_dir, path, contents)
+        self.assertNotEqual(before, build_cache_key(self.project, self.base_dir))
+
+    def test_stable(self):
+        """
+        Tests that the same project assembled twice has the same key, whatever the files' mtimes.
+        """
+        other_dir = tempfile.mkdtemp()
+        try:
+            sync_tree(self.base_dir, other_dir)
+            os.utime(os.path.join(other_dir, 'src/main.c'), (1000000000, 1000000000))
+            self.assertEqual(build_cache_key(self.project, self.base_dir), build_cache_key(self.project, other_dir))
+        finally:
+            shutil.rmtree(other_dir)
+
+    def test_source_changes(self):
+        """
+        Tests that changing, adding or renaming any file changes the key.
+        """
+        self.assertKeyChanges('src/main.c', 'changed')
+        self.assertKeyChanges('src/js/app.js', 'changed')
+        self.assertKeyChanges('resources/images/icon.png', 'changed')
+        self.assertKeyChanges('wscript', 'changed')
+        self.assertKeyChanges('src/other.c', 'main')
+        before = build_cache_key(self.project, self.base_dir)
+        os.rename(os.path.join(self.base_dir, 'src/other.c'), os.path.join(self.base_dir, 'src/renamed.c'))
+        self.assertNotEqual(before, build_cache_key(self.project, self.base_dir))
+
+    def test_target_platforms_change(self):
+        """
+        Tests that changing the platforms in appinfo.json changes the key.
+        """
+        self.assertKeyChanges('appinfo.json', json.dumps({'targetPlatforms': ['aplite']}))
+
+    def test_project_settings_change(self):
+        """
+        Tests that the project's type, SDK version and the SDK it would be built with all go into the key.
+        """
+        key = build_cache_key(self.project, self.base_dir)
+        self.assertNotEqual(key, build_cache_key(_FakeProject(project_type='pebblejs'), self.base_dir))
+        self.assertNotEqual(key, build_cache_key(_FakeProject(sdk_version='2'), self.base_dir))
+        with override_settings(BUILD_CACHE_SALT='new sdk'):
+            self.assertNotEqual(key, build_cache_key(self.project, self.base_dir))
+
+    def test_build_output_ignored(self):
+        """
+        Tests that waf's build directory and lock files don't affect the key.
+        """
+        key = build_cache_key(self.project, self.base_dir)
+        write_file(self.base_dir, 'build/basalt/pebble-app.elf', 'elf')
+        write_file(self.base_dir, '.lock-waf_linux2_build', 'lock')
+        self.assertEqual(key, build_cache_key(self.project, self.base_dir))
+
+    def binary_key(self, **manifest_changes):
+        manifest_dict = {'uuid': '00000000-0000-0000-0000-000000000000', 'versionLabel': '1.0', 'appKeys': {},
+                         'targetPlatforms': ['aplite', 'basalt']}
+        manifest_dict.update(manifest_changes)
+        return binary_cache_key(self.project, self.base_dir, manifest_dict)
+
+    def test_binary_key_ignores_repackageable_changes(self):
+        """
+        Tests that the binary key stays the same when only the JS, jshint configuration, appinfo.json, version
+        label or app keys change.
+        """
+        key = self.binary_key()
+        write_file(self.base_dir, 'src/js/app.js', 'changed')
+        write_file(self.base_dir, 'src/js/new.js', 'new')
+        write_file(self.base_dir, 'pebble-jshintrc', 'jshint')
+        write_file(self.base_dir, 'appinfo.json', json.dumps({'versionLabel': '1.1'}))
+        self.assertEqual(key, self.binary_key())
+        self.assertEqual(key, self.binary_key(versionLabel='1.1', appKeys={'KEY': 1}))
+
+    def test_binary_key_changes(self):
+        """
+        Tests that the binary key changes with the C sources, resources, wscript and the rest of the manifest.
+        """
+        key = self.binary_key()
+        self.assertNotEqual(key, self.binary_key(targetPlatforms=['basalt']))
+        self.assertNotEqual(key, self.binary_key(uuid='11111111-1111-1111-1111-111111111111'))
+        for path in ('src/main.c', 'src/main.h', 'resources/images/icon.png', 'wscript'):
+            write_file(self.base_dir, path, 'changed')
+            self.assertNotEqual(key, self.binary_key())
+            key = self.binary_key()
+
+
+class _FakeNode(object):
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+
+    @property
+    def parent(self):
+        return _FakeNode(os.path.dirname(self.path))
+
+    def abspath(self):
+        return self.path
+
+    def read(self, flags='r'):
+        with open(self.path, flags) as f:
+            return f.read()
+
+    def mkdir(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+
+class _FakeContext(object):
+    def __init__(self, top):
+        self.path = _FakeNode(top)
+        self.all_envs = {}
+        self.node_deps = {}
+
+
+class _FakeEnv(dict):
+    def __getattr__(self, name):
+        return self.get(name, [])
+
+
+class _FakeCompileTask(object):
+    """
+    Stands in for waf compiling a C file: the object it makes is just the source with a marker on the front.
+    """
+    hcode = '${CC} ${CFLAGS} ${SRC} -o ${TGT}'
+    vars = ['CFLAGS']
+
+    def __init__(self, env, source, target):
+        self.env = env
+        self.inputs = [source]
+        self.outputs = [target]
+        self.runs = 0
+
+    def uid(self):
+        return id(self)
+
+    def run(self):
+        self.runs += 1
+        self.outputs[0].parent.mkdir()
+        with open(self.outputs[0].abspath(), 'w') as f:
+            f.write('compiled:' + self.inputs[0].read())
+        return 0
+
+
+class RuntimeCacheTest(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    @override_settings(PEBBLEJS_RUNTIME_CACHE_DIR='/cache', BUILD_CACHE_SALT='')
+    def test_cache_dir_keys(self):
+        """
+        Tests that the runtime is cached for each SDK, SDK version and set of platforms, whatever their order.
+        """
+        key = runtime_cache_dir('/sdk3/waf', '3', ['aplite', 'basalt'])
+        self.assertEqual(key, runtime_cache_dir('/sdk3/waf', '3', ['basalt', 'aplite']))
+        self.assertNotEqual(key, runtime_cache_dir('/sdk3/waf', '3', ['basalt']))
+        self.assertNotEqual(key, runtime_cache_dir('/sdk2/waf', '2', ['aplite', 'basalt']))
+        self.assertTrue(key.startswith('/cache/'))
+
+    def build_runtime(self, project, resource_header):
+        """
+        Compiles the runtime in a directory of the project's own, with the build hooks caching objects.
+        :return: the compile task and the object it left in the project's build directory.
+        """
+        top = os.path.join(self.tmp, project)
+        os.makedirs(os.path.join(top, 'src'))
+        os.makedirs(os.path.join(top, 'build', 'src'))
+        with open(os.path.join(top, 'src', 'runtime.c'), 'w') as f:
+            f.write('#include "resource_ids.auto.h"\nint main(void) { return 0; }\n')
+        header = _FakeNode(os.path.join(top, 'build', 'src', 'resource_ids.auto.h'))
+        with open(header.abspath(), 'w') as f:
+            f.write(resource_header)
+
+        task_gen = type('task_gen', (object,), {
+            'create_task': lambda self, *args: type('c', (_FakeCompileTask,), {})(*args)})
+        waflib = types.ModuleType('waflib')
+        waflib.TaskGen = types.ModuleType('waflib.TaskGen')
+        waflib.TaskGen.task_gen = task_gen
+        ctx = _FakeContext(top)
+        old_modules = dict((x, sys.modules.get(x)) for x in ('waflib', 'waflib.TaskGen'))
+        sys.modules['waflib'], sys.modules['waflib.TaskGen'] = waflib, waflib.TaskGen
+        try:
+            hooks = {}
+            exec BUILD_HOOKS in hooks
+            hooks['cloudpebble_cache_runtime'](ctx, self.cache_dir)
+            env = _FakeEnv(PLATFORM_NAME='basalt', CFLAGS=['-I%s/build/src' % top])
+            task = task_gen().create_task(env, _FakeNode(os.path.join(top, 'src', 'runtime.c')),
+                                          _FakeNode(os.path.join(top, 'build', 'src', 'runtime.c.o')))
+            ctx.node_deps[task.uid()] = [header]
+            self.assertEqual(0, task.run())
+        finally:
+            for name, module in old_modules.items():
+                if module is None:
+                    del sys.modules[name]
+                else:
+                    sys.modules[name] = module
+        with open(os.path.join(top, 'build', 'src', 'runtime.c.o')) as f:
+            return task, f.read()
+
+    def test_projects_share_runtime_objects(self):
+        """
+        Tests that a second project, built in a different directory, gets the runtime objects the first compiled.
+        """
+        first, first_object = self.build_runtime('first', '#define RESOURCE_ID_FONT 1\n')
+        second, second_object = self.build_runtime('second', '#define RESOURCE_ID_FONT 1\n')
+        self.assertEqual(1, first.runs)
+        self.assertEqual(0, second.runs)
+        self.assertEqual(first_object, second_object)
+
+    def test_project_resources_not_shared(self):
+        """
+        Tests that objects including headers generated from a project's own resources aren't given to a project
+        whose resources differ.
+        """
+        first, first_object = self.build_runtime('first', '#define RESOURCE_ID_FONT 1\n')
+        second, second_object = self.build_runtime('second', '#define RESOURCE_ID_IMAGE 1\n')
+        self.assertEqual(1, first.runs)
+        self.assertEqual(1, second.runs)
+
+
+class RedisTestCase(TestCase):
+    """
+    Points the redis_client of every module in REDIS_MODULES, and the Lua scripts they registered, at a fake redis
+    of the test's own.
+    """
+    REDIS_MODULES = ()
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self._replaced = []
+        for module in self.REDIS_MODULES:
+            self._replace(module, 'redis_client', self.redis)
+            for value in vars(module).values():
+                if isinstance(value, redis.client.Script):
+                    self._replace(value, 'registered_client', self.redis)
+
+    def tearDown(self):
+        for obj, name, value in reversed(self._replaced):
+            setattr(obj, name, value)
+
+    def _replace(self, obj, name, value):
+        self._replaced.append((obj, name, getattr(obj, name)))
+        setattr(obj, name, value)
+
+
+@override_settings(BUILD_LOG_STREAM_LINES=5, BUILD_LOG_STREAM_EXPIRY=3600, BUILD_LOG_STREAM_BATCH_LINES=2,
+                   BUILD_LOG_STREAM_BATCH_MS=60000)
+class BuildLogStreamTest(RedisTestCase):
+    REDIS_MODULES = (log_stream,)
+
+    def write_lines(self, stream, count):
+        for i in xrange(count):
+            stream.write_line('line %d\n' % i)
+
+    def test_ring_buffer(self):
+        """
+        Tests that only the most recent lines are kept, and that readers are told when they've missed some.
+        """
+        stream = log_stream.BuildLogStream(1)
+        self.write_lines(stream, 12)
+        stream.flush()
+        self.assertEqual((['line %d\n' % i for i in xrange(7, 12)], 12, False, True), stream.read(0))
+        self.assertEqual((['line 10\n', 'line 11\n'], 12, False, False), stream.read(10))
+        self.assertEqual(([], 12, False, False), stream.read(12))
+
+    def test_batches(self):
+        """
+        Tests that lines are only sent once a batch is full.
+        """
+        stream = log_stream.BuildLogStream(1)
+        stream.write_line('line 0\n')
+        self.assertEqual(([], 0, False, False), stream.read(0))
+        stream.write_line('line 1\n')
+        self.assertEqual((['line 0\n', 'line 1\n'], 2, False, False), stream.read(0))
+
+    @override_settings(BUILD_LOG_STREAM_BATCH_MS=10)
+    def test_batch_timer(self):
+        """
+        Tests that a batch that never fills is sent anyway, soon after its first line was written.
+        """
+        stream = log_stream.BuildLogStream(1)
+        self.write_lines(stream, 1)
+        time.sleep(0.2)
+        self.assertEqual((['line 0\n'], 1, False, False), stream.read(0))
+
+    def test_finish(self):
+        """
+        Tests that finishing sends what's left, marks the stream finished, and leaves the complete log in the sink.
+        """
+        sink = tempfile.NamedTemporaryFile()
+        stream = log_stream.BuildLogStream(1, sink.name)
+        self.write_lines(stream, 7)
+        stream.finish()
+        lines, cursor, finished, truncated = stream.read(0)
+        self.assertEqual((7, True, True), (cursor, finished, truncated))
+        self.assertEqual(''.join('line %d\n' % i for i in xrange(7)), sink.read())
+        for key in (stream.lines_key, stream.offset_key, stream.finished_key):
+            self.assertTrue(0 < self.redis.ttl(key) <= 3600)
+
+
+@override_settings(CELERYD_TASK_TIME_LIMIT=620, FAIR_BUILD_SCHEDULING=False)
+class CancelSupersededBuildsTest(RedisTestCase):
+    REDIS_MODULES = (build_scheduler,)
+
+    def claim(self, build_id, platforms=None):
+        build = BuildResult(id=build_id, project_id=1, platforms=platforms)
+        build_scheduler.claim_build(build)
+        return build
+
+    def cancelled(self, build_id):
+        return self.redis.exists(build_scheduler._cancel_key(build_id))
+
+    def test_full_build_cancels_everything(self):
+        """
+        Tests that a build of every platform cancels every running build of the project.
+        """
+        self.claim(1)
+        self.claim(2, 'basalt')
+        build_scheduler.cancel_superseded_builds(1, None)
+        self.assertTrue(self.cancelled(1))
+        self.assertTrue(self.cancelled(2))
+
+    def test_partial_build_keeps_full_build(self):
+        """
+        Tests that a build of only some platforms doesn't cancel a running build of all of them.
+        """
+        self.claim(1)
+        build_scheduler.cancel_superseded_builds(1, 'basalt')
+        self.assertFalse(self.cancelled(1))
+
+    def test_partial_builds(self):
+        """
+        Tests that a build of some platforms cancels running builds of those platforms, and no others.
+        """
+        self.claim(1, 'basalt')
+        self.claim(2, 'aplite,chalk')
+        build_scheduler.cancel_superseded_builds(1, 'aplite,basalt')
+        self.assertTrue(self.cancelled(1))
+        self.assertFalse(self.cancelled(2))
+
+    def test_release_only_ours(self):
+        """
+        Tests that releasing a build forgets it and no other running build of the project.
+        """
+        self.claim(1)
+        build = self.claim(2, 'basalt')
+        build_scheduler.release_build(build)
+        build_scheduler.cancel_superseded_builds(1, None)
+        self.assertTrue(self.cancelled(1))
+        self.assertFalse(self.cancelled(2))
+
+    def test_watcher_kills_cancelled_build(self):
+        """
+        Tests that the processes of a build are killed, along with anything they started, once it's cancelled.
+        """
+        build = self.claim(1)
+        watcher = build_scheduler.CancellationWatcher(build.id, interval=0.01)
+        watcher.start()
+        try:
+            process = subprocess.Popen(['sh', '-c', 'sleep 30 & wait'], preexec_fn=os.setsid)
+            watcher.register(process)
+            build_scheduler.cancel_superseded_builds(1, None)
+            watcher.join(5)
+            self.assertTrue(watcher.cancelled)
+            self.assertEqual(-signal.SIGKILL, process.wait())
+        finally:
+            watcher.stop()
+
+
+@override_settings(CELERYD_TASK_TIME_LIMIT=620, BUILD_QUEUED_TTL=60)
+class BuildCoalescingTest(RedisTestCase):
+    REDIS_MODULES = (build_scheduler,)
+
+    def queue(self, build_id, platforms=None):
+        return build_scheduler._join_or_queue(keys=[build_scheduler._queued_key(1, platforms)],
+                                              args=['%d:task-%d' % (build_id, build_id), settings.BUILD_QUEUED_TTL])
+
+    def test_join_queued_build(self):
+        """
+        Tests that a build requested while another is queued joins it, and that builds of different platforms
+        don't join each other.
+        """
+        self.assertEqual('1:task-1', self.queue(1))
+        self.assertEqual('1:task-1', self.queue(2))
+        self.assertEqual('3:task-3', self.queue(3, 'basalt'))
+        self.assertEqual('3:task-3', self.queue(4, 'basalt'))
+        self.assertEqual('5:task-5', self.queue(5, 'aplite,basalt'))
+        self.assertTrue(0 < self.redis.ttl(build_scheduler._queued_key(1)) <= settings.BUILD_QUEUED_TTL)
+
+    def test_claim_ends_coalescing(self):
+        """
+        Tests that once a queued build starts, new requests queue a build of their own.
+        """
+        self.queue(1)
+        build_scheduler.claim_build(BuildResult(id=1, project_id=1))
+        self.assertEqual('2:task-2', self.queue(2))
+
+    def test_claim_leaves_other_builds_queued(self):
+        """
+        Tests that a build starting doesn't stop others from joining a build queued after it, or of other platforms.
+        """
+        self.queue(2)
+        self.queue(3, 'basalt')
+        build_scheduler.claim_build(BuildResult(id=1, project_id=1))
+        build_scheduler.claim_build(BuildResult(id=4, project_id=1, platforms='basalt'))
+        self.assertEqual('2:task-2', self.queue(5))
+        self.assertEqual('3:task-3', self.queue(6, 'basalt'))
+
+    def test_speculative_build_not_running(self):
+        """
+        Tests that a speculative build is claimed without being recorded among the project's running builds.
+        """
+        build_scheduler.claim_build(BuildResult(id=1, project_id=1, speculative=True))
+        self.assertTrue(self.redis.exists(build_scheduler._claimed_key(1)))
+        self.assertFalse(self.redis.exists(build_scheduler._running_key(1)))
+
+
+class _FakeTask(object):
+    def __init__(self):
+        self.sent = []
+
+    def apply_async(self, args=(), kwargs=None, **options):
+        self.sent.append(args[0])
+
+
+class _FakeBuild(object):
+    def __init__(self, build_id, owner_id):
+        self.id = build_id
+        self.project = _FakeProject()
+        self.project.owner_id = owner_id
+
+
+@override_settings(FAIR_BUILD_SCHEDULING=True, PROJECT_WORKSPACES=False, CELERYD_TASK_TIME_LIMIT=620,
+                   BUILD_QUEUED_TTL=60, MAX_BUILDS_IN_FLIGHT=3, MAX_BUILDS_PER_USER=1, MAX_BUILDS_PER_PROJECT=1,
+                   MAX_PENDING_BUILDS_PER_USER=3)
+class FairDispatchTest(RedisTestCase):
+    REDIS_MODULES = (build_scheduler,)
+
+    def setUp(self):
+        super(FairDispatchTest, self).setUp()
+        self.run_compile = _FakeTask()
+        self._replace(build_tasks, 'run_compile', self.run_compile)
+
+    def enqueue(self, user_id, project_id, build_id):
+        job = json.dumps({'build': str(build_id), 'task': 'task-%d' % build_id, 'project': str(project_id),
+                          'debug_info': None})
+        return build_scheduler._enqueue_fair(keys=[build_scheduler._fair_pending_key(user_id),
+                                                   build_scheduler._fair_users_key],
+                                             args=[user_id, job, settings.MAX_PENDING_BUILDS_PER_USER])
+
+    def dispatched(self):
+        build_scheduler.dispatch_builds()
+        sent, self.run_compile.sent = self.run_compile.sent, []
+        return sent
+
+    def test_users_take_turns(self):
+        """
+        Tests that users with builds waiting get one dispatched each in turn, however many they have waiting.
+        """
+        with override_settings(MAX_BUILDS_PER_USER=3, MAX_BUILDS_IN_FLIGHT=1):
+            self.enqueue(1, 10, 1)
+            self.enqueue(1, 11, 2)
+            self.enqueue(1, 12, 3)
+            self.enqueue(2, 20, 4)
+            sent = []
+            for i in range(4):
+                sent += self.dispatched()
+                build_scheduler.release_build_slot(sent[-1])
+            self.assertEqual([1, 4, 2, 3], sent)
+
+    def test_user_limit(self):
+        """
+        Tests that a user's builds wait while they have as many running as they're allowed, without holding up
+        anybody else's.
+        """
+        self.enqueue(1, 10, 1)
+        self.enqueue(1, 11, 2)
+        self.enqueue(2, 20, 3)
+        self.assertEqual([1, 3], self.dispatched())
+        self.assertEqual([], self.dispatched())
+        build_scheduler.release_build_slot(3)
+        self.assertEqual([], self.run_compile.sent)
+        build_scheduler.release_build_slot(1)
+        self.assertEqual([2], self.run_compile.sent)
+        self.assertEqual([], self.redis.lrange(build_scheduler._fair_users_key, 0, -1))
+
+    def test_project_limit(self):
+        """
+        Tests that a build waits while its project has as many running as it's allowed, and that builds of the
+        user's other projects go ahead of it.
+        """
+        with override_settings(MAX_BUILDS_PER_USER=3):
+            self.enqueue(1, 10, 1)
+            self.enqueue(1, 10, 2)
+            self.enqueue(1, 11, 3)
+            self.assertEqual([1, 3], self.dispatched())
+            build_scheduler.release_build_slot(1)
+            self.assertEqual([2], self.run_compile.sent)
+
+    def test_total_limit(self):
+        """
+        Tests that no more than MAX_BUILDS_IN_FLIGHT builds are dispatched at once.
+        """
+        for user_id in range(1, 6):
+            self.enqueue(user_id, user_id * 10, user_id)
+        self.assertEqual([1, 2, 3], self.dispatched())
+        build_scheduler.release_build_slot(2)
+        self.assertEqual([4], self.dispatched())
+
+    def test_expired_slots(self):
+        """
+        Tests that a slot held past its deadline, by a build whose worker died, is given to someone else.
+        """
+        self.enqueue(1, 10, 1)
+        self.assertEqual([1], self.dispatched())
+        for key in (build_scheduler._fair_running_key, build_scheduler._fair_user_running_key(1),
+                    build_scheduler._fair_project_running_key(10)):
+            self.redis.zadd(key, **{'1': time.time() - 1})
+        self.enqueue(1, 10, 2)
+        self.assertEqual([2], self.dispatched())
+
+    def test_pending_limit(self):
+        """
+        Tests that a user can't have more than MAX_PENDING_BUILDS_PER_USER builds waiting.
+        """
+        for build_id in range(1, 4):
+            self.assertEqual(build_id, self.enqueue(1, 10, build_id))
+        self.assertEqual(-1, self.enqueue(1, 10, 4))
+        self.assertEqual(1, self.enqueue(2, 20, 5))
+
+    def test_release_unknown_slot(self):
+        """
+        Tests that releasing the slot of a build that never had one does nothing but dispatch what's waiting.
+        """
+        self.enqueue(1, 10, 1)
+        build_scheduler.release_build_slot(99)
+        self.assertEqual([1], self.run_compile.sent)
+
+    def test_queue_position(self):
+        """
+        Tests that a build's position counts one build from each user ahead of it per turn.
+        """
+        self.enqueue(1, 10, 1)
+        self.enqueue(1, 11, 2)
+        self.enqueue(2, 20, 3)
+        self.enqueue(3, 30, 4)
+        self.enqueue(3, 31, 5)
+        self.enqueue(3, 32, 6)
+        positions = [build_scheduler.get_queue_position(_FakeBuild(build_id, owner_id))
+                     for build_id, owner_id in [(1, 1), (2, 1), (3, 2), (4, 3), (5, 3), (6, 3), (7, 3)]]
+        self.assertEqual([0, 3, 1, 2, 4, 5, None], positions)
+
+
+@override_settings(SCRATCH_QUOTA=64 * 1024, SCRATCH_QUOTA_CHECK_INTERVAL=0, SCRATCH_REAP_INTERVAL=300,
+                   CELERYD_TASK_TIME_LIMIT=620)
+class ScratchTest(RedisTestCase):
+    REDIS_MODULES = (scratch,)
+
+    def setUp(self):
+        super(ScratchTest, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self._replace(scratch, '_scratch_root', self.root)
+
+    def tearDown(self):
+        super(ScratchTest, self).tearDown()
+        scratch.remove_tree(self.root)
+
+    def test_quota(self):
+        """
+        Tests that a directory is only refused once it has grown beyond the quota.
+        """
+        with scratch.ScratchDir('build') as scratch_dir:
+            write_file(scratch_dir.path, 'small', 'x' * 1024)
+            scratch_dir.check_quota()
+            write_file(scratch_dir.path, 'src/large', 'x' * 128 * 1024)
+            with self.assertRaises(scratch.ScratchQuotaExceeded):
+                scratch_dir.check_quota()
+            scratch_dir.check_quota(1024 * 1024)
+        self.assertFalse(os.path.exists(scratch_dir.path))
+
+    def test_quota_watcher(self):
+        """
+        Tests that a build which goes over the quota while it's running is killed, and that check() says why.
+        """
+        with scratch.ScratchDir('build') as scratch_dir:
+            watcher = scratch.QuotaWatcher(scratch_dir.path)
+            process = subprocess.Popen(['sh', '-c', 'sleep 30 & wait'], preexec_fn=os.setsid)
+            watcher.register(process)
+            watcher.on_line('compiling')
+            self.assertIsNone(process.poll())
+            write_file(scratch_dir.path, 'build/large', 'x' * 128 * 1024)
+            watcher.on_line('linking')
+            self.assertEqual(-signal.SIGKILL, process.wait())
+            with self.assertRaises(scratch.ScratchQuotaExceeded):
+                watcher.check()
+
+    def test_remove_tree_unwritable(self):
+        """
+        Tests that scratch directories are removed even if a build took away its own permissions on them.
+        """
+        with scratch.ScratchDir('build') as scratch_dir:
+            write_file(scratch_dir.path, 'locked/file', 'x')
+            os.chmod(os.path.join(scratch_dir.path, 'locked'), 0)
+        self.assertFalse(os.path.exists(scratch_dir.path))
+
+    def make_entry(self, name, age, directory=True):
+        mtime = time.time() - age
+        if directory:
+            write_file(self.root, os.path.join(name, 'inner/file'), 'x', mtime=mtime)
+            os.utime(os.path.join(self.root, name, 'inner'), (mtime, mtime))
+        else:
+            write_file(self.root, name, 'x')
+        os.utime(os.path.join(self.root, name), (mtime, mtime))
+
+    def test_reaper(self):
+        """
+        Tests that directories and files are reaped once the task that made them has died, or once they're older
+        than any task can run for, and that anything else is left alone.
+        """
+        process = subprocess.Popen(['true'])
+        process.wait()
+        dead_pid = process.pid
+        live_pid = os.getpid()
+        self.make_entry('build-%d-dead' % dead_pid, 120)
+        self.make_entry('export-%d-dead.zip' % dead_pid, 120, directory=False)
+        self.make_entry('build-%d-just-died' % dead_pid, 0)
+        self.make_entry('build-%d-old' % live_pid, 3600)
+        self.make_entry('import-%d-old.zip' % live_pid, 3600, directory=False)
+        self.make_entry('build-%d-running' % live_pid, 120)
+        self.make_entry('export-%d-running.zip' % live_pid, 120, directory=False)
+        self.make_entry('.simplyjs-template.pbw', 3600, directory=False)
+        scratch.reap_scratch()
+        self.assertEqual(sorted(['build-%d-just-died' % dead_pid, 'build-%d-running' % live_pid,
+                                 'export-%d-running.zip' % live_pid, '.simplyjs-template.pbw']),
+                         sorted(os.listdir(self.root)))
+        self.assertTrue(self.redis.exists('scratch-metrics-%s' % socket.gethostname()))
+
+    def test_scratch_file(self):
+        """
+        Tests that scratch files are named so that the reaper can tell whose they are, and are deleted when closed.
+        """
+        with scratch.scratch_file('export', suffix='.zip') as f:
+            name = os.path.basename(f.name)
+            self.assertTrue(name.startswith('export-%d-' % os.getpid()) and name.endswith('.zip'))
+            self.assertEqual(self.root, os.path.dirname(f.name))
+        self.assertFalse(os.path.exists(f.name))
+
+
+class _FakeRollup(object):
+    def __init__(self, builds=0, failures=0, durations=(), queue_waits=(), sizes=()):
+        self.builds = builds
+        self.failures = failures
+        duration_histogram = []
+        queue_wait_histogram = []
+        for duration in durations:
+            build_stats.histogram_add(duration_histogram, duration)
+        for queue_wait in queue_waits:
+            build_stats.histogram_add(queue_wait_histogram, queue_wait)
+        self.duration_histogram = json.dumps(duration_histogram)
+        self.duration_total = sum(durations)
+        self.queue_wait_histogram = json.dumps(queue_wait_histogram)
+        self.queue_wait_total = sum(queue_waits)
+        self.sized_builds = len(sizes)
+        self.binary_size_total = sum(binary for binary, resources in sizes)
+        self.resource_size_total = sum(resources for binary, resources in sizes)
+
+
+class BuildStatsTest(TestCase):
+    def test_histogram_buckets(self):
+        """
+        Tests that values go in the first bucket whose bound they don't exceed, and that anything too long for the
+        histogram goes on the end.
+        """
+        counts = []
+        for value in (0, 0.1, 0.11, build_stats.HISTOGRAM_BOUNDS[10], 10 ** 6):
+            build_stats.histogram_add(counts, value)
+        self.assertEqual(len(build_stats.HISTOGRAM_BOUNDS) + 1, len(counts))
+        self.assertEqual(2, counts[0])
+        self.assertEqual(1, counts[1])
+        self.assertEqual(1, counts[10])
+        self.assertEqual(1, counts[-1])
+
+    def test_histogram_percentile(self):
+        """
+        Tests that percentiles are reported as the bound of the bucket they fall in.
+        """
+        bounds = build_stats.HISTOGRAM_BOUNDS
+        counts = build_stats.histogram_merge([[0] * 5 + [90], [0] * 20 + [9], [0] * (len(bounds) + 1)])
+        counts[-1] = 1
+        self.assertEqual(bounds[5], build_stats.histogram_percentile(counts, 50))
+        self.assertEqual(bounds[5], build_stats.histogram_percentile(counts, 90))
+        self.assertEqual(bounds[20], build_stats.histogram_percentile(counts, 95))
+        self.assertEqual(bounds[-1], build_stats.histogram_percentile(counts, 100))
+        self.assertIsNone(build_stats.histogram_percentile([], 50))
+
+    def test_summary(self):
+        """
+        Tests that rollups are combined into totals, rates, means and percentiles.
+        """
+        summary = build_stats.summarise_build_stats([
+            _FakeRollup(builds=3, failures=1, durations=[10, 20, 30], queue_waits=[1, 2], sizes=[(1000, 100)]),
+            _FakeRollup(builds=1, durations=[40], queue_waits=[5], sizes=[(3000, 300)]),
+            _FakeRollup(),
+        ])
+        self.assertEqual(4, summary['builds'])
+        self.assertEqual(1, summary['failures'])
+        self.assertEqual(0.25, summary['failure_rate'])
+        self.assertEqual(4, summary['duration']['count'])
+        self.assertEqual(25, summary['duration']['mean'])
+        self.assertTrue(20 <= summary['duration']['p50'] < 20 * 1.2)
+        self.assertTrue(40 <= summary['duration']['p99'] < 40 * 1.2)
+        self.assertEqual(3, summary['queue_wait']['count'])
+        self.assertEqual(2000, summary['mean_binary_size'])
+        self.assertEqual(200, summary['mean_resource_size'])
+
+    def test_empty_summary(self):
+        """
+        Tests that a summary of no builds has nothing to average.
+        """
+        summary = build_stats.summarise_build_stats([])
+        self.assertEqual(0, summary['builds'])
+        self.assertIsNone(summary['failure_rate'])
+        self.assertIsNone(summary['duration']['mean'])
+        self.assertIsNone(summary['duration']['p50'])
+        self.assertIsNone(summary['mean_binary_size'])
+
+
+class _FakeSourceFiles(object):
+    def __init__(self, count):
+        self._count = count
+
+    def count(self):
+        return self._count
+
+
+class _FakeEstimatedBuild(object):
+    def __init__(self, build_id, project_type='native', sdk_version='3', source_count=1, duration=None,
+                 queue_wait=None, owner_id=1):
+        self.id = build_id
+        self.project = _FakeProject(project_type, sdk_version)
+        self.project.owner_id = owner_id
+        self.project.source_files = _FakeSourceFiles(source_count)
+        self.project.get_build_platforms = lambda: ['aplite', 'basalt', 'chalk']
+        self.platform_list = None
+        self.started = datetime.datetime(2015, 1, 1)
+        if duration is not None:
+            self.finished = self.started + datetime.timedelta(seconds=duration + (queue_wait or 0))
+        self._metrics = {'queue_wait': queue_wait} if queue_wait is not None else None
+
+    def get_metrics(self):
+        return self._metrics
+
+
+@override_settings(DEFAULT_BUILD_DURATION=15.0, FAIR_BUILD_SCHEDULING=True, MAX_BUILDS_IN_FLIGHT=1,
+                   MAX_PENDING_BUILDS_PER_USER=5, CELERYD_TASK_TIME_LIMIT=620, BUILD_QUEUED_TTL=60)
+class BuildEstimatesTest(RedisTestCase):
+    REDIS_MODULES = (build_estimates, build_scheduler)
+
+    def record(self, count, duration, **kwargs):
+        for i in xrange(count):
+            build = _FakeEstimatedBuild(i, duration=duration, **kwargs)
+            build_estimates.record_build_duration(build, build.project.source_files.count())
+
+    def estimate(self, **kwargs):
+        return build_estimates.estimate_build_duration(_FakeEstimatedBuild(0, **kwargs))
+
+    def test_queue_wait_not_counted(self):
+        """
+        Tests that the time a build spent waiting to start isn't counted as part of its duration.
+        """
+        self.record(5, 10, queue_wait=30)
+        self.assertEqual(10, self.estimate())
+
+    def test_most_alike_builds(self):
+        """
+        Tests that estimates come from the most alike builds there have been enough of, falling back to every build,
+        and then to the default.
+        """
+        self.assertEqual(15, self.estimate())
+        self.record(5, 10, source_count=4)
+        self.record(5, 30, project_type='pebblejs')
+        self.record(4, 100, source_count=100)
+        self.assertEqual(10, self.estimate(source_count=5))
+        self.assertEqual(10, self.estimate(source_count=100))
+        self.assertEqual(30, self.estimate(project_type='pebblejs'))
+        self.assertEqual(30, self.estimate(sdk_version='2'))
+
+    def test_started_build(self):
+        """
+        Tests that a build that has started is estimated to finish its typical duration after it started.
+        """
+        self.record(5, 60)
+        build = _FakeEstimatedBuild(1)
+        build_scheduler.claim_build(BuildResult(id=1, project_id=1, speculative=True))
+        estimate = build_estimates.estimate_build_times(build)
+        self.assertTrue(estimate['started'])
+        self.assertEqual(0, estimate['builds_ahead'])
+        self.assertEqual(60, estimate['estimated_duration'])
+        self.assertEqual(estimate['estimated_start'] + datetime.timedelta(seconds=60), estimate['estimated_finish'])
+
+    def test_waiting_build(self):
+        """
+        Tests that a waiting build is estimated to start once the builds ahead of it have had their turns.
+        """
+        self.record(5, 60)
+        for build_id, owner_id in [(1, 1), (2, 2), (3, 3)]:
+            job = json.dumps({'build': str(build_id), 'task': 'task', 'project': str(owner_id), 'debug_info': None})
+            build_scheduler._enqueue_fair(keys=[build_scheduler._fair_pending_key(owner_id),
+                                                build_scheduler._fair_users_key],
+                                          args=[owner_id, job, settings.MAX_PENDING_BUILDS_PER_USER])
+        before = build_estimates.now()
+        estimate = build_estimates.estimate_build_times(_FakeEstimatedBuild(3, owner_id=3))
+        self.assertFalse(estimate['started'])
+        self.assertEqual(2, estimate['builds_ahead'])
+        self.assertEqual(2, estimate['queue_position'])
+        wait = (estimate['estimated_start'] - before).total_seconds()
+        self.assertTrue(120 <= wait < 125)
+        self.assertEqual(estimate['estimated_start'] + datetime.timedelta(seconds=60), estimate['estimated_finish'])
@@ -3,8 +3,9 @@ from django.conf.urls import patterns, url
 from ide.api import proxy_keen, check_task, get_shortlink, heartbeat
 from ide.api.git import github_push, github_pull, set_project_repo, create_project_repo
 from ide.api.phone import ping_phone, check_phone, list_phones, update_phone
-from ide.api.project import project_info, compile_project, last_build, build_history, build_log, create_project, \
-    save_project_settings, delete_project, begin_export, import_zip, import_github, do_import_gist
+from ide.api.project import project_info, compile_project, last_build, build_history, build_log, build_log_tail, \
+    build_symbolicate, build_estimate, create_project, save_project_settings, delete_project, begin_export, \
+    import_zip, import_github, do_import_gist
 from ide.api.resource import create_resource, resource_info, delete_resource, update_resource, show_resource, \
     delete_variant
 from ide.api.source import create_source_file, load_source_file, source_file_is_safe, save_source_file, \
@@ -12,6 +13,7 @@ from ide.api.source import create_source_file, load_source_file, source_file_is_
 from ide.api.user import transition_accept, transition_export, transition_delete, whats_new
 from ide.api.ycm import init_autocomplete
 from ide.api.qemu import launch_emulator, generate_phone_token, handle_phone_token
+from ide.api.stats import build_stats
 from ide.views.index import index
 from ide.views.project import view_project, github_hook, build_status, import_gist, qemu_config, enter_phone_token
 from ide.views.settings import settings_page, start_github_auth, remove_github_auth, complete_github_auth
@@ -41,6 +43,9 @@ urlpatterns = patterns(
     url(r'^project/(?P<project_id>\d+)/build/last', last_build, name='get_last_build'),
     url(r'^project/(?P<project_id>\d+)/build/history', build_history, name='get_build_history'),
     url(r'^project/(?P<project_id>\d+)/analytics', proxy_keen, name='proxy_analytics'),
+    url(r'^project/(?P<project_id>\d+)/build/(?P<build_id>\d+)/log/tail', build_log_tail, name='get_build_log_tail'),
+    url(r'^project/(?P<project_id>\d+)/build/(?P<build_id>\d+)/symbolicate', build_symbolicate, name='build_symbolicate'),
+    url(r'^project/(?P<project_id>\d+)/build/(?P<build_id>\d+)/estimate', build_estimate, name='build_estimate'),
     url(r'^project/(?P<project_id>\d+)/build/(?P<build_id>\d+)/log', build_log, name='get_build_log'),
     url(r'^project/(?P<project_id>\d+)/export', begin_export, name='begin_export'),
     url(r'^project/(?P<project_id>\d+)/github/repo$', set_project_repo, name='set_project_repo'),
@@ -74,5 +79,6 @@ urlpatterns = patterns(
     url(r'^whats_new', whats_new, name='whats_new'),
     url(r'^gist/(?P<gist_id>[0-9a-f]+)$', import_gist),
     url(r'^heartbeat$', heartbeat),
+    url(r'^stats/builds$', build_stats, name='build_stats'),
     url(r'^jsi18n/$', 'django.views.i18n.javascript_catalog', name='jsi18n'),
 )
@@ -1,3 +1,5 @@
+import errno
+import fnmatch
 import os
 import shutil
 import uuid
@@ -15,6 +17,38 @@ def link_or_copy(src, dst):
             raise
 
 
+def link_tree(src, dst, ignore=()):
+    """
+    Recreates the tree at src in dst, hardlinking files instead of copying them where src and dst are on the same
+    filesystem. As with shutil.copytree, symlinks are followed. Anything that might write to a file in dst must
+    call break_link on it first, or the change will show up in src and every other tree linked from it.
+    :param ignore: glob patterns matching names at the top level of src to leave out.
+    """
+    for root, dirs, files in os.walk(src, followlinks=True):
+        rel_root = os.path.relpath(root, src)
+        if rel_root == '.':
+            dirs[:] = [name for name in dirs if not any(fnmatch.fnmatch(name, x) for x in ignore)]
+            files = [name for name in files if not any(fnmatch.fnmatch(name, x) for x in ignore)]
+        dst_root = os.path.normpath(os.path.join(dst, rel_root))
+        if not os.path.isdir(dst_root):
+            os.makedirs(dst_root)
+        for name in files:
+            link_or_copy(os.path.realpath(os.path.join(root, name)), os.path.join(dst_root, name))
+
+
+def break_link(path):
+    """
+    Removes path if it is one of several links to the same file, so that writing to path creates a file of its own
+    instead of changing the others.
+    """
+    try:
+        if os.lstat(path).st_nlink > 1:
+            os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
 def generate_half_uuid():
     _uuid = str(uuid.uuid4())
     if int(_uuid.split('-')[0], 16) > (0xffffffff/2):
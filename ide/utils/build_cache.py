@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+
+from django.conf import settings
+
+# Bump this if the way we lay out build directories changes in a way that isn't reflected in their contents.
+CACHE_KEY_VERSION = '1'
+
+# The parts of a native project's appinfo.json that don't go into its compiled binaries or resources, or that
+# ide.utils.pbw.repackage_pbw can patch into them afterwards.
+REPACKAGE_MANIFEST_FIELDS = ('versionLabel', 'appKeys')
+
+
+def hash_file(path, block_size=65536):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def hash_directory(base_dir, hasher, ignore=None):
+    """
+    Feeds the relative path and content digest of every file under base_dir into hasher, in a stable order.
+    Anything waf has already produced (the build directory and its lock files) is skipped.
+    :param ignore: a function given each file's path relative to base_dir, which returns True to skip it.
+    """
+    for root, dirs, files in os.walk(base_dir):
+        if root == base_dir:
+            dirs[:] = [d for d in dirs if d != 'build']
+        dirs.sort()
+        for name in sorted(files):
+            if name.startswith('.lock-waf'):
+                continue
+            path = os.path.join(root, name)
+            relpath = os.path.relpath(path, base_dir)
+            if ignore is not None and ignore(relpath):
+                continue
+            hasher.update('%s\0%s\0' % (relpath, hash_file(path)))
+
+
+def _start_hash(project):
+    if project.sdk_version == '2':
+        sdk = settings.SDK2_PEBBLE_WAF
+    else:
+        sdk = settings.SDK3_PEBBLE_WAF
+    h = hashlib.sha1()
+    h.update('%s\0%s\0%s\0%s\0%s\0' % (CACHE_KEY_VERSION, project.project_type, project.sdk_version, sdk,
+                                       settings.BUILD_CACHE_SALT))
+    return h
+
+
+def build_cache_key(project, base_dir):
+    """
+    Returns a digest identifying everything that can affect the output of building the project assembled in base_dir:
+    sources, resource variants, the generated appinfo.json/wscript/jshintrc (or the JS runtime tree), and the SDK.
+    """
+    h = _start_hash(project)
+    hash_directory(base_dir, h)
+    return h.hexdigest()
+
+
+def _is_repackageable_file(path):
+    return path in ('appinfo.json', 'pebble-jshintrc') or (path.startswith('src' + os.sep) and path.endswith('.js'))
+
+
+def binary_cache_key(project, base_dir, manifest_dict):
+    """
+    Returns a digest identifying everything that can affect the binaries and resources built from the native
+    project assembled in base_dir. Its JavaScript, jshint configuration and REPACKAGE_MANIFEST_FIELDS are left out,
+    so that projects which differ only in those can be built by repackaging each other's PBWs.
+    """
+    h = _start_hash(project)
+    h.update(json.dumps({k: v for k, v in manifest_dict.iteritems() if k not in REPACKAGE_MANIFEST_FIELDS},
+                        sort_keys=True))
+    hash_directory(base_dir, h, ignore=_is_repackageable_file)
+    return h.hexdigest()
@@ -0,0 +1,126 @@
+import datetime
+import math
+
+from django.conf import settings
+from django.utils.timezone import now
+
+from ide.models.build import BuildResult
+from ide.utils.build_scheduler import count_builds_ahead, get_claim_time
+from utils.redis_helper import redis_client
+
+# How many recent build durations to keep for each kind of project, and how many are needed to estimate from.
+DURATION_SAMPLES = 50
+MIN_DURATION_SAMPLES = 5
+# How long to keep durations for kinds of project nobody has built in a while, in seconds.
+DURATION_TTL = 7 * 24 * 3600
+
+
+def _source_count_bucket(source_count):
+    """
+    Groups projects with roughly the same number of source files: 0-1, 2-3, 4-7, 8-15 and so on.
+    """
+    return int(math.log(source_count, 2)) if source_count > 1 else 0
+
+
+def _duration_key(*parts):
+    return 'build-durations-%s' % '-'.join(parts)
+
+
+def _duration_keys(sdk_version, project_type, platform_count, source_count):
+    """
+    :return: the keys of the durations of builds like this one, from the most to the least alike. The last is that
+    of every build.
+    """
+    parts = [sdk_version, project_type, str(platform_count), str(_source_count_bucket(source_count))]
+    return [_duration_key(*parts[:i]) for i in xrange(len(parts), -1, -1)]
+
+
+def _build_platform_count(build_result):
+    return len(build_result.platform_list or build_result.project.get_build_platforms())
+
+
+def record_build_duration(build_result, source_count):
+    """
+    Adds a successful build's duration, not counting time spent queued, to the recent durations of builds like it.
+    """
+    project = build_result.project
+    queue_wait = (build_result.get_metrics() or {}).get('queue_wait', None) or 0
+    duration = (build_result.finished - build_result.started).total_seconds() - queue_wait
+    pipe = redis_client.pipeline()
+    for key in _duration_keys(project.sdk_version, project.project_type, _build_platform_count(build_result),
+                              source_count):
+        pipe.lpush(key, round(duration, 2))
+        pipe.ltrim(key, 0, DURATION_SAMPLES - 1)
+        pipe.expire(key, DURATION_TTL)
+    pipe.execute()
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def estimate_build_duration(build_result):
+    """
+    :return: the median duration, in seconds, of recent builds of projects with the same SDK version and type, number
+    of platforms and about as many source files. If there haven't been enough of those, progressively less similar
+    builds are used, down to settings.DEFAULT_BUILD_DURATION if there haven't been any at all.
+    """
+    project = build_result.project
+    keys = _duration_keys(project.sdk_version, project.project_type, _build_platform_count(build_result),
+                          project.source_files.count())
+    pipe = redis_client.pipeline()
+    for key in keys:
+        pipe.lrange(key, 0, -1)
+    for durations in pipe.execute():
+        if len(durations) >= MIN_DURATION_SAMPLES:
+            return _median([float(x) for x in durations])
+    return settings.DEFAULT_BUILD_DURATION
+
+
+def _median_duration(key):
+    durations = redis_client.lrange(key, 0, -1)
+    if len(durations) < MIN_DURATION_SAMPLES:
+        return settings.DEFAULT_BUILD_DURATION
+    return _median([float(x) for x in durations])
+
+
+def estimate_build_times(build_result):
+    """
+    Estimates when a build that hasn't finished will start and finish. Builds ahead of it are assumed to take as long
+    as builds generally have lately, and to be spread across settings.MAX_BUILDS_IN_FLIGHT workers.
+    :return: a dict of whether the build has started, how many builds are ahead of it, its position among the
+    builds waiting to be dispatched (if settings.FAIR_BUILD_SCHEDULING is set), and its estimated duration and start
+    and finish times.
+    """
+    duration = estimate_build_duration(build_result)
+    claimed = get_claim_time(build_result)
+    if claimed is not None:
+        ahead, position = 0, None
+        start = claimed
+    else:
+        ahead, position = count_builds_ahead(build_result)
+        # Builds are mostly alike as far as the queue is concerned, so the overall median will do for those ahead.
+        typical = _median_duration(_duration_key())
+        waves = max(0, ahead - settings.MAX_BUILDS_IN_FLIGHT + 1) / float(settings.MAX_BUILDS_IN_FLIGHT)
+        start = now() + datetime.timedelta(seconds=math.ceil(waves) * typical)
+    finish = max(start + datetime.timedelta(seconds=duration), now())
+    return {
+        'started': claimed is not None,
+        'builds_ahead': ahead,
+        'queue_position': position,
+        'estimated_duration': duration,
+        'estimated_start': start,
+        'estimated_finish': finish,
+    }
+
+
+def count_waiting_builds():
+    """
+    :return: how many builds have been requested and not finished, not counting any that must have been lost.
+    """
+    cutoff = now() - datetime.timedelta(seconds=settings.BUILD_QUEUED_TTL + settings.CELERYD_TASK_TIME_LIMIT)
+    return BuildResult.objects.filter(state=BuildResult.STATE_WAITING, speculative=False, started__gte=cutoff).count()
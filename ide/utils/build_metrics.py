@@ -0,0 +1,110 @@
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+# Waf prints a line like "[12/12] foo.pbw: build/aplite/pebble-app.bin ... -> build/foo.pbw" as it starts bundling.
+_bundle_line = re.compile(r"^\[\s*\d+/\d+\].*\.pbw\b")
+
+
+class BuildMetrics(object):
+    """
+    Collects how long each phase of a build took and how much the processes it ran used, to be saved with the build.
+    The phases are db_fetch, assembly, fetch, preprocessor_check, configure, compile, bundle, size_extraction,
+    debug_info, artifact_upload and log_upload; any that didn't happen are left out.
+    """
+    def __init__(self):
+        self.phases = {}
+        self.rusage = {'user_time': 0.0, 'system_time': 0.0, 'max_rss': 0, 'bytes_written': 0}
+        self.extra = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def add_rusage(self, usage):
+        """
+        Adds the resource usage of a process, as returned by os.wait4, which includes everything it waited for.
+        """
+        with self._lock:
+            self.rusage['user_time'] += usage.ru_utime
+            self.rusage['system_time'] += usage.ru_stime
+            # Linux reports maxrss in kilobytes and oublock in 512-byte blocks.
+            self.rusage['max_rss'] = max(self.rusage['max_rss'], usage.ru_maxrss * 1024)
+            self.rusage['bytes_written'] += usage.ru_oublock * 512
+
+    def merge_concurrent(self, others):
+        """
+        Adds in the metrics of builds that ran at the same time, so only the longest of each phase counts towards
+        how long the build took.
+        """
+        phases = {}
+        for other in others:
+            for name, seconds in other.phases.iteritems():
+                phases[name] = max(phases.get(name, 0), seconds)
+            with self._lock:
+                self.rusage['user_time'] += other.rusage['user_time']
+                self.rusage['system_time'] += other.rusage['system_time']
+                self.rusage['max_rss'] = max(self.rusage['max_rss'], other.rusage['max_rss'])
+                self.rusage['bytes_written'] += other.rusage['bytes_written']
+        for name, seconds in phases.iteritems():
+            self.add_time(name, seconds)
+
+    def as_dict(self):
+        result = dict(self.extra)
+        result['phases'] = {name: round(seconds, 3) for name, seconds in self.phases.iteritems()}
+        result['rusage'] = dict(self.rusage, user_time=round(self.rusage['user_time'], 3),
+                                system_time=round(self.rusage['system_time'], 3))
+        return result
+
+    def to_json(self):
+        return json.dumps(self.as_dict())
+
+
+class WafPhaseTimer(object):
+    """
+    Passes each line of waf's output on to on_line, while working out from it when waf finished configuring and
+    started bundling, so that its run can be split into configure, compile and bundle phases.
+    """
+    def __init__(self, on_line=None):
+        self.on_line = on_line
+        self.started = time.time()
+        self.configured = None
+        self.bundling = None
+
+    def __call__(self, line):
+        if self.configured is None and "'configure' finished successfully" in line:
+            self.configured = time.time()
+        elif self.bundling is None and _bundle_line.match(line):
+            self.bundling = time.time()
+        if self.on_line is not None:
+            try:
+                self.on_line(line)
+            except Exception as e:
+                print "Couldn't pass on waf output: %s" % e
+                self.on_line = None
+
+    def record(self, metrics):
+        """
+        Adds the phases of the run, which ended now, to metrics. If we never saw waf start bundling, the whole build
+        counts as compiling.
+        """
+        end = time.time()
+        compile_start = self.started
+        if self.configured is not None:
+            metrics.add_time('configure', self.configured - self.started)
+            compile_start = self.configured
+        compile_end = self.bundling if self.bundling is not None and self.bundling >= compile_start else end
+        metrics.add_time('compile', compile_end - compile_start)
+        if compile_end != end:
+            metrics.add_time('bundle', end - compile_end)
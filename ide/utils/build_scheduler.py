@@ -0,0 +1,545 @@
+import datetime
+import json
+import os
+import signal
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.utils.timezone import now, utc
+
+from ide.models.build import BuildResult
+from ide.models.project import Project
+from ide.utils.revisions import get_project_revision
+from utils.redis_helper import redis_client
+
+# Joins the queued build if there is one, otherwise queues ours. Returns the value now in the key.
+_join_or_queue = redis_client.register_script("""
+local current = redis.call('get', KEYS[1])
+if current then
+    return current
+end
+redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return ARGV[1]
+""")
+
+# Deletes the key only if its value starts with ARGV[1]. Returns 1 if it did.
+_delete_if_prefixed = redis_client.register_script("""
+local current = redis.call('get', KEYS[1])
+if current and string.sub(current, 1, string.len(ARGV[1])) == ARGV[1] then
+    redis.call('del', KEYS[1])
+    return 1
+end
+return 0
+""")
+
+# Adds ARGV[2] to the user's pending builds unless they already have ARGV[3] waiting, putting the user at the back of
+# the line of users with pending builds if they weren't in it. Returns how many builds the user now has pending, or -1.
+_enqueue_fair = redis_client.register_script("""
+local pending = redis.call('llen', KEYS[1])
+if pending >= tonumber(ARGV[3]) then
+    return -1
+end
+if pending == 0 then
+    redis.call('rpush', KEYS[2], ARGV[1])
+end
+return redis.call('rpush', KEYS[1], ARGV[2])
+""")
+
+# Moves user ARGV[1] to the back of the line of users with pending builds, if they're still in it.
+_requeue_fair_user = redis_client.register_script("""
+if redis.call('lrem', KEYS[1], 1, ARGV[1]) > 0 then
+    redis.call('rpush', KEYS[1], ARGV[1])
+end
+""")
+
+# Takes the pending build ARGV[7] out of its owner's list and counts it as running until ARGV[2], unless that would go
+# over the total, per-user or per-project limit. Running builds are kept in sorted sets by when they'll have timed
+# out, so that a worker dying can't leave a slot taken forever. The owner goes to the back of the line of users with
+# pending builds, or leaves it once they have none left.
+# KEYS: the sets of all, the user's and the project's running builds, the user's pending builds, the users with
+# pending builds, and the build's slot.
+# ARGV: the time now, the deadline, the three limits, how long to keep the keys, the pending entry, the user, the
+# build and what to record in its slot.
+# Returns 1 if the build was taken, 0 if it had already gone, or -1, -2 or -3 for whichever limit was reached.
+_claim_fair_slot = redis_client.register_script("""
+for i = 1, 3 do
+    redis.call('zremrangebyscore', KEYS[i], '-inf', ARGV[1])
+    if redis.call('zcard', KEYS[i]) >= tonumber(ARGV[2 + i]) then
+        return -i
+    end
+end
+if redis.call('lrem', KEYS[4], 1, ARGV[7]) == 0 then
+    return 0
+end
+redis.call('lrem', KEYS[5], 0, ARGV[8])
+if redis.call('llen', KEYS[4]) > 0 then
+    redis.call('rpush', KEYS[5], ARGV[8])
+end
+for i = 1, 3 do
+    redis.call('zadd', KEYS[i], ARGV[2], ARGV[9])
+    redis.call('expire', KEYS[i], ARGV[6])
+end
+redis.call('set', KEYS[6], ARGV[10], 'EX', ARGV[6])
+return 1
+""")
+
+_FAIR_SLOT_TAKEN = 1
+_FAIR_SLOT_TOTAL_LIMIT = -1
+_FAIR_SLOT_USER_LIMIT = -2
+
+
+class BuildRejected(Exception):
+    pass
+
+
+def _queued_key(project_id, platforms=None):
+    # Builds of only some platforms queue separately, so nobody joins a build that won't have what they asked for.
+    if platforms:
+        return 'build-queued-%d-%s' % (project_id, platforms)
+    return 'build-queued-%d' % project_id
+
+
+def _running_key(project_id):
+    # A hash of the project's running builds' ids to the platforms they're building, which is empty for all of them.
+    return 'build-running-builds-%d' % project_id
+
+
+def _cancel_key(build_id):
+    return 'build-cancel-%d' % build_id
+
+
+def _claimed_key(build_id):
+    return 'build-claimed-%d' % build_id
+
+
+def _speculation_key(project_id):
+    return 'build-speculation-%d' % project_id
+
+
+def _speculative_build_key(project_id):
+    return 'build-speculative-%d' % project_id
+
+
+_fair_running_key = 'build-fair-running'
+_fair_users_key = 'build-fair-users'
+
+
+def _fair_pending_key(user_id):
+    return 'build-fair-pending-%s' % user_id
+
+
+def _fair_user_running_key(user_id):
+    return 'build-fair-running-user-%s' % user_id
+
+
+def _fair_project_running_key(project_id):
+    return 'build-fair-running-project-%s' % project_id
+
+
+def _fair_slot_key(build_id):
+    return 'build-fair-slot-%s' % build_id
+
+
+def _affinity_key(project_id):
+    return 'build-affinity-%d' % project_id
+
+
+def _worker_key(hostname):
+    return 'build-worker-%s' % hostname
+
+
+def record_affinity(project_id, hostname):
+    """
+    Notes that the worker called hostname has a workspace for the project, so its next build should go there.
+    """
+    redis_client.set(_affinity_key(project_id), hostname, ex=settings.PROJECT_WORKSPACE_AFFINITY_TTL)
+
+
+def _routing_options(project_id):
+    """
+    :return: the options that send the project's build to the worker holding its workspace, if that worker is alive.
+    """
+    if not settings.PROJECT_WORKSPACES:
+        return {}
+    hostname = redis_client.get(_affinity_key(project_id))
+    if hostname is None or not redis_client.exists(_worker_key(hostname)):
+        return {}
+    # Each worker consumes from its own queue on the C.dq exchange when CELERY_WORKER_DIRECT is set.
+    return {'exchange': 'C.dq', 'routing_key': hostname}
+
+
+def start_worker_heartbeat(hostname, interval=20):
+    """
+    Keeps a key in redis alive for as long as this worker is, so that builds are only routed to workers that
+    are still around to pick them up.
+    """
+    def beat():
+        while True:
+            try:
+                redis_client.set(_worker_key(hostname), '1', ex=interval * 3)
+            except Exception as e:
+                print "Couldn't send worker heartbeat: %s" % e
+            time.sleep(interval)
+    thread = threading.Thread(target=beat)
+    thread.daemon = True
+    thread.start()
+
+
+def schedule_build(project, debug_info=None, platforms=None):
+    """
+    Requests a build of the project. If a build of it is already queued and hasn't started yet, it will pick up
+    the project as it is now, so that build is returned instead of queuing another. Otherwise a new build is
+    queued and, if settings.CANCEL_SUPERSEDED_BUILDS is set, any running build of the project whose platforms the
+    new one also builds is asked to stop.
+    If settings.FAIR_BUILD_SCHEDULING is set, new builds wait their turn in dispatch_builds, and BuildRejected is
+    raised if the project's owner already has as many builds waiting as they're allowed.
+    :param debug_info: passed on to run_compile, for new builds.
+    :param platforms: a list of the project's platforms to build, if it shouldn't be built for all of them.
+    :return: a tuple of the BuildResult and the id of the task that will build it.
+    """
+    from ide.tasks.build import run_compile
+
+    # Speculative builds are of every platform, so one will do whichever were asked for.
+    if settings.SPECULATIVE_BUILDS:
+        promoted = promote_speculative_build(project)
+        if promoted is not None:
+            return promoted
+
+    build = BuildResult.objects.create(project=project, platforms=','.join(platforms) if platforms else None)
+    task_id = str(uuid.uuid4())
+    ours = '%d:%s' % (build.id, task_id)
+    queued_key = _queued_key(project.id, build.platforms)
+    current = _join_or_queue(keys=[queued_key], args=[ours, settings.BUILD_QUEUED_TTL])
+    if current != ours:
+        queued_build_id, queued_task_id = current.split(':', 1)
+        try:
+            queued_build = BuildResult.objects.get(pk=int(queued_build_id), state=BuildResult.STATE_WAITING)
+        except BuildResult.DoesNotExist:
+            # Whatever that was has gone away without claiming its key; queue ours in its place.
+            redis_client.set(queued_key, ours, ex=settings.BUILD_QUEUED_TTL)
+        else:
+            build.delete()
+            return queued_build, queued_task_id
+
+    if settings.FAIR_BUILD_SCHEDULING:
+        job = json.dumps({'build': str(build.id), 'task': task_id, 'project': str(project.id), 'debug_info': debug_info})
+        if _enqueue_fair(keys=[_fair_pending_key(project.owner_id), _fair_users_key],
+                         args=[project.owner_id, job, settings.MAX_PENDING_BUILDS_PER_USER]) < 0:
+            _delete_if_prefixed(keys=[queued_key], args=['%d:' % build.id])
+            build.delete()
+            raise BuildRejected("You already have %d builds waiting; try again once one has started."
+                                % settings.MAX_PENDING_BUILDS_PER_USER)
+
+    if settings.CANCEL_SUPERSEDED_BUILDS:
+        cancel_superseded_builds(project.id, build.platforms)
+
+    if settings.FAIR_BUILD_SCHEDULING:
+        dispatch_builds()
+    else:
+        run_compile.apply_async(args=[build.id], kwargs={'debug_info': debug_info}, task_id=task_id,
+                                **_routing_options(project.id))
+    return build, task_id
+
+
+def _supersedes(platforms, running_platforms):
+    """
+    :return: True if a build of platforms (comma-separated, or empty for all of them) makes one of running_platforms
+    pointless.
+    """
+    if not platforms:
+        return True
+    if not running_platforms:
+        return False
+    return set(running_platforms.split(',')) <= set(platforms.split(','))
+
+
+def cancel_superseded_builds(project_id, platforms):
+    """
+    Asks every running build of the project whose platforms a new build of platforms also builds to stop. A build of
+    only some platforms never stops one of more, so that nobody loses a build they were waiting for.
+    """
+    for build_id, running_platforms in redis_client.hgetall(_running_key(project_id)).iteritems():
+        if _supersedes(platforms, running_platforms):
+            redis_client.set(_cancel_key(int(build_id)), '1', ex=settings.CELERYD_TASK_TIME_LIMIT)
+
+
+def dispatch_builds():
+    """
+    Sends waiting builds to the workers for as long as there's room, taking one from each user in turn. A build only
+    goes once fewer than settings.MAX_BUILDS_PER_USER of its owner's builds, and fewer than
+    settings.MAX_BUILDS_PER_PROJECT of its project's, are running, and fewer than settings.MAX_BUILDS_IN_FLIGHT
+    builds are running in total. Builds count as running from when they're dispatched until release_build.
+    """
+    from ide.tasks.build import run_compile
+
+    while True:
+        job = _dispatch_next_build()
+        if job is None:
+            return
+        run_compile.apply_async(args=[int(job['build'])], kwargs={'debug_info': job['debug_info']},
+                                task_id=job['task'], **_routing_options(int(job['project'])))
+
+
+def _dispatch_next_build():
+    """
+    Visits the users with pending builds in turn, and takes the first build that can start without going over any of
+    the limits. Users are sent to the back of the line once they've had a build taken or none of theirs could go.
+    :return: the job that was taken, or None if there wasn't one.
+    """
+    # A build that has been dispatched will have been killed by the time limit if it started at all, or dropped by
+    # now if it never did.
+    slot_ttl = settings.BUILD_QUEUED_TTL + settings.CELERYD_TASK_TIME_LIMIT
+    for user in redis_client.lrange(_fair_users_key, 0, -1):
+        pending_key = _fair_pending_key(user)
+        for entry in redis_client.lrange(pending_key, 0, -1):
+            job = json.loads(entry)
+            now_time = time.time()
+            result = _claim_fair_slot(keys=[_fair_running_key, _fair_user_running_key(user),
+                                            _fair_project_running_key(job['project']), pending_key, _fair_users_key,
+                                            _fair_slot_key(job['build'])],
+                                      args=[now_time, now_time + slot_ttl, settings.MAX_BUILDS_IN_FLIGHT,
+                                            settings.MAX_BUILDS_PER_USER, settings.MAX_BUILDS_PER_PROJECT, slot_ttl,
+                                            entry, user, job['build'], '%s:%s' % (user, job['project'])])
+            if result == _FAIR_SLOT_TAKEN:
+                return job
+            if result == _FAIR_SLOT_TOTAL_LIMIT:
+                return None
+            if result == _FAIR_SLOT_USER_LIMIT:
+                break
+        _requeue_fair_user(keys=[_fair_users_key], args=[user])
+    return None
+
+
+def _has_free_slot(project_id):
+    """
+    :return: True if a build of the project could be dispatched now without going over any of the limits that
+    dispatch_builds keeps to, and no other builds are waiting.
+    """
+    owner_id = Project.objects.values_list('owner_id', flat=True).get(pk=project_id)
+    now_time = time.time()
+    pipe = redis_client.pipeline()
+    pipe.llen(_fair_users_key)
+    for key in (_fair_running_key, _fair_user_running_key(owner_id), _fair_project_running_key(project_id)):
+        pipe.zcount(key, now_time, '+inf')
+    waiting_users, running, user_running, project_running = pipe.execute()
+    return (waiting_users == 0 and running < settings.MAX_BUILDS_IN_FLIGHT and
+            user_running < settings.MAX_BUILDS_PER_USER and project_running < settings.MAX_BUILDS_PER_PROJECT)
+
+
+def get_queue_position(build_result):
+    """
+    Works out where a build is in the line of builds waiting to be dispatched, assuming each user with builds waiting
+    gets one dispatched in turn.
+    :return: how many builds are ahead of it, or None if it isn't waiting to be dispatched.
+    """
+    users = redis_client.lrange(_fair_users_key, 0, -1)
+    pipe = redis_client.pipeline()
+    for user in users:
+        pipe.lrange(_fair_pending_key(user), 0, -1)
+    pending = pipe.execute()
+    ours = str(build_result.project.owner_id)
+    if ours not in users:
+        return None
+    our_place = users.index(ours)
+    our_pending = [json.loads(x)['build'] for x in pending[our_place]]
+    if str(build_result.id) not in our_pending:
+        return None
+    turn = our_pending.index(str(build_result.id))
+    # Everyone in the line ahead of us gets one more go before ours than those behind us.
+    position = turn
+    for i, entries in enumerate(pending):
+        if i != our_place:
+            position += min(len(entries), turn + 1 if i < our_place else turn)
+    return position
+
+
+def schedule_speculative_build(project):
+    """
+    Requests a low-priority build of the project as it is now, to be started after settings.SPECULATIVE_BUILD_DELAY
+    seconds unless this is called again in the meantime, in the hope that the user will ask for a build of the same
+    state of the project shortly afterwards.
+    """
+    from ide.tasks.build import run_speculative_compile
+
+    token = str(uuid.uuid4())
+    redis_client.set(_speculation_key(project.id), token,
+                     ex=settings.SPECULATIVE_BUILD_DELAY + settings.BUILD_QUEUED_TTL)
+    run_speculative_compile.apply_async(args=[project.id, token], countdown=settings.SPECULATIVE_BUILD_DELAY,
+                                        queue=settings.SPECULATIVE_BUILD_QUEUE)
+
+
+def start_speculative_build(project_id, token, task_id):
+    """
+    Called by the speculative build task once its delay is up.
+    :return: a BuildResult to build, or None if another speculative build was requested since this one.
+    """
+    if not _delete_if_prefixed(keys=[_speculation_key(project_id)], args=[token]):
+        return None
+    # Speculative builds only use what real builds have left over.
+    if settings.FAIR_BUILD_SCHEDULING and not _has_free_slot(project_id):
+        return None
+    # Anything that changes after this point means the build isn't of the current revision, even if it saw the change.
+    revision = get_project_revision(project_id)
+    build = BuildResult.objects.create(project_id=project_id, speculative=True)
+    redis_client.set(_speculative_build_key(project_id), '%s:%d:%s' % (revision, build.id, task_id),
+                     ex=settings.SPECULATIVE_BUILD_TTL)
+    return build
+
+
+def promote_speculative_build(project):
+    """
+    Finds a speculative build of the project as it is now which has either succeeded or is still running, and makes
+    it an ordinary build.
+    :return: a tuple of the BuildResult and the id of the task building it, or None if there isn't one.
+    """
+    current = redis_client.get(_speculative_build_key(project.id))
+    if current is None:
+        return None
+    revision, build_id, task_id = current.split(':', 2)
+    if revision != get_project_revision(project.id):
+        return None
+    try:
+        build = BuildResult.objects.get(pk=int(build_id))
+    except BuildResult.DoesNotExist:
+        return None
+    # A waiting build that isn't running might never run at all.
+    if not (build.state == BuildResult.STATE_SUCCEEDED or
+            (build.state == BuildResult.STATE_WAITING and redis_client.exists(_claimed_key(build.id)))):
+        return None
+    if build.speculative:
+        BuildResult.objects.filter(pk=build.pk).update(speculative=False)
+        build.speculative = False
+    return build, task_id
+
+
+def claim_build(build_result):
+    """
+    Called by the build task before it looks at the project. From here on, new build requests for the project get
+    a build of their own instead of joining this one. Speculative builds aren't recorded among the project's running
+    builds, so that they can't be mistaken for one the user asked for.
+    """
+    project_id = build_result.project_id
+    if not build_result.speculative:
+        _delete_if_prefixed(keys=[_queued_key(project_id, build_result.platforms)], args=['%d:' % build_result.id])
+        pipe = redis_client.pipeline()
+        pipe.hset(_running_key(project_id), build_result.id, build_result.platforms or '')
+        pipe.expire(_running_key(project_id), settings.CELERYD_TASK_TIME_LIMIT)
+        pipe.execute()
+    redis_client.set(_claimed_key(build_result.id), str(time.time()), ex=settings.CELERYD_TASK_TIME_LIMIT)
+
+
+def get_claim_time(build_result):
+    """
+    :return: when the build task started on the build, or None if it hasn't yet.
+    """
+    claimed = redis_client.get(_claimed_key(build_result.id))
+    if claimed is None:
+        return None
+    return datetime.datetime.utcfromtimestamp(float(claimed)).replace(tzinfo=utc)
+
+
+def count_builds_ahead(build_result):
+    """
+    Counts the builds that will start before one that hasn't. With settings.FAIR_BUILD_SCHEDULING, those are the
+    builds already dispatched and those that get_queue_position says are ahead of it. Otherwise builds are taken
+    in order, so they're the unfinished builds requested before it.
+    :return: a tuple of the number of builds ahead and the build's queue position, which is None if it has been
+    dispatched or fair scheduling is off.
+    """
+    window = settings.BUILD_QUEUED_TTL + settings.CELERYD_TASK_TIME_LIMIT
+    if settings.FAIR_BUILD_SCHEDULING:
+        position = get_queue_position(build_result)
+        if position is not None:
+            return redis_client.zcount(_fair_running_key, time.time(), '+inf') + position, position
+    earlier = BuildResult.objects.filter(state=BuildResult.STATE_WAITING, speculative=False,
+                                         started__gte=now() - datetime.timedelta(seconds=window),
+                                         started__lt=build_result.started)
+    return earlier.count(), None
+
+
+def release_build(build_result):
+    redis_client.hdel(_running_key(build_result.project_id), build_result.id)
+    redis_client.delete(_cancel_key(build_result.id), _claimed_key(build_result.id))
+    if settings.FAIR_BUILD_SCHEDULING:
+        release_build_slot(build_result.id)
+
+
+def release_build_slot(build_id):
+    """
+    Frees the place dispatch_builds gave the build, if it had one, and dispatches whatever can go in its place.
+    Needs only the build's id, so it works even if the build itself has gone.
+    """
+    slot = redis_client.get(_fair_slot_key(build_id))
+    if slot is not None:
+        user_id, project_id = slot.split(':', 1)
+        pipe = redis_client.pipeline()
+        for key in (_fair_running_key, _fair_user_running_key(user_id), _fair_project_running_key(project_id)):
+            pipe.zrem(key, build_id)
+        pipe.delete(_fair_slot_key(build_id))
+        pipe.execute()
+    dispatch_builds()
+
+
+def start_dispatch_timer(interval=30):
+    """
+    Dispatches builds every so often, so that builds waiting on a slot held by a build whose worker died go out once
+    that slot has expired, even if no other build finishes or is requested in the meantime.
+    """
+    def tick():
+        while True:
+            time.sleep(interval)
+            try:
+                dispatch_builds()
+            except Exception as e:
+                print "Couldn't dispatch builds: %s" % e
+    thread = threading.Thread(target=tick)
+    thread.daemon = True
+    thread.start()
+
+
+class CancellationWatcher(threading.Thread):
+    """
+    Watches for a build being superseded, and kills the processes building it when it is.
+    Processes must be started in their own process group so that everything they started goes too.
+    """
+    def __init__(self, build_id, interval=1):
+        super(CancellationWatcher, self).__init__()
+        self.daemon = True
+        self.cancelled = False
+        self._key = _cancel_key(build_id)
+        self._interval = interval
+        self._processes = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def register(self, process):
+        with self._lock:
+            self._processes.append(process)
+            if self.cancelled:
+                self._kill(process)
+
+    def _kill(self, process):
+        if process.poll() is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                if not redis_client.exists(self._key):
+                    continue
+            except Exception as e:
+                print "Couldn't check for build cancellation: %s" % e
+                continue
+            with self._lock:
+                self.cancelled = True
+                for process in self._processes:
+                    self._kill(process)
+            return
+
+    def stop(self):
+        self._stopped.set()
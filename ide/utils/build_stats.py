@@ -0,0 +1,128 @@
+import bisect
+import json
+
+from django.db import transaction, IntegrityError
+
+from ide.models.build import BuildResult, BuildStats
+
+# Upper bounds, in seconds, of the histogram buckets: 0.1s to about 45 minutes, each 19% wider than the last.
+# Anything longer goes in one more bucket on the end.
+HISTOGRAM_BOUNDS = [0.1 * 2 ** (i / 4.0) for i in xrange(60)]
+
+
+def histogram_add(counts, value):
+    if len(counts) < len(HISTOGRAM_BOUNDS) + 1:
+        counts.extend([0] * (len(HISTOGRAM_BOUNDS) + 1 - len(counts)))
+    counts[bisect.bisect_left(HISTOGRAM_BOUNDS, value)] += 1
+
+
+def histogram_merge(histograms):
+    merged = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+    for counts in histograms:
+        for i, count in enumerate(counts):
+            merged[i] += count
+    return merged
+
+
+def histogram_percentile(counts, percentile):
+    """
+    :return: the upper bound of the bucket the percentile falls in, or None if the histogram is empty. Values that
+    fell off the end of the histogram are reported as the largest bound.
+    """
+    total = sum(counts)
+    if total == 0:
+        return None
+    target = total * percentile / 100.0
+    seen = 0
+    for i, count in enumerate(counts):
+        seen += count
+        if seen >= target and count > 0:
+            return HISTOGRAM_BOUNDS[min(i, len(HISTOGRAM_BOUNDS) - 1)]
+    return HISTOGRAM_BOUNDS[-1]
+
+
+def _build_platforms(build_result, sizes):
+    if sizes:
+        return sizes.keys()
+    return build_result.platform_list or build_result.project.get_build_platforms()
+
+
+def _add_to_rollup(key, failed, duration, queue_wait, size):
+    with transaction.atomic():
+        try:
+            stats = BuildStats.objects.select_for_update().get(**key)
+        except BuildStats.DoesNotExist:
+            try:
+                with transaction.atomic():
+                    stats = BuildStats.objects.create(**key)
+            except IntegrityError:
+                # Another build finishing at the same time got there first.
+                stats = BuildStats.objects.select_for_update().get(**key)
+
+        stats.builds += 1
+        if failed:
+            stats.failures += 1
+        durations = json.loads(stats.duration_histogram)
+        histogram_add(durations, duration)
+        stats.duration_histogram = json.dumps(durations)
+        stats.duration_total += duration
+        if queue_wait is not None:
+            queue_waits = json.loads(stats.queue_wait_histogram)
+            histogram_add(queue_waits, queue_wait)
+            stats.queue_wait_histogram = json.dumps(queue_waits)
+            stats.queue_wait_total += queue_wait
+        if size is not None:
+            stats.sized_builds += 1
+            stats.binary_size_total += size.binary_size or 0
+            stats.resource_size_total += size.resource_size or 0
+        stats.save()
+
+
+def record_build_stats(build_result):
+    """
+    Adds a finished build to the hourly rollups for its SDK version, project type and platforms.
+    """
+    project = build_result.project
+    metrics = build_result.get_metrics() or {}
+    queue_wait = metrics.get('queue_wait', None)
+    duration = (build_result.finished - build_result.started).total_seconds() - (queue_wait or 0)
+    sizes = {size.platform: size for size in build_result.sizes.all()}
+    failed = build_result.state != BuildResult.STATE_SUCCEEDED
+    hour = build_result.finished.replace(minute=0, second=0, microsecond=0)
+
+    for platform in [''] + list(_build_platforms(build_result, sizes)):
+        key = {'hour': hour, 'sdk_version': project.sdk_version, 'project_type': project.project_type,
+               'platform': platform}
+        _add_to_rollup(key, failed, duration, queue_wait, sizes.get(platform, None))
+
+
+def summarise_build_stats(rollups):
+    """
+    Combines a set of BuildStats rows into one summary.
+    :return: a dict of the number of builds, their failure rate, duration and queue wait percentiles and means,
+    and mean binary and resource sizes.
+    """
+    builds = sum(x.builds for x in rollups)
+    failures = sum(x.failures for x in rollups)
+    sized_builds = sum(x.sized_builds for x in rollups)
+
+    def distribution(histogram_field, total_field):
+        histogram = histogram_merge(json.loads(getattr(x, histogram_field)) for x in rollups)
+        count = sum(histogram)
+        return {
+            'count': count,
+            'mean': sum(getattr(x, total_field) for x in rollups) / count if count else None,
+            'p50': histogram_percentile(histogram, 50),
+            'p95': histogram_percentile(histogram, 95),
+            'p99': histogram_percentile(histogram, 99),
+        }
+
+    return {
+        'builds': builds,
+        'failures': failures,
+        'failure_rate': float(failures) / builds if builds else None,
+        'duration': distribution('duration_histogram', 'duration_total'),
+        'queue_wait': distribution('queue_wait_histogram', 'queue_wait_total'),
+        'mean_binary_size': sum(x.binary_size_total for x in rollups) / sized_builds if sized_builds else None,
+        'mean_resource_size': sum(x.resource_size_total for x in rollups) / sized_builds if sized_builds else None,
+    }
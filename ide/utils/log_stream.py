@@ -0,0 +1,121 @@
+import threading
+
+from django.conf import settings
+
+from utils.redis_helper import redis_client
+
+
+class BuildLogStream(object):
+    """
+    The output of a running build, kept in redis so that it can be followed while the build is still going.
+    Lines are numbered from zero; only the most recent settings.BUILD_LOG_STREAM_LINES are kept, and everything
+    expires settings.BUILD_LOG_STREAM_EXPIRY seconds after the build finishes.
+    Lines are sent to redis in batches, once settings.BUILD_LOG_STREAM_BATCH_LINES have been written or
+    settings.BUILD_LOG_STREAM_BATCH_MS milliseconds after the first line of the batch, whichever is sooner.
+    If sink_path is given, every line is also appended to the file there, which can be saved as the complete log
+    once the build finishes, so the build never has to hold the whole of it in memory.
+    """
+    def __init__(self, build_id, sink_path=None):
+        self.lines_key = 'build-log-%d' % build_id
+        self.offset_key = 'build-log-%d-offset' % build_id
+        self.finished_key = 'build-log-%d-finished' % build_id
+        self.sink_path = sink_path
+        self._sink = open(sink_path, 'a') if sink_path is not None else None
+        self._pending = []
+        self._timer = None
+        # How many lines have been sent to redis, so we know how many have been trimmed from the front.
+        self._sent = 0
+        # Platforms built in parallel write their lines from threads of their own.
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        """
+        Writes some output that didn't come a line at a time.
+        """
+        if text and not text.endswith('\n'):
+            text += '\n'
+        for line in text.splitlines(True):
+            self.write_line(line)
+
+    def write_line(self, line):
+        with self._lock:
+            if self._sink is not None:
+                self._sink.write(line)
+            self._pending.append(line)
+            if len(self._pending) >= settings.BUILD_LOG_STREAM_BATCH_LINES:
+                # Losing the live log mustn't stop the complete one being written.
+                try:
+                    self._send()
+                except Exception as e:
+                    print "Couldn't stream build output: %s" % e
+            elif self._timer is None:
+                self._timer = threading.Timer(settings.BUILD_LOG_STREAM_BATCH_MS / 1000.0, self._send_later)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _send_later(self):
+        with self._lock:
+            try:
+                self._send()
+            except Exception as e:
+                print "Couldn't stream build output: %s" % e
+
+    def _send(self):
+        """
+        Sends the lines written since the last batch to redis in one go. Must be called holding self._lock.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        pipe = redis_client.pipeline()
+        pipe.rpush(self.lines_key, *self._pending)
+        pipe.ltrim(self.lines_key, -settings.BUILD_LOG_STREAM_LINES, -1)
+        if self._sent == 0:
+            # Only the first batch sets when it all expires, in case the build dies before finishing it.
+            pipe.expire(self.lines_key, settings.BUILD_LOG_STREAM_EXPIRY)
+        self._sent += len(self._pending)
+        self._pending = []
+        if self._sent > settings.BUILD_LOG_STREAM_LINES:
+            pipe.set(self.offset_key, self._sent - settings.BUILD_LOG_STREAM_LINES, ex=settings.BUILD_LOG_STREAM_EXPIRY)
+        pipe.execute()
+
+    def flush(self):
+        """
+        Makes sure everything written so far is in redis and in the file at sink_path.
+        """
+        with self._lock:
+            self._send()
+            if self._sink is not None:
+                self._sink.flush()
+
+    def finish(self):
+        with self._lock:
+            if self._sink is not None:
+                self._sink.close()
+                self._sink = None
+            self._send()
+            expiry = settings.BUILD_LOG_STREAM_EXPIRY
+            pipe = redis_client.pipeline()
+            pipe.expire(self.lines_key, expiry)
+            pipe.expire(self.offset_key, expiry)
+            pipe.set(self.finished_key, '1', ex=expiry)
+            pipe.execute()
+
+    def read(self, cursor):
+        """
+        :param cursor: the number of the first line wanted.
+        :return: a tuple of the lines from cursor onwards, the cursor to ask for next, whether the build has finished,
+        and whether lines were skipped because they had already been dropped from the buffer.
+        """
+        # The pipeline runs as a transaction, so the offset always matches the lines we get back.
+        pipe = redis_client.pipeline()
+        pipe.get(self.offset_key)
+        pipe.lrange(self.lines_key, 0, -1)
+        pipe.exists(self.finished_key)
+        offset, lines, finished = pipe.execute()
+        offset = int(offset or 0)
+        start = max(cursor - offset, 0)
+        lines = lines[start:]
+        return lines, offset + start + len(lines), bool(finished), cursor < offset
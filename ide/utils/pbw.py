@@ -0,0 +1,216 @@
+import json
+import struct
+import uuid
+import zipfile
+
+# Where the SDK's inject_metadata puts things in the header of pebble-app.bin.
+_APP_VERSION_OFFSET = 12
+_APP_NAME_OFFSET = 24
+_APP_COMPANY_OFFSET = 56
+_APP_FLAGS_OFFSET = 96
+_APP_UUID_OFFSET = 104
+_APP_STRING_LENGTH = 32
+_APP_FLAG_WATCHFACE = 1
+
+
+class PBWPatchError(Exception):
+    pass
+
+
+def _crc_table():
+    table = []
+    for i in xrange(256):
+        value = i << 24
+        for j in xrange(8):
+            value = ((value << 1) ^ 0x04C11DB7) if value & 0x80000000 else (value << 1)
+        table.append(value & 0xffffffff)
+    return table
+
+_CRC_TABLE = _crc_table()
+
+
+def stm32_crc(data):
+    """
+    :return: the CRC the watch's STM32 hardware computes for data, which the PBW manifest records for each binary.
+    It works on little-endian words, with any odd bytes on the end padded in their own peculiar way.
+    """
+    crc = 0xffffffff
+    for i in xrange(0, len(data), 4):
+        word = data[i:i + 4]
+        if len(word) < 4:
+            word = word[::-1] + '\0' * (4 - len(word))
+        for char in reversed(word):
+            crc = ((crc << 8) ^ _CRC_TABLE[(crc >> 24) ^ ord(char)]) & 0xffffffff
+    return crc
+
+
+def merge_pbws(pbw_paths, dest_path):
+    """
+    Combines PBWs that were each built for a subset of an app's platforms into one PBW for all of them.
+    Where more than one PBW contains the same file, the first one wins, except for appinfo.json, whose
+    targetPlatforms is rewritten to cover every platform that went into the merged PBW.
+    """
+    seen = set()
+    appinfo = None
+    platforms = []
+    with zipfile.ZipFile(dest_path, 'w', zipfile.ZIP_DEFLATED) as dest:
+        for path in pbw_paths:
+            with zipfile.ZipFile(path, 'r') as z:
+                for info in z.infolist():
+                    if info.filename == 'appinfo.json':
+                        this_appinfo = json.loads(z.read(info))
+                        if appinfo is None:
+                            appinfo = this_appinfo
+                        for platform in this_appinfo.get('targetPlatforms', []):
+                            if platform not in platforms:
+                                platforms.append(platform)
+                        continue
+                    if info.filename in seen:
+                        continue
+                    seen.add(info.filename)
+                    dest.writestr(info, z.read(info))
+        if appinfo is not None:
+            if platforms:
+                appinfo['targetPlatforms'] = platforms
+            dest.writestr('appinfo.json', json.dumps(appinfo))
+
+
+def _pack_version(version_label):
+    try:
+        major, minor = [int(x) for x in version_label.split('.')]
+        return struct.pack('<BB', major, minor)
+    except (ValueError, AttributeError, struct.error):
+        raise PBWPatchError("Can't encode the app's version")
+
+
+def _app_metadata(manifest_dict):
+    """
+    :return: the header fields of pebble-app.bin that come from appinfo.json, as (offset, packed value) pairs.
+    Raises PBWPatchError for anything the SDK would have encoded some other way.
+    """
+    try:
+        version = _pack_version(manifest_dict['versionLabel'])
+        name = manifest_dict['shortName'].encode('ascii')
+        company = manifest_dict['companyName'].encode('ascii')
+        app_uuid = uuid.UUID(manifest_dict['uuid']).bytes
+    except (ValueError, KeyError, AttributeError, UnicodeError):
+        raise PBWPatchError("Can't encode the app's metadata")
+    if len(name) >= _APP_STRING_LENGTH or len(company) >= _APP_STRING_LENGTH:
+        raise PBWPatchError("App metadata is too long")
+    return [
+        (_APP_VERSION_OFFSET, version),
+        (_APP_NAME_OFFSET, struct.pack('<32s', name)),
+        (_APP_COMPANY_OFFSET, struct.pack('<32s', company)),
+        (_APP_UUID_OFFSET, app_uuid),
+    ]
+
+
+def _patch_app_binary(binary, template_manifest, manifest_dict):
+    binary = bytearray(binary)
+    for (offset, old), (new_offset, new) in zip(_app_metadata(template_manifest), _app_metadata(manifest_dict)):
+        if binary[offset:offset + len(old)] != old:
+            raise PBWPatchError("pebble-app.bin doesn't have the template's metadata at %d" % offset)
+        binary[offset:offset + len(new)] = new
+    flags, = struct.unpack_from('<I', binary, _APP_FLAGS_OFFSET)
+    if template_manifest['watchapp']['watchface'] != bool(flags & _APP_FLAG_WATCHFACE):
+        raise PBWPatchError("pebble-app.bin doesn't have the template's flags")
+    if manifest_dict['watchapp']['watchface']:
+        flags |= _APP_FLAG_WATCHFACE
+    else:
+        flags &= ~_APP_FLAG_WATCHFACE
+    struct.pack_into('<I', binary, _APP_FLAGS_OFFSET, flags)
+    return str(binary)
+
+
+def patch_pbw(template_path, dest_path, template_manifest, manifest_dict, js_placeholder, js):
+    """
+    Makes a PBW for an app that differs from the template PBW only in its appinfo.json and its JavaScript, without
+    building anything: the metadata the SDK put in the template's pebble-app.bin is rewritten to match
+    manifest_dict, and js_placeholder in pebble-js-app.js is replaced with js. Raises PBWPatchError, having written
+    nothing, if the template isn't what we expected.
+    """
+    with zipfile.ZipFile(template_path, 'r') as template:
+        names = template.namelist()
+        for required in ('manifest.json', 'appinfo.json', 'pebble-app.bin', 'pebble-js-app.js'):
+            if required not in names:
+                raise PBWPatchError("Template has no %s" % required)
+        binary = template.read('pebble-app.bin')
+        manifest = json.loads(template.read('manifest.json'))
+        if manifest.get('application', {}).get('crc') != stm32_crc(binary):
+            raise PBWPatchError("Template's manifest doesn't match its binary")
+        binary = _patch_app_binary(binary, template_manifest, manifest_dict)
+        manifest['application']['crc'] = stm32_crc(binary)
+
+        script = template.read('pebble-js-app.js')
+        if script.count(js_placeholder) != 1:
+            raise PBWPatchError("Template's JavaScript doesn't have exactly one placeholder")
+        before, after = script.split(js_placeholder)
+        script = before + js + after
+
+        replacements = {
+            'manifest.json': json.dumps(manifest),
+            'appinfo.json': json.dumps(manifest_dict),
+            'pebble-app.bin': binary,
+            'pebble-js-app.js': script,
+        }
+        with zipfile.ZipFile(dest_path, 'w', zipfile.ZIP_DEFLATED) as dest:
+            for info in template.infolist():
+                if info.filename in replacements:
+                    dest.writestr(info, replacements[info.filename])
+                else:
+                    dest.writestr(info, template.read(info))
+
+
+def _repackage_binaries(pbw, replacements, old_manifest, manifest_dict):
+    """
+    Adds to replacements each binary in pbw with its version changed from old_manifest's to manifest_dict's, along
+    with the manifests that list them.
+    """
+    old_version = _pack_version(old_manifest['versionLabel'])
+    new_version = _pack_version(manifest_dict['versionLabel'])
+    # SDK 3 PBWs have a manifest for each platform, listing the binaries in the same directory.
+    for manifest_name in [x for x in pbw.namelist() if x == 'manifest.json' or x.endswith('/manifest.json')]:
+        directory = manifest_name[:-len('manifest.json')]
+        manifest = json.loads(pbw.read(manifest_name))
+        for kind in ('application', 'worker'):
+            if kind not in manifest:
+                continue
+            binary_name = directory + manifest[kind]['name']
+            if binary_name not in replacements:
+                binary = pbw.read(binary_name)
+                if manifest[kind].get('crc') != stm32_crc(binary):
+                    raise PBWPatchError("%s doesn't match its manifest" % binary_name)
+                if binary[_APP_VERSION_OFFSET:_APP_VERSION_OFFSET + len(old_version)] != old_version:
+                    raise PBWPatchError("%s doesn't have the old version" % binary_name)
+                replacements[binary_name] = binary[:_APP_VERSION_OFFSET] + new_version + \
+                    binary[_APP_VERSION_OFFSET + len(new_version):]
+            manifest[kind]['crc'] = stm32_crc(replacements[binary_name])
+        replacements[manifest_name] = json.dumps(manifest)
+
+
+def repackage_pbw(pbw_path, dest_path, manifest_dict, js):
+    """
+    Makes a PBW for a native app from the PBW of an earlier build whose binaries and resources were built from the
+    same code, without building anything: its appinfo.json and pebble-js-app.js are replaced, and the version in
+    the header of every binary is rewritten to match manifest_dict. Raises PBWPatchError, having written nothing,
+    if the old PBW isn't what we expected.
+    :param js: the new contents of pebble-js-app.js, or None if the app has no JavaScript.
+    """
+    with zipfile.ZipFile(pbw_path, 'r') as old:
+        names = old.namelist()
+        if ('pebble-js-app.js' in names) != (js is not None):
+            raise PBWPatchError("Can't add or remove JavaScript")
+        replacements = {'appinfo.json': json.dumps(manifest_dict)}
+        if js is not None:
+            replacements['pebble-js-app.js'] = js
+        try:
+            _repackage_binaries(old, replacements, json.loads(old.read('appinfo.json')), manifest_dict)
+        except (KeyError, ValueError, TypeError) as e:
+            raise PBWPatchError("Old PBW isn't laid out as expected: %s" % e)
+
+        with zipfile.ZipFile(dest_path, 'w', zipfile.ZIP_DEFLATED) as dest:
+            for info in old.infolist():
+                if info.filename in replacements:
+                    dest.writestr(info, replacements[info.filename])
+                else:
+                    dest.writestr(info, old.read(info))
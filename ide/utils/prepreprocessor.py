@@ -1,24 +1,44 @@
+import hashlib
 import re
-import uuid
 import os.path
 from django.utils.translation import ugettext as _
 
-def fix_newlines(source):
-    return re.sub(r'\r\n|\r|\n', '\n', source)
+# Backslash-newlines, which join lines before anything else happens. GCC allows whitespace between the two.
+_continuation = re.compile(r'\\[ \t\f\v]*\n')
 
+# Scans a source file in one pass. Comments and string and character literals are matched so that nothing inside
+# them is mistaken for a directive, and runs of anything else are skipped over a line at a time. Comments count as
+# whitespace, including before the '#'.
+_comment = r'/\*[^*]*\*+(?:[^/*][^*]*\*+)*/'
+_space = r'(?:[ \t\f\v]|%s)*' % _comment
+_tokens = re.compile(r"""
+    ^{space}(?:\#|%:){space}(?:include(?:_next)?|import){space}(?:<(?P<system>[^>\n]+)>|"(?P<local>[^"\n]+)")
+    | {comment}
+    | //[^\n]*
+    | "(?:\\.|[^"\\\n])*"
+    | '(?:\\.|[^'\\\n])*'
+    | [^"'/\n]+
+""".format(space=_space, comment=_comment), re.MULTILINE | re.VERBOSE)
 
-def merge_newlines(source):
-    return source.replace('\\\n', '')
-
-
-def remove_comments(source):
-    no_mutiline = re.sub(r'/\*.*?\*/', ' ', source, flags=re.DOTALL|re.MULTILINE)
-    no_single_line = re.sub(r'//.*$', ' ', no_mutiline, flags=re.MULTILINE)
-    return no_single_line
+# Includes found in recently checked files, by the digest of their contents.
+_include_cache = {}
+_INCLUDE_CACHE_SIZE = 4096
 
 
 def extract_includes(source):
-    return re.findall(r'^#\s*include\s*[<"](.+)[">]\s*$', source, flags=re.MULTILINE)
+    """
+    :return: the file named by every literal #include in source, in order.
+    """
+    if '\r' in source:
+        source = source.replace('\r\n', '\n').replace('\r', '\n')
+    if '\\' in source:
+        source = _continuation.sub('', source)
+    includes = []
+    for match in _tokens.finditer(source):
+        include = match.group('system') or match.group('local')
+        if include is not None:
+            includes.append(include)
+    return includes
 
 
 def check_include_legal(abs_dir, abs_target, include):
@@ -29,10 +49,13 @@ def check_include_legal(abs_dir, abs_target, include):
 
 
 def process_file(abs_dir, abs_target, source):
-    processed_text = remove_comments(merge_newlines(fix_newlines(source)))
-    includes = extract_includes(processed_text)
+    key = hashlib.sha1(source).digest()
+    includes = _include_cache.get(key, None)
+    if includes is None:
+        includes = extract_includes(source)
+        if len(_include_cache) >= _INCLUDE_CACHE_SIZE:
+            _include_cache.clear()
+        _include_cache[key] = includes
 
     for include in includes:
         check_include_legal(abs_dir, abs_target, include)
-
-
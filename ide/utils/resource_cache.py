@@ -0,0 +1,75 @@
+import hashlib
+import os
+import shutil
+import time
+
+from django.conf import settings
+
+# How often, in seconds, each worker checks whether a cache of task outputs has grown past its budget.
+PRUNE_INTERVAL = 3600
+
+
+def resource_cache_dir(sdk):
+    """
+    :return: the directory the wscript build hooks should cache resources built by the SDK whose waf is at sdk in.
+    Each SDK gets its own, since they don't all process resources the same way.
+    """
+    return os.path.join(settings.RESOURCE_CACHE_DIR, hashlib.sha1(sdk + settings.BUILD_CACHE_SALT).hexdigest()[:16])
+
+
+def runtime_cache_dir(sdk, sdk_version, platforms):
+    """
+    :return: the directory the wscript build hooks should cache objects compiled from a shared runtime in, for
+    builds by the SDK whose waf is at sdk for the given platforms. Every project built that way shares it.
+    """
+    key = '%s-%s-%s' % (sdk, sdk_version, '+'.join(sorted(platforms or ['default'])))
+    return os.path.join(settings.PEBBLEJS_RUNTIME_CACHE_DIR,
+                        hashlib.sha1(key + settings.BUILD_CACHE_SALT).hexdigest()[:16])
+
+
+def prune_resource_cache(budget):
+    """
+    Deletes the least recently used entries in the resource cache until the rest fit in budget bytes.
+    """
+    prune_task_cache(settings.RESOURCE_CACHE_DIR, budget)
+
+
+def prune_runtime_cache(budget):
+    """
+    Deletes the least recently used objects in the runtime cache until the rest fit in budget bytes.
+    """
+    prune_task_cache(settings.PEBBLEJS_RUNTIME_CACHE_DIR, budget)
+
+
+def prune_task_cache(root, budget):
+    """
+    Deletes the least recently used entries in a cache kept by the wscript build hooks until the rest fit in budget
+    bytes. Entries are directories of the outputs of one task, touched whenever a build reuses them.
+    Does nothing if the cache was checked less than PRUNE_INTERVAL seconds ago.
+    """
+    marker = os.path.join(root, '.last-pruned')
+    if os.path.exists(marker) and os.stat(marker).st_mtime > time.time() - PRUNE_INTERVAL:
+        return
+    open(marker, 'w').close()
+
+    entries = []
+    total = 0
+    for sdk in os.listdir(root):
+        sdk_dir = os.path.join(root, sdk)
+        if not os.path.isdir(sdk_dir):
+            continue
+        for prefix in os.listdir(sdk_dir):
+            for key in os.listdir(os.path.join(sdk_dir, prefix)):
+                path = os.path.join(sdk_dir, prefix, key)
+                try:
+                    size = sum(os.path.getsize(os.path.join(path, x)) for x in os.listdir(path))
+                    entries.append((os.stat(path).st_mtime, path, size))
+                except OSError:
+                    continue
+                total += size
+    entries.sort()
+    for mtime, path, size in entries:
+        if total <= budget:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
@@ -0,0 +1,28 @@
+import uuid
+
+from django.conf import settings
+
+from utils.redis_helper import redis_client
+
+
+def _revision_key(project_id):
+    return 'project-revision-%d' % project_id
+
+
+def bump_project_revision(project_id):
+    """
+    Notes that something that goes into building the project has changed. Revisions are random rather than counted,
+    so one that has expired can never come back to match a build of an older state of the project.
+    """
+    redis_client.set(_revision_key(project_id), uuid.uuid4().hex, ex=settings.PROJECT_REVISION_TTL)
+
+
+def get_project_revision(project_id):
+    """
+    :return: a string that changes whenever the project does.
+    """
+    revision = redis_client.get(_revision_key(project_id))
+    if revision is None:
+        redis_client.set(_revision_key(project_id), uuid.uuid4().hex, ex=settings.PROJECT_REVISION_TTL, nx=True)
+        revision = redis_client.get(_revision_key(project_id))
+    return revision
@@ -0,0 +1,266 @@
+import errno
+import os
+import shutil
+import signal
+import socket
+import stat
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+from utils.redis_helper import redis_client
+
+_scratch_root = None
+
+
+class ScratchQuotaExceeded(Exception):
+    pass
+
+
+def scratch_root():
+    """
+    Returns the directory that scratch space for builds, imports and exports is allocated in, creating it if
+    necessary. tmpfs is used if it's available and has enough room; builds in a chroot have to stay inside it.
+    """
+    global _scratch_root
+    if _scratch_root is not None:
+        return _scratch_root
+    if settings.SCRATCH_ROOT:
+        root = settings.SCRATCH_ROOT
+    elif settings.CHROOT_ROOT:
+        root = os.path.join(settings.CHROOT_ROOT, 'tmp')
+    elif settings.SCRATCH_TMPFS and _has_room(settings.SCRATCH_TMPFS, settings.SCRATCH_TMPFS_MIN_FREE):
+        root = os.path.join(settings.SCRATCH_TMPFS, 'cloudpebble-scratch')
+    else:
+        root = os.path.join(tempfile.gettempdir(), 'cloudpebble-scratch')
+    try:
+        os.makedirs(root, 0700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    _scratch_root = root
+    return root
+
+
+def _has_room(path, min_free):
+    try:
+        s = os.statvfs(path)
+    except OSError:
+        return False
+    return os.access(path, os.W_OK) and s.f_bavail * s.f_frsize >= min_free
+
+
+def remove_tree(path):
+    """
+    Deletes path and everything in it, even if a build has left behind files or directories it can't write to.
+    """
+    def fix_and_retry(func, failed_path, exc_info):
+        if isinstance(exc_info[1], OSError) and exc_info[1].errno == errno.ENOENT:
+            return
+        # Deleting something needs write permission on the directory it's in, and listing a directory needs read.
+        parent = os.path.dirname(failed_path)
+        os.chmod(parent, os.stat(parent).st_mode | stat.S_IRWXU)
+        if os.path.isdir(failed_path) and not os.path.islink(failed_path):
+            os.chmod(failed_path, os.stat(failed_path).st_mode | stat.S_IRWXU)
+            shutil.rmtree(failed_path)
+        else:
+            func(failed_path)
+
+    if os.path.lexists(path):
+        shutil.rmtree(path, onerror=fix_and_retry)
+
+
+def disk_usage(path):
+    """
+    :return: a tuple of the bytes and inodes used by everything under path.
+    """
+    size = 0
+    inodes = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                continue
+            inodes += 1
+    return size, inodes
+
+
+def check_quota(path, quota=None):
+    """
+    Raises ScratchQuotaExceeded if path has grown beyond quota bytes (settings.SCRATCH_QUOTA by default).
+    """
+    if quota is None:
+        quota = settings.SCRATCH_QUOTA
+    size, inodes = disk_usage(path)
+    if size > quota:
+        raise ScratchQuotaExceeded("Project is too large to build (%d KB; the limit is %d KB)."
+                                   % (size / 1024, quota / 1024))
+
+
+class QuotaWatcher(object):
+    """
+    Keeps an eye on a directory that a build is writing to. Its on_line is meant to be given each line of the build's
+    output, and checks the directory's size at most every settings.SCRATCH_QUOTA_CHECK_INTERVAL seconds; if it has
+    grown beyond quota bytes, the processes given to register are killed. check() raises ScratchQuotaExceeded if
+    that happened, or if the directory is too big now.
+    Processes must be started in their own process group so that everything they started goes too.
+    """
+    def __init__(self, path, quota=None):
+        self.path = path
+        self.quota = quota
+        self.exceeded = None
+        self._processes = []
+        self._lock = threading.Lock()
+        self._last_check = time.time()
+
+    def register(self, process):
+        with self._lock:
+            self._processes.append(process)
+            if self.exceeded is not None:
+                self._kill(process)
+
+    def _kill(self, process):
+        if process.poll() is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def on_line(self, line):
+        if self.exceeded is not None or time.time() - self._last_check < settings.SCRATCH_QUOTA_CHECK_INTERVAL:
+            return
+        self._last_check = time.time()
+        try:
+            check_quota(self.path, self.quota)
+        except ScratchQuotaExceeded as e:
+            with self._lock:
+                self.exceeded = e
+                for process in self._processes:
+                    self._kill(process)
+
+    def check(self):
+        if self.exceeded is not None:
+            raise self.exceeded
+        check_quota(self.path, self.quota)
+
+
+class ScratchDir(object):
+    """
+    A temporary directory for a single task, which can be used as a context manager to make sure it is deleted.
+    Directories whose tasks died without cleaning up after themselves are removed by reap_scratch().
+    """
+    def __init__(self, kind):
+        root = scratch_root()
+        maybe_reap_scratch()
+        # The reaper uses the PID in the name to tell whether the directory is still in use.
+        self.path = tempfile.mkdtemp(prefix='%s-%d-' % (kind, os.getpid()), dir=root)
+
+    def check_quota(self, quota=None):
+        """
+        Raises ScratchQuotaExceeded if the directory has grown beyond quota bytes (settings.SCRATCH_QUOTA by default).
+        """
+        check_quota(self.path, quota)
+
+    def remove(self):
+        remove_tree(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.remove()
+
+
+def scratch_file(kind, suffix=''):
+    """
+    Returns a NamedTemporaryFile for a single task, which is deleted when it's closed. Files whose tasks died without
+    closing them are removed by reap_scratch().
+    """
+    root = scratch_root()
+    maybe_reap_scratch()
+    # The reaper uses the PID in the name to tell whether the file is still in use.
+    return tempfile.NamedTemporaryFile(prefix='%s-%d-' % (kind, os.getpid()), suffix=suffix, dir=root)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def reap_scratch():
+    """
+    Deletes scratch directories and files left behind by tasks that have died, or that are older than any task can
+    run for, and records how much space the scratch area is using. Only the entries at the top of the scratch area
+    are looked at; whatever is inside them goes with them.
+    """
+    root = scratch_root()
+    max_age = settings.CELERYD_TASK_TIME_LIMIT + 60
+    cutoff = time.time() - max_age
+    for name in os.listdir(root):
+        if name.startswith('.'):
+            continue
+        path = os.path.join(root, name)
+        try:
+            st = os.lstat(path)
+        except OSError:
+            continue
+        if not (stat.S_ISDIR(st.st_mode) or stat.S_ISREG(st.st_mode)):
+            continue
+        try:
+            pid = int(name.split('-')[1])
+        except (IndexError, ValueError):
+            pid = None
+        # Give entries a moment before trusting the PID, in case it has been reused.
+        if st.st_mtime < cutoff or (pid is not None and not _pid_alive(pid) and st.st_mtime < time.time() - 60):
+            try:
+                if stat.S_ISDIR(st.st_mode):
+                    remove_tree(path)
+                else:
+                    os.unlink(path)
+            except Exception as e:
+                print "Couldn't reap %s: %s" % (path, e)
+    record_scratch_metrics()
+
+
+def maybe_reap_scratch():
+    """
+    Runs reap_scratch if nothing on this machine has in the last settings.SCRATCH_REAP_INTERVAL seconds.
+    """
+    stamp = os.path.join(scratch_root(), '.last-reaped')
+    try:
+        if os.stat(stamp).st_mtime > time.time() - settings.SCRATCH_REAP_INTERVAL:
+            return
+    except OSError:
+        pass
+    try:
+        with open(stamp, 'a'):
+            os.utime(stamp, None)
+        reap_scratch()
+    except Exception as e:
+        print "Couldn't reap scratch space: %s" % e
+
+
+def record_scratch_metrics():
+    root = scratch_root()
+    s = os.statvfs(root)
+    used, inodes = disk_usage(root)
+    key = 'scratch-metrics-%s' % socket.gethostname()
+    pipe = redis_client.pipeline()
+    pipe.hmset(key, {
+        'root': root,
+        'used_bytes': used,
+        'used_inodes': inodes,
+        'free_bytes': s.f_bavail * s.f_frsize,
+        'total_bytes': s.f_blocks * s.f_frsize,
+        'free_inodes': s.f_favail,
+        'total_inodes': s.f_files,
+        'updated': int(time.time()),
+    })
+    pipe.expire(key, settings.SCRATCH_REAP_INTERVAL * 10)
+    pipe.execute()
@@ -5,6 +5,152 @@ from ide.models.files import ResourceFile, ResourceIdentifier
 
 __author__ = 'katharine'
 
+# Extra build-time setup for wscripts we run ourselves; never included in exported projects.
+BUILD_HOOKS = """
+import os
+
+
+def cloudpebble_build_hooks(ctx):
+    # Compile C through a shared ccache if the build environment provides one.
+    ccache = os.environ.get('CLOUDPEBBLE_CCACHE')
+    if ccache:
+        for env in ctx.all_envs.values():
+            if env.CC:
+                cc = env.CC if isinstance(env.CC, list) else [env.CC]
+                if cc[0] != ccache:
+                    env.CC = [ccache] + cc
+
+    # Reuse processed resources from earlier builds if the build environment provides somewhere to keep them.
+    resource_cache = os.environ.get('CLOUDPEBBLE_RESOURCE_CACHE')
+    if resource_cache:
+        cloudpebble_cache_resources(ctx, resource_cache)
+
+    # Reuse objects compiled from a runtime that every project of this kind shares, if the build environment
+    # provides somewhere to keep them.
+    runtime_cache = os.environ.get('CLOUDPEBBLE_RUNTIME_CACHE')
+    if runtime_cache:
+        cloudpebble_cache_runtime(ctx, runtime_cache)
+
+
+def cloudpebble_cache_task_outputs(cache_dir, cache_key):
+    # Tasks for which cache_key returns a key copy their outputs from cache_dir instead of running, if an earlier
+    # build left them there, and leave them there for later builds if not.
+    import shutil
+    import tempfile
+    from waflib import TaskGen
+
+    def run_cached(task, run):
+        key = cache_key(task)
+        if key is None:
+            return run()
+        entry = os.path.join(cache_dir, key[:2], key)
+        if os.path.isdir(entry):
+            try:
+                for i, node in enumerate(task.outputs):
+                    node.parent.mkdir()
+                    shutil.copyfile(os.path.join(entry, str(i)), node.abspath())
+                os.utime(entry, None)
+                return 0
+            except (IOError, OSError):
+                pass
+        result = run()
+        if not result:
+            temp = None
+            try:
+                if not os.path.isdir(os.path.dirname(entry)):
+                    os.makedirs(os.path.dirname(entry))
+                temp = tempfile.mkdtemp(dir=os.path.dirname(entry))
+                for i, node in enumerate(task.outputs):
+                    shutil.copyfile(node.abspath(), os.path.join(temp, str(i)))
+                os.rename(temp, entry)
+            except (IOError, OSError):
+                # Most likely another build cached the same thing first.
+                if temp is not None:
+                    shutil.rmtree(temp, ignore_errors=True)
+        return result
+
+    create_task = TaskGen.task_gen.create_task
+
+    def create_cached_task(self, *args, **kwargs):
+        task = create_task(self, *args, **kwargs)
+        run = task.run
+        task.run = lambda: run_cached(task, run)
+        return task
+    TaskGen.task_gen.create_task = create_cached_task
+
+
+def cloudpebble_cache_resources(ctx, cache_dir):
+    import hashlib
+    import json
+
+    resource_dir = ctx.path.find_node('resources')
+    if resource_dir is None:
+        return
+    with open(ctx.path.find_node('appinfo.json').abspath()) as f:
+        media = json.load(f).get('resources', {}).get('media', [])
+
+    def cache_key(task):
+        # Only tasks turning one resource file into something else; never the pack or the headers built from all of
+        # them.
+        if len(task.inputs) != 1 or not task.outputs or not task.inputs[0].is_child_of(resource_dir):
+            return None
+        if [x for x in task.outputs if x.name.endswith(('.pbpack', '.h', '.c'))]:
+            return None
+        path = task.inputs[0].path_from(resource_dir)
+        base, ext = os.path.splitext(path)
+        definitions = [x for x in media if x.get('file') == base.split('~')[0] + ext]
+        h = hashlib.sha1()
+        h.update(repr((task.__class__.__name__, getattr(task.__class__, 'hcode', ''), task.env.PLATFORM_NAME,
+                       [task.env[x] for x in getattr(task, 'vars', [])], path,
+                       [x.path_from(ctx.bldnode) for x in task.outputs])))
+        h.update(json.dumps(definitions, sort_keys=True))
+        h.update(hashlib.sha1(task.inputs[0].read('rb')).hexdigest())
+        return h.hexdigest()
+
+    cloudpebble_cache_task_outputs(cache_dir, cache_key)
+
+
+def cloudpebble_cache_runtime(ctx, cache_dir):
+    import hashlib
+
+    top = ctx.path.abspath()
+    # Keep the build directory out of the objects, so that they're the same whichever project's build made them.
+    for env in ctx.all_envs.values():
+        if env.CC:
+            env.append_unique('CFLAGS', ['-fdebug-prefix-map=%s=.' % top])
+
+    def location(node):
+        return node.abspath().replace(top, '.')
+
+    def cache_key(task):
+        # Only compiling one C file; linking brings in the project's own resources.
+        if task.__class__.__name__ != 'c' or len(task.inputs) != 1 or len(task.outputs) != 1:
+            return None
+        h = hashlib.sha1()
+        h.update(repr((getattr(task.__class__, 'hcode', ''), task.env.PLATFORM_NAME,
+                       [str(task.env[x]).replace(top, '.') for x in getattr(task, 'vars', [])],
+                       [location(x) for x in task.outputs])))
+        # Headers generated from the project's resources differ between projects, so everything the file
+        # includes counts.
+        deps = list(getattr(task, 'dep_nodes', [])) + list(ctx.node_deps.get(task.uid(), []))
+        for node in task.inputs + sorted(deps, key=location):
+            h.update(location(node))
+            h.update(hashlib.sha1(node.read('rb')).hexdigest())
+        return h.hexdigest()
+
+    cloudpebble_cache_task_outputs(cache_dir, cache_key)
+
+
+def build(ctx):
+    cloudpebble_build_hooks(ctx)
+"""
+
+
+def add_build_hooks(wscript, for_export):
+    if for_export:
+        return wscript
+    return wscript.replace("\ndef build(ctx):\n", BUILD_HOOKS, 1)
+
 
 def generate_wscript_file_sdk2(project, for_export=False):
     jshint = project.app_jshint
@@ -30,14 +176,11 @@ def options(ctx):
 
 def configure(ctx):
     ctx.load('pebble_sdk')
-    global hint
-    if hint is not None:
-        hint = hint.bake(['--config', 'pebble-jshintrc'])
 
 def build(ctx):
     if {{jshint}} and hint is not None:
         try:
-            hint([node.abspath() for node in ctx.path.ant_glob("src/**/*.js")], _tty_out=False) # no tty because there are none in the cloudpebble sandbox.
+            hint(['--config', 'pebble-jshintrc'] + [node.abspath() for node in ctx.path.ant_glob("src/**/*.js")], _tty_out=False) # no tty because there are none in the cloudpebble sandbox.
         except ErrorReturnCode_2 as e:
             ctx.fatal("\\nJavaScript linting failed (you can disable this in Project Settings):\\n" + e.stdout)
 
@@ -66,6 +209,7 @@ def build(ctx):
                        js='pebble-js-app.js' if has_js else [])
 
 """
+    wscript = add_build_hooks(wscript, for_export)
     return wscript.replace('{{jshint}}', 'True' if jshint and not for_export else 'False')
 
 
@@ -178,6 +322,7 @@ def build(ctx):
     ctx.pbl_bundle(binaries=binaries, js=ctx.path.ant_glob('src/js/**/*.js'), js_entry_file='src/js/app.js')
 """
 
+    wscript = add_build_hooks(wscript, for_export)
     return wscript.replace('{{jshint}}', 'True' if jshint and not for_export else 'False')
 
 
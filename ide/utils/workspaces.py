@@ -0,0 +1,255 @@
+import errno
+import fcntl
+import os
+import shutil
+
+from django.conf import settings
+
+
+# The files waf keeps between 'configure' and 'build', as prefixes of paths relative to the project.
+WAF_CONFIGURE_STATE = ('.lock-waf', 'build/c4che', 'build/config.log')
+# Everything waf keeps between builds, including its outputs, so it only has to rebuild what changed.
+WAF_BUILD_STATE = ('.lock-waf', 'build/')
+
+
+class Workspace(object):
+    """
+    A build directory that outlives a single build. Holding a Workspace holds an exclusive lock on it,
+    so it must be released when the build is done with it.
+    If it is persistent, waf's outputs are kept from one build to the next as well as its configuration.
+    """
+    def __init__(self, path, lock_fd, persistent=False):
+        self.path = path
+        self.persistent = persistent
+        self._lock_fd = lock_fd
+
+    def is_configured(self):
+        return os.path.exists(os.path.join(self.path, 'build', 'c4che'))
+
+    def unconfigure(self):
+        shutil.rmtree(os.path.join(self.path, 'build'), ignore_errors=True)
+
+    def sync_from(self, src):
+        """
+        Makes the workspace contain the project assembled in src, leaving alone any files that haven't changed.
+        """
+        sync_tree(src, self.path, preserve=WAF_BUILD_STATE if self.persistent else WAF_CONFIGURE_STATE)
+        if self.persistent:
+            # Make sure nothing left over from the last build can be mistaken for the output of this one.
+            for root, dirs, files in os.walk(os.path.join(self.path, 'build')):
+                for name in files:
+                    if name.endswith('.pbw') or name in ('pebble-app.elf', 'pebble-worker.elf'):
+                        os.unlink(os.path.join(root, name))
+
+    def release(self):
+        if self._lock_fd is not None:
+            if self.persistent:
+                try:
+                    with open(self.path + '.size', 'w') as f:
+                        f.write(str(_disk_usage(self.path)))
+                except (IOError, OSError) as e:
+                    print "Couldn't record workspace size: %s" % e
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+
+def _try_lock(lock_path):
+    fd = os.open(lock_path, os.O_CREAT | os.O_RDWR, 0600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        os.close(fd)
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return fd
+
+
+def workspace_pool_key(project, manifest_dict):
+    """
+    Builds only share a pre-configured workspace if configuring them would have produced the same result,
+    which depends on the SDK, the platforms in the manifest and the kind of project.
+    """
+    platforms = '+'.join(sorted(manifest_dict.get('targetPlatforms', None) or ['default']))
+    return '%s-%s-%s' % (project.project_type, project.sdk_version, platforms)
+
+
+def acquire_pooled_workspace(key):
+    """
+    Takes a free workspace from this worker's pool for the given key, creating one if the pool isn't full yet.
+    Pooled workspaces are shared between projects, so only waf's configuration is kept in them.
+    :return: a Workspace, or None if every workspace in the pool is in use.
+    """
+    root = os.path.join(settings.BUILD_WORKSPACE_ROOT, 'pool', key)
+    if not os.path.exists(root):
+        try:
+            os.makedirs(root)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    for i in xrange(settings.BUILD_WORKSPACE_POOL_SIZE):
+        fd = _try_lock(os.path.join(root, '%d.lock' % i))
+        if fd is None:
+            continue
+        path = os.path.join(root, str(i))
+        if not os.path.exists(path):
+            os.mkdir(path)
+        return Workspace(path, fd)
+    return None
+
+
+def acquire_project_workspace(name, config_key):
+    """
+    Takes the persistent workspace with the given name (normally a project ID) on this worker, creating it if
+    necessary. If it was last configured for something other than config_key, its build state is thrown away.
+    :return: a Workspace, or None if another build is already using it.
+    """
+    root = os.path.join(settings.BUILD_WORKSPACE_ROOT, 'projects')
+    if not os.path.exists(root):
+        try:
+            os.makedirs(root)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    lock_path = os.path.join(root, '%s.lock' % name)
+    fd = _try_lock(lock_path)
+    if fd is None:
+        return None
+    # The lock file's mtime records when the workspace was last used.
+    os.utime(lock_path, None)
+    path = os.path.join(root, name)
+    if not os.path.exists(path):
+        os.mkdir(path)
+    workspace = Workspace(path, fd, persistent=True)
+
+    key_path = path + '.key'
+    try:
+        with open(key_path) as f:
+            old_key = f.read()
+    except IOError:
+        old_key = None
+    if old_key != config_key:
+        workspace.unconfigure()
+        with open(key_path, 'w') as f:
+            f.write(config_key)
+    return workspace
+
+
+def evict_project_workspaces(budget):
+    """
+    Deletes the least recently used persistent workspaces on this worker until the rest fit in budget bytes.
+    Workspaces that are in use are skipped.
+    """
+    root = os.path.join(settings.BUILD_WORKSPACE_ROOT, 'projects')
+    if not os.path.isdir(root):
+        return
+    workspaces = []
+    total = 0
+    for filename in os.listdir(root):
+        if not filename.endswith('.lock'):
+            continue
+        name = filename[:-len('.lock')]
+        path = os.path.join(root, name)
+        try:
+            with open(path + '.size') as f:
+                size = int(f.read())
+        except (IOError, ValueError):
+            continue
+        workspaces.append((os.stat(os.path.join(root, filename)).st_mtime, path, size))
+        total += size
+    workspaces.sort()
+    for mtime, path, size in workspaces:
+        if total <= budget:
+            break
+        fd = _try_lock(path + '.lock')
+        if fd is None:
+            continue
+        try:
+            # The lock file itself has to stay, or someone could end up locking a different file of the same name.
+            shutil.rmtree(path, ignore_errors=True)
+            for suffix in ('.key', '.size'):
+                if os.path.exists(path + suffix):
+                    os.unlink(path + suffix)
+            total -= size
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+
+def _disk_usage(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+
+def _is_preserved(rel_path, preserve):
+    return any(rel_path.startswith(prefix) for prefix in preserve)
+
+
+def _contains_preserved(rel_path, preserve):
+    return any(prefix.startswith(rel_path + '/') for prefix in preserve)
+
+
+def _same_contents(a, b):
+    a_stat = os.stat(a)
+    b_stat = os.stat(b)
+    if a_stat.st_size != b_stat.st_size:
+        return False
+    if a_stat.st_mtime == b_stat.st_mtime:
+        return True
+    with open(a, 'rb') as fa, open(b, 'rb') as fb:
+        while True:
+            block_a = fa.read(65536)
+            if block_a != fb.read(65536):
+                return False
+            if not block_a:
+                return True
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def sync_tree(src, dest, preserve=()):
+    """
+    Makes dest match src. Files whose contents haven't changed are left alone, so they keep their mtimes.
+    Anything in dest that isn't in src is deleted, unless its path relative to dest starts with one of the
+    prefixes in preserve.
+    """
+    for root, dirs, files in os.walk(src):
+        rel_root = os.path.relpath(root, src)
+        dest_root = os.path.normpath(os.path.join(dest, rel_root))
+        if not os.path.isdir(dest_root) or os.path.islink(dest_root):
+            _remove(dest_root)
+            os.makedirs(dest_root)
+        for name in files:
+            src_file = os.path.join(root, name)
+            dest_file = os.path.join(dest_root, name)
+            if os.path.isfile(dest_file) and not os.path.islink(dest_file) and _same_contents(src_file, dest_file):
+                continue
+            _remove(dest_file)
+            shutil.copy2(src_file, dest_file)
+
+    for root, dirs, files in os.walk(dest):
+        rel_root = os.path.relpath(root, dest)
+        src_root = os.path.normpath(os.path.join(src, rel_root))
+        for name in list(dirs):
+            rel_path = os.path.normpath(os.path.join(rel_root, name))
+            if _is_preserved(rel_path, preserve):
+                dirs.remove(name)
+            elif not os.path.isdir(os.path.join(src_root, name)) and not _contains_preserved(rel_path, preserve):
+                shutil.rmtree(os.path.join(root, name))
+                dirs.remove(name)
+        for name in files:
+            rel_path = os.path.normpath(os.path.join(rel_root, name))
+            if not _is_preserved(rel_path, preserve) and not os.path.isfile(os.path.join(src_root, name)):
+                os.unlink(os.path.join(root, name))
@@ -68,7 +68,8 @@ def github_hook(request, project_id):
 def build_status(request, project_id):
     project = get_object_or_404(Project, pk=project_id)
     try:
-        last_build = BuildResult.objects.order_by('-id').filter(~Q(state=BuildResult.STATE_WAITING), project=project)[0]
+        last_build = BuildResult.objects.order_by('-id').filter(~Q(state=BuildResult.STATE_WAITING), project=project,
+                                                                speculative=False, platforms=None)[0]
     except IndexError:
         return HttpResponseRedirect(settings.STATIC_URL + '/ide/img/status/error.png')
     if last_build.state == BuildResult.STATE_SUCCEEDED:
@@ -3,6 +3,8 @@ from boto.s3.key import Key
 from boto.s3.connection import OrdinaryCallingFormat
 from django.conf import settings
 import urllib
+import os
+from multiprocessing.pool import ThreadPool
 
 def _ensure_bucket_exists(s3, bucket):
     try:
@@ -50,12 +52,57 @@ def read_file(bucket_name, path):
     return key.get_contents_as_string()
 
 
+@_requires_aws
+def read_file_if_exists(bucket_name, path):
+    """
+    :return: the contents of the file, or None if there is no such file.
+    """
+    bucket = _buckets[bucket_name]
+    key = bucket.get_key(path)
+    if key is None:
+        return None
+    return key.get_contents_as_string()
+
+
 @_requires_aws
 def read_file_to_filesystem(bucket_name, path, destination):
     bucket = _buckets[bucket_name]
     key = bucket.get_key(path)
     key.get_contents_to_filename(destination)
 
+@_requires_aws
+def read_files_to_filesystem(bucket_name, transfers, concurrency=8, keep=()):
+    """
+    Downloads many files at once.
+    :param transfers: a list of (path, destination) pairs.
+    :param keep: destinations whose contents should also be returned.
+    :return: a tuple of the total number of bytes downloaded and a dict of the contents of each destination in keep.
+    """
+    bucket = _buckets[bucket_name]
+    contents = {}
+    if not transfers:
+        return 0, contents
+
+    def fetch(transfer):
+        path, destination = transfer
+        # Constructing the key ourselves instead of using get_key saves a HEAD request per file.
+        key = Key(bucket, path)
+        if destination in keep:
+            data = key.get_contents_as_string()
+            with open(destination, 'wb') as f:
+                f.write(data)
+            contents[destination] = data
+            return len(data)
+        key.get_contents_to_filename(destination)
+        return os.path.getsize(destination)
+
+    pool = ThreadPool(min(concurrency, len(transfers)))
+    try:
+        return sum(pool.map(fetch, transfers)), contents
+    finally:
+        pool.close()
+
+
 @_requires_aws
 def delete_file(bucket_name, path):
     bucket = _buckets[bucket_name]
@@ -76,6 +123,22 @@ def save_file(bucket_name, path, value, public=False, content_type='application/
     key.set_contents_from_string(value, policy=policy, headers={'Content-Type': content_type})
 
 
+@_requires_aws
+def save_files(bucket_name, files, public=False, content_type='application/octet-stream', concurrency=8):
+    """
+    Saves many files at once.
+    :param files: a list of (path, value) pairs.
+    """
+    if not files:
+        return
+    pool = ThreadPool(min(concurrency, len(files)))
+    try:
+        pool.map(lambda (path, value): save_file(bucket_name, path, value, public=public, content_type=content_type),
+                 files)
+    finally:
+        pool.close()
+
+
 @_requires_aws
 def upload_file(bucket_name, dest_path, src_path, public=False, content_type='application/octet-stream', download_filename=None):
     bucket = _buckets[bucket_name]
@@ -97,6 +160,24 @@ def upload_file(bucket_name, dest_path, src_path, public=False, content_type='ap
     key.set_contents_from_filename(src_path, policy=policy, headers=headers)
 
 
+@_requires_aws
+def copy_file(bucket_name, src_path, dest_path, public=False):
+    bucket = _buckets[bucket_name]
+
+    if public:
+        policy = 'public-read'
+    else:
+        policy = 'private'
+
+    try:
+        bucket.copy_key(dest_path, bucket.name, src_path, headers={'x-amz-acl': policy})
+    except boto.exception.S3ResponseError as e:
+        if e.status == 404:
+            return False
+        raise
+    return True
+
+
 @_requires_aws
 def get_signed_url(bucket_name, path, headers=None):
     bucket = _buckets[bucket_name]